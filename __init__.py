@@ -1,4 +1,5 @@
 from .topaz import NODE_CLASS_MAPPINGS, NODE_DISPLAY_NAME_MAPPINGS
+from .janitor import get_janitor
 import os
 import shutil
 import __main__
@@ -6,6 +7,9 @@ import __main__
 WEB_DIRECTORY = "./web"
 __all__ = ['NODE_CLASS_MAPPINGS', 'NODE_DISPLAY_NAME_MAPPINGS', 'WEB_DIRECTORY']
 
+# 注册节点时启动 Topaz 缓存的后台清理线程，首次统计不必等到节点第一次运行
+get_janitor()
+
 # 确保 ComfyUI web 扩展目录存在
 # 使用新的插件名称 "ComfyTopazPhoto" 作为子目录名
 extensions_dir_name = "ComfyTopazPhoto"
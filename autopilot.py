@@ -0,0 +1,162 @@
+import os
+import re
+import json
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+
+from .cli import TPAI_ERROR_CODES, TopazError, TpaiOutputParser, build_tpai_argv, run_tpai
+from .result_cache import default_cache_dir
+from .staging import make_work_dir
+
+# 日志前缀
+log_prefix = "[ComfyTopazPhoto]"
+
+def map_autopilot_settings(entries, token, count):
+    """
+    把 TpaiOutputParser 解析出的 Autopilot 设置分配给每个输入
+
+    输入文件以 "<token>_<index>" 命名。设置归属于它之前的输出中最后提到的输入文件；
+    如果没有提到文件名，则按出现顺序依次分配。
+
+    参数:
+        entries (list): TpaiOutputParser.autopilot
+        token (str): 输入文件名的 token
+        count (int): 输入数量
+
+    返回:
+        list: 与输入顺序一致的设置列表 (JSON 可解析时为 dict，否则为原始字符串)，缺失的为 None
+    """
+    name_pattern = re.compile(re.escape(token) + r"_(\d{5})")
+    settings = [None] * count
+    next_unassigned = 0
+
+    for context, value in entries:
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+
+        mentioned = [int(i) for i in name_pattern.findall(context) if int(i) < count]
+        if mentioned and settings[mentioned[-1]] is None:
+            index = mentioned[-1]
+        else:
+            while next_unassigned < count and settings[next_unassigned] is not None:
+                next_unassigned += 1
+            index = next_unassigned
+        if index < count:
+            settings[index] = value
+
+    return settings
+
+def analyze_autopilot(tpai_exe, input_paths, timeout=None):
+    """
+    只计算 Autopilot 设置而不渲染图像
+
+    所有输入放入同一个暂存文件夹，以 --showSettings --skipProcessing 启动一次 tpai。
+
+    参数:
+        tpai_exe (str): Topaz Photo AI 可执行文件路径
+        input_paths (list): 输入图像路径列表
+        timeout (float, optional): 超时时间 (秒)，默认每个图像 60 秒
+
+    返回:
+        list: 与 input_paths 顺序一致的 Autopilot 设置
+
+    异常:
+        TopazError: tpai 以错误返回码 (未登录、参数错误等) 结束，此时不返回任何设置
+    """
+    if not input_paths:
+        return []
+
+    token = uuid.uuid4().hex[:12]
+    work_dir = make_work_dir(prefix="autopilot_")
+    try:
+        for i, path in enumerate(input_paths):
+            staged = os.path.join(work_dir, f"{token}_{i:05d}{os.path.splitext(path)[1]}")
+            try:
+                os.link(path, staged)
+            except OSError:
+                shutil.copy2(path, staged)
+
+        argv = build_tpai_argv(tpai_exe, work_dir, show_settings=True, skip_processing=True)
+        print(f"{log_prefix} 分析 {len(input_paths)} 个图像的 Autopilot 设置")
+        parser = TpaiOutputParser()
+        result = run_tpai(argv, timeout=timeout or 60 * len(input_paths), parser=parser)
+        if result.returncode not in (0, 1):
+            detail = result.stderr.strip() or "; ".join(parser.errors) or TPAI_ERROR_CODES.get(result.returncode, "未知错误")
+            raise TopazError(f"Autopilot 分析失败: {detail} (返回码: {result.returncode}, {len(input_paths)} 个图像)")
+        return map_autopilot_settings(parser.autopilot, token, len(input_paths))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+class AutopilotCache:
+    """
+    按图像内容哈希缓存 Autopilot 设置
+
+    内存中保留最近使用的 max_entries 条，同时以 JSON 文件持久化到磁盘。
+    """
+
+    def __init__(self, cache_dir=None, max_entries=4096):
+        self.cache_dir = cache_dir or os.path.join(default_cache_dir(), "autopilot")
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, key):
+        """返回缓存的设置，未命中时返回 None"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        """缓存设置"""
+        tmp_path = self._path(key) + f".{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, self._path(key))
+        with self._lock:
+            self._remember(key, value)
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"memory_entries": len(self._memory), "hits": self.hits, "misses": self.misses}
+
+_autopilot_cache = None
+_autopilot_cache_lock = threading.Lock()
+
+def get_autopilot_cache():
+    """返回进程共享的 Autopilot 设置缓存"""
+    global _autopilot_cache
+    with _autopilot_cache_lock:
+        if _autopilot_cache is None:
+            _autopilot_cache = AutopilotCache()
+        return _autopilot_cache
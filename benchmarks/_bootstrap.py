@@ -0,0 +1,27 @@
+"""
+Import this extension's modules outside ComfyUI.
+
+The package __init__ copies web assets into the running ComfyUI install, so the
+benchmarks register an empty package pointing at the repository instead and
+import the submodules they need from it. Modules that need ComfyUI itself
+(tpai.py imports folder_paths) load when COMFYUI_DIR points at a ComfyUI
+checkout.
+"""
+import importlib
+import os
+import sys
+import types
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = "comfy_topaz_photo"
+STUB_TPAI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_tpai.py")
+
+if os.environ.get("COMFYUI_DIR"):
+    sys.path.insert(0, os.environ["COMFYUI_DIR"])
+
+def load(module):
+    if PACKAGE not in sys.modules:
+        package = types.ModuleType(PACKAGE)
+        package.__path__ = [REPO_DIR]
+        sys.modules[PACKAGE] = package
+    return importlib.import_module(f"{PACKAGE}.{module}")
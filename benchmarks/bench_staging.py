@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Compare staging and output formats using the stub tpai.
+
+For every combination of staging format (the files handed to tpai) and output
+format (the files read back), times the three stages the node pays for:
+encoding the batch, one batch-mode tpai run, and decoding into a tensor.
+
+    python benchmarks/bench_staging.py --batch 8 --size 1024 --repeat 3
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import torch
+
+from _bootstrap import STUB_TPAI, load
+
+topaz = load("topaz")
+
+OUTPUT_FORMATS = ["auto", "png", "jpg"]
+
+def time_once(images, staging_format, output_format):
+    work_dir = tempfile.mkdtemp(prefix="bench_staging_")
+    try:
+        start = time.perf_counter()
+        input_paths = topaz.save_images(images, output_dir=work_dir, staging_format=staging_format)
+        encoded = time.perf_counter()
+        output_paths = topaz.process_topaz_batch(STUB_TPAI, input_paths, os.path.join(work_dir, "out"), output_format)
+        processed = time.perf_counter()
+        topaz.load_images_to_tensor(output_paths)
+        decoded = time.perf_counter()
+        staged_bytes = sum(os.path.getsize(p) for p in input_paths)
+        return {
+            "encode_s": encoded - start,
+            "tpai_s": processed - encoded,
+            "decode_s": decoded - processed,
+            "total_s": decoded - start,
+            "staged_bytes": staged_bytes,
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch", type=int, default=4)
+    parser.add_argument("--size", type=int, default=512, help="square frame size in pixels")
+    parser.add_argument("--repeat", type=int, default=3, help="best of N runs is reported")
+    parser.add_argument("--output", help="write the JSON results to this file")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    images = torch.rand(args.batch, args.size, args.size, 3)
+
+    results = []
+    for staging_format in topaz.STAGING_FORMATS:
+        for output_format in OUTPUT_FORMATS:
+            runs = [time_once(images, staging_format, output_format) for _ in range(args.repeat)]
+            best = min(runs, key=lambda r: r["total_s"])
+            results.append({"staging_format": staging_format, "output_format": output_format, **best})
+            print(f"{staging_format:>9} -> {output_format:<4}  "
+                  f"encode {best['encode_s']:.3f}s  tpai {best['tpai_s']:.3f}s  "
+                  f"decode {best['decode_s']:.3f}s  total {best['total_s']:.3f}s")
+
+    report = {"batch": args.batch, "size": args.size, "repeat": args.repeat, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
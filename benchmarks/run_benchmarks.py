@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Time the extension's Python hot path against the stub tpai.
+
+Runs save_images, load_images, load_images_to_tensor, process_topaz_image and
+both node classes (node_remote: in client mode against --remote-workers
+local worker services) over every combination of batch size and resolution, and
+reports the best and median of N runs. Results are JSON so two versions can
+be diffed; --compare prints the change against an earlier results file and
+exits non-zero when a case got slower than --threshold.
+
+    python benchmarks/run_benchmarks.py --batches 1,8 --sizes 256,1024 --output after.json
+    python benchmarks/run_benchmarks.py --compare before.json --threshold 0.2
+
+The stub's simulated latency and upscale factor come from --startup-latency,
+--image-latency and --scale. tpai.py's node needs ComfyUI's folder_paths and is
+skipped unless COMFYUI_DIR is set.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import torch
+
+from _bootstrap import STUB_TPAI, load
+
+topaz = load("topaz")
+try:
+    tpai = load("tpai")
+except ImportError as e:
+    tpai = None
+    TPAI_SKIP_REASON = str(e)
+
+def bench_save_images(images, work_dir):
+    def run():
+        topaz.save_images(images, output_dir=work_dir)
+    return run
+
+def staged_inputs(images, work_dir):
+    input_dir = os.path.join(work_dir, "inputs")
+    os.makedirs(input_dir)
+    return topaz.save_images(images, output_dir=input_dir)
+
+def bench_load_images(images, work_dir):
+    paths = staged_inputs(images, work_dir)
+    return lambda: topaz.load_images(paths)
+
+def bench_load_images_to_tensor(images, work_dir):
+    paths = staged_inputs(images, work_dir)
+    return lambda: topaz.load_images_to_tensor(paths)
+
+def bench_process_topaz_image(images, work_dir):
+    paths = staged_inputs(images, work_dir)
+    output_folder = os.path.join(work_dir, "out")
+    return lambda: topaz.process_topaz_image(STUB_TPAI, paths, output_folder, "png", overwrite=True)
+
+def bench_node(execution_mode):
+    def setup(images, work_dir):
+        node = topaz.ComfyTopazPhoto()
+        return lambda: node.process_images(images, STUB_TPAI, "auto", use_cache="False", dedup="off",
+                                           execution_mode=execution_mode)
+    return setup
+
+REMOTE_WORKERS = 2
+_worker_urls = []
+
+def local_worker_urls():
+    """Start REMOTE_WORKERS in-process worker services on ephemeral ports, once."""
+    if not _worker_urls:
+        worker = load("worker")
+        for _ in range(REMOTE_WORKERS):
+            server = worker.make_server(worker.TopazWorker(STUB_TPAI), port=0)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            _worker_urls.append("http://%s:%d" % server.server_address[:2])
+    return ",".join(_worker_urls)
+
+def bench_remote_node(images, work_dir):
+    node = topaz.ComfyTopazPhoto()
+    urls = local_worker_urls()
+    return lambda: node.process_images(images, STUB_TPAI, "auto", use_cache="False", dedup="off", worker_urls=urls)
+
+def bench_tpai_node(images, work_dir):
+    node = tpai.ComfyTopazPhoto()
+    upscale = tpai.ComfyTopazPhotoUpscaleSettings().get_settings(True)[0]
+    return lambda: node.process(images, STUB_TPAI, 2, upscale=upscale)
+
+CASES = {
+    "save_images": bench_save_images,
+    "load_images": bench_load_images,
+    "load_images_to_tensor": bench_load_images_to_tensor,
+    "process_topaz_image": bench_process_topaz_image,
+    "node_batch": bench_node("batch"),
+    "node_sequential": bench_node("sequential"),
+    "node_pipeline": bench_node("pipeline"),
+    "node_remote": bench_remote_node,
+    "tpai_node": bench_tpai_node,
+}
+
+def run_case(name, images, repeat):
+    work_dir = tempfile.mkdtemp(prefix=f"bench_{name}_")
+    try:
+        run = CASES[name](images, work_dir)
+        run()  # warm-up: imports, first process launch, page cache
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        "best_s": min(times),
+        "median_s": statistics.median(times),
+        "per_frame_ms": min(times) / len(images) * 1000,
+    }
+
+def case_key(result):
+    return f"{result['case']}/b{result['batch']}/{result['size']}px"
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = {case_key(r): r for r in json.load(f)["results"]}
+
+    regressions = []
+    print(f"\n{'case':<40}{'before':>10}{'after':>10}{'change':>9}")
+    for result in results:
+        before = baseline.get(case_key(result))
+        if before is None:
+            continue
+        change = result["best_s"] / before["best_s"] - 1
+        flag = "  <-- slower" if change > threshold else ""
+        print(f"{case_key(result):<40}{before['best_s']:>9.4f}s{result['best_s']:>9.4f}s{change:>+8.1%}{flag}")
+        if change > threshold:
+            regressions.append(case_key(result))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batches", default="1,8", help="comma-separated batch sizes")
+    parser.add_argument("--sizes", default="256,1024", help="comma-separated square frame sizes in pixels")
+    parser.add_argument("--cases", default=",".join(CASES), help="comma-separated subset of: " + ", ".join(CASES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--startup-latency", type=float, default=0.0, help="stub seconds per tpai launch")
+    parser.add_argument("--image-latency", type=float, default=0.0, help="stub seconds per image")
+    parser.add_argument("--scale", type=float, default=1.0, help="stub upscale factor")
+    parser.add_argument("--remote-workers", type=int, default=2, help="local worker services for node_remote")
+    parser.add_argument("--output", help="write the JSON results to this file")
+    parser.add_argument("--compare", help="results file from an earlier run to diff against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative slowdown reported as a regression")
+    args = parser.parse_args()
+
+    os.environ["TPAI_STUB_STARTUP_SECONDS"] = str(args.startup_latency)
+    os.environ["TPAI_STUB_IMAGE_SECONDS"] = str(args.image_latency)
+    os.environ["TPAI_STUB_SCALE"] = str(args.scale)
+    global REMOTE_WORKERS
+    REMOTE_WORKERS = args.remote_workers
+
+    cases = [c for c in args.cases.split(",") if c]
+    unknown = [c for c in cases if c not in CASES]
+    if unknown:
+        parser.error(f"unknown cases: {unknown}")
+    if tpai is None and "tpai_node" in cases:
+        print(f"skipping tpai_node: {TPAI_SKIP_REASON}")
+        cases.remove("tpai_node")
+
+    torch.manual_seed(0)
+    results = []
+    for size in [int(s) for s in args.sizes.split(",")]:
+        for batch in [int(b) for b in args.batches.split(",")]:
+            images = torch.rand(batch, size, size, 3)
+            for name in cases:
+                result = {"case": name, "batch": batch, "size": size, **run_case(name, images, args.repeat)}
+                results.append(result)
+                print(f"{case_key(result):<40}best {result['best_s']:.4f}s  median {result['median_s']:.4f}s  "
+                      f"{result['per_frame_ms']:.1f} ms/frame", flush=True)
+
+    report = {
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "stub": {"startup_latency": args.startup_latency, "image_latency": args.image_latency, "scale": args.scale},
+        "repeat": args.repeat,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} case(s) slower than {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+A stand-in for Topaz Photo AI's `tpai` CLI, used by the benchmarks.
+
+It accepts files and folders like the real CLI, honours --output, --format,
+--quality, --compression, --bit-depth and --tiff-compression, and writes each
+input back out in the requested format. --showSettings prints an
+"Autopilot settings: {...}" line per input and --skipProcessing skips writing
+outputs. No Topaz install, license or GPU is needed, so the timings measure
+only this extension's own overhead.
+
+The CLI is driven by the extension, so the simulated behaviour is set through
+environment variables instead of flags:
+
+    TPAI_STUB_STARTUP_SECONDS   sleep once before processing (model loading)
+    TPAI_STUB_IMAGE_SECONDS     sleep per processed image
+    TPAI_STUB_SCALE             resize outputs by this factor (default 1, a copy)
+    TPAI_STUB_EXIT_CODE         exit with this code after processing
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from PIL import Image
+
+IMAGE_EXTS = {".jpg", ".jpeg", ".png", ".tif", ".tiff", ".dng"}
+PIL_FORMATS = {"jpg": "JPEG", "jpeg": "JPEG", "png": "PNG", "tif": "TIFF", "tiff": "TIFF"}
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="tpai")
+    parser.add_argument("inputs", nargs="*")
+    parser.add_argument("--output", "-o")
+    parser.add_argument("--format", "-f", default="preserve")
+    parser.add_argument("--quality", "-q", type=int, default=95)
+    parser.add_argument("--compression", "-c", type=int, default=2)
+    parser.add_argument("--bit-depth", "-d", type=int, default=16)
+    parser.add_argument("--tiff-compression", "-tc", default="zip")
+    parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument("--recursive", "-r", action="store_true")
+    parser.add_argument("--showSettings", action="store_true")
+    parser.add_argument("--skipProcessing", action="store_true")
+    parser.add_argument("--verbose", "-v", action="store_true")
+    parser.add_argument("--override", action="store_true")
+    parser.add_argument("--settings")
+    parser.add_argument("--version", action="store_true")
+    parser.add_argument("--test", action="store_true")
+    # Unknown flags are ignored so newer tpai options do not break the stub
+    args, _ = parser.parse_known_args(argv)
+    return args
+
+def collect_inputs(paths, recursive):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                files.extend(os.path.join(root, n) for n in sorted(names)
+                             if os.path.splitext(n)[1].lower() in IMAGE_EXTS)
+                if not recursive:
+                    break
+        elif os.path.isfile(path):
+            files.append(path)
+    return files
+
+def output_path_for(input_path, args):
+    stem, ext = os.path.splitext(os.path.basename(input_path))
+    fmt = ext[1:].lower() if args.format == "preserve" else args.format
+    if args.output and os.path.splitext(args.output)[1]:
+        # A file path was given as --output (tpai.py does this for single images)
+        return args.output, fmt
+    folder = args.output or os.path.dirname(input_path)
+    return os.path.join(folder, f"{stem}.{fmt}"), fmt
+
+def env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+def autopilot_settings(input_path, img, scale):
+    # Deterministic per input so cached and fresh analyses can be compared
+    return {
+        "input": os.path.basename(input_path),
+        "size": list(img.size),
+        "enhance": {"enabled": scale != 1, "scale": scale},
+    }
+
+def save(img, path, fmt, args):
+    pil_format = PIL_FORMATS[fmt]
+    if pil_format == "JPEG":
+        img.convert("RGB").save(path, pil_format, quality=args.quality)
+    elif pil_format == "PNG":
+        img.save(path, pil_format, compress_level=min(args.compression, 9))
+    else:
+        compression = None if args.tiff_compression == "none" else "tiff_adobe_deflate"
+        img.save(path, pil_format, compression=compression)
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.version:
+        print("tpai stub 1.0.0")
+        return 0
+    if args.test:
+        print("Test passed")
+        return 0
+
+    files = collect_inputs(args.inputs, args.recursive)
+    if not files:
+        print("No valid files passed.", file=sys.stderr)
+        return 255
+
+    image_seconds = env_float("TPAI_STUB_IMAGE_SECONDS", 0)
+    scale = env_float("TPAI_STUB_SCALE", 1)
+    time.sleep(env_float("TPAI_STUB_STARTUP_SECONDS", 0))
+
+    for input_path in files:
+        print(f"Processing {input_path}")
+        with Image.open(input_path) as img:
+            img.load()
+            if args.showSettings:
+                print("Autopilot settings: " + json.dumps(autopilot_settings(input_path, img, scale)))
+            if args.skipProcessing:
+                continue
+            time.sleep(image_seconds)
+            if scale != 1:
+                img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.BICUBIC)
+            out_path, fmt = output_path_for(input_path, args)
+            os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+            save(img, out_path, fmt, args)
+        print(f"Processed {input_path} -> {out_path}")
+    sys.stdout.flush()
+    return int(os.environ.get("TPAI_STUB_EXIT_CODE", 0))
+
+if __name__ == "__main__":
+    sys.exit(main())
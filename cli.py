@@ -0,0 +1,166 @@
+import os
+import re
+import shlex
+import subprocess
+
+from .jobs import JobCancelled, TopazJob, get_job_runner
+from .metrics import record
+from .progress import current_progress, interrupted, throw_if_interrupted
+from .scheduler import get_scheduler
+
+# Topaz Photo AI 异常类
+class TopazError(Exception):
+    """Topaz Photo AI 相关错误的异常类"""
+    pass
+
+# tpai 输出 Autopilot 设置时使用的行前缀
+AUTOPILOT_PREFIX = "Autopilot settings: "
+
+# tpai 的错误返回码 (0=成功, 1=部分成功)
+TPAI_ERROR_CODES = {
+    255: "No valid files passed.",
+    254: "Invalid log token. Login via GUI.",
+    253: "Invalid argument.",
+}
+
+# 开始处理第 x 个文件的行: "Processing 3 of 10"、"[3/10]" 等
+_PROGRESS_PATTERN = re.compile(r"(?:^|\[|\s)(\d+)\s*(?:/|of)\s*(\d+)(?:\]|\s|$)")
+# 单个文件完成的行
+_DONE_PATTERN = re.compile(r"^\s*(processed|saved|finished|exported)\b", re.IGNORECASE)
+# 当前文件内部的进度 (--verbose 时输出): "45%"
+_PERCENT_PATTERN = re.compile(r"(\d{1,3}(?:\.\d+)?)\s*%")
+_ERROR_PATTERN = re.compile(r"\b(error|failed|failure)\b", re.IGNORECASE)
+
+def build_tpai_argv(tpai_exe, inputs, output=None, options=(), settings=None, show_settings=False, skip_processing=False, overwrite=False):
+    """
+    构建 tpai 的参数列表
+
+    参数直接传给进程而不经过 shell，路径和 JSON 设置中的引号、空格都不需要转义。
+
+    参数:
+        tpai_exe (str): tpai 可执行文件路径
+        inputs (str | list): 输入文件或文件夹
+        output (str, optional): 输出文件夹或文件
+        options (list): 其他参数，如 ["--format", "png"]
+        settings (str, optional): 通过 --settings 传递的 JSON 设置
+        show_settings (bool): 是否输出 Autopilot 设置
+        skip_processing (bool): 是否只分析不处理
+        overwrite (bool): 是否覆盖现有文件
+
+    返回:
+        list: 参数列表
+    """
+    argv = [tpai_exe] + ([inputs] if isinstance(inputs, str) else list(inputs))
+    if output:
+        argv += ["--output", output]
+    argv += list(options)
+    if settings:
+        argv += ["--settings", settings]
+    if show_settings:
+        argv.append("--showSettings")
+    if skip_processing:
+        argv.append("--skipProcessing")
+    if overwrite:
+        argv.append("--overwrite")
+    return argv
+
+def format_argv(argv):
+    """将参数列表格式化为可复制到终端的命令行，仅用于日志"""
+    return subprocess.list2cmdline(argv) if os.name == "nt" else shlex.join(argv)
+
+class TpaiOutputParser:
+    """
+    逐行解析 tpai 的标准输出
+
+    作为 TopazJob 的 on_line 回调，在输出到达时增量提取 Autopilot 设置、进度和错误。
+    进度变化时调用 on_progress(processed, fraction)，fraction 为当前文件内部的进度 (0-1)，
+    输出中没有时为 None。
+
+    属性:
+        autopilot (list): (上下文, 设置字符串) 列表，上下文是上一条设置之后到本条设置之前的输出，
+            用于判断设置属于哪个输入
+        processed (int): 已完成的文件数
+        errors (list): 包含错误信息的行
+    """
+
+    def __init__(self, on_progress=None):
+        self.on_progress = on_progress
+        self.autopilot = []
+        self.processed = 0
+        self.errors = []
+        self._context = []
+
+    def feed(self, line):
+        if line.startswith(AUTOPILOT_PREFIX):
+            self.autopilot.append(("\n".join(self._context), line[len(AUTOPILOT_PREFIX):].strip()))
+            self._context = []
+            return
+        self._context.append(line)
+
+        if _ERROR_PATTERN.search(line):
+            self.errors.append(line)
+
+        if _DONE_PATTERN.match(line):
+            self._report(self.processed + 1, None)
+            return
+        match = _PROGRESS_PATTERN.search(line)
+        if match and int(match.group(2)) > 0:
+            # 开始处理第 x 个文件，说明之前的 x-1 个已完成
+            self._report(int(match.group(1)) - 1, 0.0)
+            return
+        match = _PERCENT_PATTERN.search(line)
+        if match:
+            self._report(self.processed, min(float(match.group(1)), 100.0) / 100.0)
+
+    def _report(self, processed, fraction):
+        self.processed = max(self.processed, processed)
+        if self.on_progress:
+            self.on_progress(self.processed, fraction)
+
+    def first_settings(self):
+        """返回第一条 Autopilot 设置字符串，没有时返回 None"""
+        return self.autopilot[0][1] if self.autopilot else None
+
+def run_tpai(argv, timeout=None, parser=None, count=0):
+    """
+    运行一次 tpai 并逐行解析输出
+
+    启动前向进程共享的调度器申请运行名额，按当前上下文的优先级和所属者排队。
+    解析出的进度报告给当前的进度跟踪器，排队、启动和运行耗时记录到当前的计时器。
+    用户在 ComfyUI 中取消任务时立即结束 tpai 进程 (或放弃排队) 并抛出中断异常。
+
+    参数:
+        argv (list): build_tpai_argv 构建的参数列表
+        timeout (float, optional): 超时时间 (秒)
+        parser (TpaiOutputParser, optional): 输出解析器
+        count (int): 本次处理的图像数，用于进度报告 (0 表示不报告)
+
+    返回:
+        JobResult: 执行结果，launch_seconds 和 run_seconds 从取得运行名额之后开始计算
+    """
+    throw_if_interrupted()
+    parser = parser or TpaiOutputParser()
+    tracker = current_progress()
+    progress = tracker.job(count) if tracker and count else None
+    if progress:
+        parser.on_progress = progress
+
+    job = TopazJob(argv, timeout, parser.feed)
+    success = False
+    try:
+        with get_scheduler().slot(cancel_check=interrupted) as wait:
+            record("scheduler_wait", wait)
+            result = get_job_runner().run(job, cancel_check=interrupted)
+        success = result.returncode in (0, 1)
+        return result
+    except JobCancelled:
+        # 转换为 ComfyUI 的中断异常，使执行器按取消处理
+        throw_if_interrupted()
+        raise
+    finally:
+        if progress:
+            progress.close(success)
+        if job.launch_seconds is not None:
+            record("tpai_launch", job.launch_seconds)
+        if job.run_seconds is not None:
+            record("tpai_run", job.run_seconds)
@@ -0,0 +1,58 @@
+import torch
+
+from .result_cache import content_digest
+
+# 感知比较时缩略图的边长
+THUMBNAIL_SIZE = 16
+
+def _thumbnails(images):
+    """将 [B, H, W, C] 图像缩小为 [B, THUMBNAIL_SIZE*THUMBNAIL_SIZE*C] 的向量"""
+    x = images.detach().float().permute(0, 3, 1, 2)
+    x = torch.nn.functional.adaptive_avg_pool2d(x, THUMBNAIL_SIZE)
+    return x.reshape(x.shape[0], -1)
+
+def find_duplicates(images, threshold=0.0, keys=None, digests=None):
+    """
+    查找批次中重复的帧
+
+    像素完全相同的帧通过哈希合并。threshold 大于 0 时还会进行感知比较：
+    把每帧缩小为缩略图，与已有的唯一帧缩略图的平均绝对差 (像素值范围 0-1)
+    不超过 threshold 时视为重复，使用先出现的那一帧的结果。
+
+    参数:
+        images (torch.Tensor): 形状为 [B, H, W, C] 的图像
+        threshold (float): 感知距离阈值，0 表示只合并完全相同的帧
+        keys (list, optional): 每帧的附加键 (如处理设置)，只有键相同的帧才会合并
+        digests (list, optional): 已计算的每帧 content_digest，未提供时在这里计算
+
+    返回:
+        tuple: (唯一帧索引列表, 每帧对应的唯一帧位置 torch.LongTensor, 每帧的内容摘要列表)，
+        摘要可以直接传给 make_cache_key，避免再次哈希像素
+    """
+    count = len(images)
+    keys = keys or [None] * count
+    digests = digests or [content_digest(images[i]) for i in range(count)]
+    thumbs = _thumbnails(images) if threshold > 0 else None
+
+    unique = []
+    inverse = []
+    seen = {}  # (键, 像素哈希) -> 唯一帧位置
+    for i in range(count):
+        position = seen.get((keys[i], digests[i]))
+
+        if position is None and thumbs is not None and unique:
+            # 与键相同的所有唯一帧一次性向量化比较
+            candidates = [p for p, j in enumerate(unique) if keys[j] == keys[i]]
+            if candidates:
+                distances = (thumbs[[unique[p] for p in candidates]] - thumbs[i]).abs().mean(dim=1)
+                best = int(torch.argmin(distances))
+                if float(distances[best]) <= threshold:
+                    position = candidates[best]
+
+        if position is None:
+            position = len(unique)
+            unique.append(i)
+            seen[(keys[i], digests[i])] = position
+        inverse.append(position)
+
+    return unique, torch.tensor(inverse, dtype=torch.long), digests
@@ -0,0 +1,78 @@
+import os
+import json
+import hashlib
+
+import torch
+
+# 每帧按网格抽样的像素数 (每个方向)，抽样只复制这些像素而不是整个张量
+SAMPLE_GRID = 64
+
+def tensor_fingerprint(images):
+    """
+    计算图像批次的快速指纹
+
+    不对整个张量做哈希: 只哈希形状、类型、每帧按 SAMPLE_GRID x SAMPLE_GRID 网格抽样的像素，
+    以及每帧所有像素的和 (在张量所在设备上归约，不复制数据)。抽样会漏掉的局部修改
+    通常也会改变像素和。
+
+    参数:
+        images (torch.Tensor): [B, H, W, C] 图像批次
+
+    返回:
+        str: 十六进制指纹
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{tuple(images.shape)}|{images.dtype}".encode())
+    if images.numel() == 0:
+        return h.hexdigest()
+
+    with torch.no_grad():
+        step_h = max(1, images.shape[1] // SAMPLE_GRID)
+        step_w = max(1, images.shape[2] // SAMPLE_GRID)
+        sample = images[:, ::step_h, ::step_w].contiguous().cpu().numpy()
+        sums = images.sum(dim=(1, 2, 3)).cpu().numpy()
+    h.update(memoryview(sample).cast("B"))
+    h.update(memoryview(sums).cast("B"))
+    return h.hexdigest()
+
+def binary_fingerprint(path):
+    """
+    返回可执行文件的指纹 (真实路径、修改时间、大小)，与 tpai 信息缓存使用的判断相同
+
+    Topaz 升级后指纹随之变化，且不需要启动 tpai 查询版本。文件不存在时返回路径本身。
+    """
+    if not path:
+        return ""
+    real_path = os.path.realpath(path)
+    try:
+        st = os.stat(real_path)
+    except OSError:
+        return real_path
+    return f"{real_path}|{st.st_mtime_ns}|{st.st_size}"
+
+def node_fingerprint(images=None, tpai_exe="", tpai_version="", **settings):
+    """
+    组合节点输入的指纹，用作节点的 IS_CHANGED 返回值
+
+    Topaz 的输出只取决于像素、设置和 tpai 版本，三者都不变时 ComfyUI 直接复用上次的输出。
+    tpai 版本同时用可执行文件的指纹和 tpai_version 判断，后者覆盖可执行文件不变而
+    版本变化的情况 (如远程 worker 升级，或同一路径换成了另一个安装)。
+    较新的 ComfyUI 在调用 IS_CHANGED 时不传入来自上游节点的张量，此时只比较设置和 tpai，
+    像素是否变化由 ComfyUI 根据上游节点判断。
+
+    参数:
+        images (torch.Tensor, optional): 输入图像
+        tpai_exe (str): tpai 可执行文件路径
+        tpai_version (str): 缓存的 tpai 版本 (远程模式下为 worker 的版本)
+        **settings: 其他节点输入
+
+    返回:
+        str: 十六进制指纹
+    """
+    h = hashlib.blake2b(digest_size=16)
+    if isinstance(images, torch.Tensor):
+        h.update(tensor_fingerprint(images).encode())
+    h.update(binary_fingerprint(tpai_exe).encode())
+    h.update(str(tpai_version).encode())
+    h.update(json.dumps(settings, sort_keys=True, default=str).encode())
+    return h.hexdigest()
@@ -0,0 +1,321 @@
+import os
+import time
+import fnmatch
+import platform
+import threading
+
+# 日志前缀
+log_prefix = "[ComfyTopazPhoto]"
+
+# 清理缓存时总是删除的临时文件
+TEMP_PATTERNS = ("*.tmp", "*.cache", "temp_*", "*.log")
+
+# 后台清理的间隔 (秒)，可通过环境变量 COMFY_TOPAZ_JANITOR_INTERVAL 调整，0 表示不启动后台线程
+JANITOR_INTERVAL = float(os.environ.get("COMFY_TOPAZ_JANITOR_INTERVAL", 3600))
+
+# 缓存的容量上限 (GB) 和最长保留时间 (天)，未设置时后台线程只统计不删除
+_max_gb = os.environ.get("COMFY_TOPAZ_CACHE_MAX_GB")
+_max_age_days = os.environ.get("COMFY_TOPAZ_CACHE_MAX_AGE_DAYS")
+DEFAULT_MAX_BYTES = int(float(_max_gb) * 1024 ** 3) if _max_gb else None
+DEFAULT_MAX_AGE = float(_max_age_days) * 86400 if _max_age_days else None
+
+# 最近这么多秒内使用过的文件不会被容量和时间策略删除，Topaz 可能正在读写它们
+MIN_EVICT_AGE = 600
+
+def topaz_cache_dir():
+    """返回当前平台上 Topaz Photo AI 的缓存目录，不支持的平台返回空字符串"""
+    if platform.system() == "Windows":
+        return os.path.expanduser("~/AppData/Local/Topaz Labs LLC/Topaz Photo AI/Cache")
+    elif platform.system() == "Darwin":  # macOS
+        return os.path.expanduser("~/Library/Caches/Topaz Labs LLC/Topaz Photo AI")
+    elif platform.system() == "Linux":
+        return os.path.expanduser("~/.cache/Topaz Labs LLC/Topaz Photo AI")
+    return ""
+
+class CacheEntry:
+    """缓存中的一个文件"""
+    __slots__ = ("path", "size", "last_used")
+
+    def __init__(self, path, size, last_used):
+        self.path = path
+        self.size = size
+        self.last_used = last_used
+
+def _last_used(st):
+    """最后使用时间取访问时间和修改时间中较晚的一个 (很多文件系统以 relatime/noatime 挂载，访问时间不一定更新)"""
+    return max(st.st_atime, st.st_mtime)
+
+def scan_directory(directory):
+    """
+    用 os.scandir 列出一个目录，不递归，不跟随符号链接
+
+    返回:
+        (files, subdirs): {文件路径: CacheEntry} 和子目录路径列表
+    """
+    files = {}
+    subdirs = []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        st = entry.stat(follow_symlinks=False)
+                        files[entry.path] = CacheEntry(entry.path, st.st_size, _last_used(st))
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return files, subdirs
+
+def scan_cache(cache_dir, previous=None):
+    """
+    遍历缓存目录，返回按目录组织的索引
+
+    提供上一次的索引时增量更新: 修改时间没有变化的目录 (没有增删或重命名文件)
+    沿用上次的文件列表，不再列出其中的文件，只对每个目录 stat 一次。
+    沿用的条目可能没有反映之后对文件的读取，删除前需要重新确认 (见 CacheJanitor)。
+
+    参数:
+        cache_dir (str): 缓存目录
+        previous (dict, optional): 上一次返回的索引
+
+    返回:
+        (index, rescanned): index 为 {目录: (修改时间, {文件路径: CacheEntry}, 子目录列表)}，
+        rescanned 为重新列出的目录数
+    """
+    previous = previous or {}
+    index = {}
+    rescanned = 0
+    pending = [cache_dir]
+    while pending:
+        directory = pending.pop()
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError:
+            continue
+        cached = previous.get(directory)
+        if cached and cached[0] == mtime_ns:
+            index[directory] = cached
+        else:
+            files, subdirs = scan_directory(directory)
+            index[directory] = (mtime_ns, files, subdirs)
+            rescanned += 1
+        pending.extend(index[directory][2])
+    return index, rescanned
+
+def plan_eviction(entries, max_bytes=None, max_age=None, patterns=(), now=None):
+    """
+    按策略选出要删除的文件
+
+    依次应用: 匹配 patterns 的临时文件、超过 max_age 秒未使用的文件、
+    总大小超过 max_bytes 时按最后使用时间从旧到新 (LRU) 删除的文件。
+    最近 MIN_EVICT_AGE 秒内使用过的文件不会被容量和时间策略选中；匹配 patterns 的
+    临时文件只在用户要求清理时传入，不受这一限制。
+
+    返回:
+        list: 要删除的 CacheEntry 列表
+    """
+    now = now or time.time()
+    candidates = [e for e in entries if now - e.last_used >= MIN_EVICT_AGE]
+    selected = {}
+    for e in entries:
+        name = os.path.basename(e.path)
+        if any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+            selected[e.path] = e
+    for e in candidates:
+        if max_age is not None and now - e.last_used > max_age:
+            selected[e.path] = e
+
+    if max_bytes is not None:
+        remaining = sum(e.size for e in entries) - sum(e.size for e in selected.values())
+        for e in sorted(candidates, key=lambda e: e.last_used):
+            if remaining <= max_bytes:
+                break
+            if e.path not in selected:
+                selected[e.path] = e
+                remaining -= e.size
+    return list(selected.values())
+
+class CacheJanitor:
+    """
+    Topaz Photo AI 缓存的统计和清理
+
+    后台线程按 interval 定期增量更新一次缓存索引 (见 scan_cache) 并按策略删除文件，
+    索引在两次遍历之间保留。clean() 直接在索引上挑选要删除的文件，不遍历目录，
+    也不等待正在进行的后台遍历。索引和统计由 _index_lock 保护，只在读写时短暂持有；
+    _run_lock 保证同一时间只运行一次遍历。尚未完成首次遍历时 stats() 和 clean() 报告
+    "not_scanned"，clean() 要求的临时文件清理在首次遍历完成后执行。
+    """
+
+    def __init__(self, cache_dir=None, interval=JANITOR_INTERVAL, max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE):
+        self.cache_dir = cache_dir if cache_dir is not None else topaz_cache_dir()
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._index = {}
+        self._scan = None  # 最近一次遍历的信息，尚未遍历时为 None
+        self._stats = None
+        self._clean_temp_after_scan = False
+        self._index_lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+        self._oneshot = None
+
+    def run_once(self, clean_temp=False):
+        """
+        增量更新一次索引并按策略清理
+
+        参数:
+            clean_temp (bool): 是否同时删除 TEMP_PATTERNS 匹配的临时文件
+
+        返回:
+            dict: 统计结果
+        """
+        with self._run_lock:
+            start = time.perf_counter()
+            with self._index_lock:
+                previous = self._index
+            if not self.cache_dir or not os.path.isdir(self.cache_dir):
+                index, rescanned = {}, 0
+            else:
+                index, rescanned = scan_cache(self.cache_dir, previous)
+            with self._index_lock:
+                clean_temp = clean_temp or self._clean_temp_after_scan
+                self._clean_temp_after_scan = False
+                self._index = index
+                self._scan = {
+                    "scanned_at": time.time(),
+                    "scan_seconds": round(time.perf_counter() - start, 3),
+                    "dirs": len(index),
+                    "rescanned_dirs": rescanned,
+                }
+            return self.clean(clean_temp)
+
+    def clean(self, clean_temp=True):
+        """
+        按当前索引清理，不遍历缓存目录
+
+        被选中的文件在删除前重新 stat: 已不存在的从索引中移除；按容量和时间策略选中、
+        但在索引更新之后被使用过的文件只更新索引，本次不删除。
+
+        参数:
+            clean_temp (bool): 是否同时删除 TEMP_PATTERNS 匹配的临时文件
+
+        返回:
+            dict: 统计结果
+        """
+        with self._index_lock:
+            scanned = self._scan is not None
+            if not scanned:
+                self._clean_temp_after_scan = self._clean_temp_after_scan or clean_temp
+        if not scanned:
+            self.request_scan()
+            return self.stats()
+
+        patterns = TEMP_PATTERNS if clean_temp else ()
+        with self._index_lock:
+            entries = [e for _, files, _ in self._index.values() for e in files.values()]
+        size_before = sum(e.size for e in entries)
+
+        removed = []
+        gone = []
+        for e in plan_eviction(entries, self.max_bytes, self.max_age, patterns):
+            try:
+                st = os.stat(e.path, follow_symlinks=False)
+            except OSError:
+                gone.append(e)
+                continue
+            temp = any(fnmatch.fnmatch(os.path.basename(e.path), pattern) for pattern in patterns)
+            if not temp and _last_used(st) != e.last_used:
+                e.size, e.last_used = st.st_size, _last_used(st)
+                continue
+            try:
+                os.remove(e.path)
+            except OSError:
+                continue
+            e.size = st.st_size
+            removed.append(e)
+
+        with self._index_lock:
+            for e in removed + gone:
+                cached = self._index.get(os.path.dirname(e.path))
+                if cached:
+                    cached[1].pop(e.path, None)
+            entries = [e for _, files, _ in self._index.values() for e in files.values()]
+            oldest = min((e.last_used for e in entries), default=None)
+            removed_bytes = sum(e.size for e in removed)
+            stats = {
+                "cache_dir": self.cache_dir,
+                "status": "scanned",
+                **self._scan,
+                "files": len(entries),
+                "size_before": size_before,
+                "size_after": sum(e.size for e in entries),
+                "removed_files": len(removed),
+                "removed_bytes": removed_bytes,
+                "oldest_age_days": round((time.time() - oldest) / 86400, 1) if oldest else 0.0,
+                "max_bytes": self.max_bytes,
+                "max_age_days": self.max_age / 86400 if self.max_age else None,
+            }
+            self._stats = stats
+        if removed:
+            print(f"{log_prefix} 缓存清理: 删除 {len(removed)} 个文件, 释放 {removed_bytes/1024/1024:.2f} MB")
+        return stats
+
+    def stats(self):
+        """返回最近一次遍历或清理的统计结果，尚未完成首次遍历时 status 为 not_scanned"""
+        with self._index_lock:
+            if self._stats is None:
+                return {"cache_dir": self.cache_dir, "status": "not_scanned"}
+            return self._stats
+
+    def request_scan(self):
+        """尽快进行一次遍历: 唤醒后台线程，未启动后台线程时在一次性的线程中遍历"""
+        if self._thread and self._thread.is_alive():
+            self._wake.set()
+            return
+        with self._index_lock:
+            if self._oneshot and self._oneshot.is_alive():
+                return
+            self._oneshot = threading.Thread(target=self._run_safely, name="topaz_cache_janitor_once", daemon=True)
+            self._oneshot.start()
+
+    def start(self):
+        """启动后台清理线程 (interval 为 0 或已启动时不做任何事)"""
+        if self.interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="topaz_cache_janitor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _run_safely(self):
+        try:
+            self.run_once()
+        except Exception as e:
+            print(f"{log_prefix} 缓存清理出错: {str(e)}")
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self._run_safely()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+_janitor = None
+_janitor_lock = threading.Lock()
+
+def get_janitor():
+    """返回进程共享的缓存清理器，首次调用时启动后台线程 (注册节点时即调用一次)"""
+    global _janitor
+    with _janitor_lock:
+        if _janitor is None:
+            _janitor = CacheJanitor()
+            _janitor.start()
+        return _janitor
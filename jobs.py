@@ -0,0 +1,225 @@
+import os
+import re
+import time
+import asyncio
+import threading
+import subprocess
+import concurrent.futures
+
+# Windows 上不为 tpai 弹出控制台窗口
+_POPEN_KWARGS = {"creationflags": subprocess.CREATE_NO_WINDOW} if os.name == "nt" else {}
+
+# 同步等待任务时检查取消请求的间隔 (秒)
+CANCEL_POLL_SECONDS = 0.2
+
+# 标准输出按块读取再按行切分。tpai 的进度行可能只以 \r 结尾，readline 会把它们
+# 当作一行，超过 StreamReader 的行长限制 (64 KiB) 时抛出异常
+READ_CHUNK_BYTES = 64 * 1024
+# 一直没有换行时，缓冲超过这个长度就作为一行输出，内存占用不随输出增长
+MAX_LINE_BYTES = 1024 * 1024
+_LINE_BREAK = re.compile(rb"\r\n|\r|\n")
+
+class JobCancelled(Exception):
+    """任务因取消请求而被终止"""
+    pass
+
+class JobResult(subprocess.CompletedProcess):
+    """tpai 的执行结果，另外记录启动和运行耗时 (不含排队时间)"""
+
+    def __init__(self, args, returncode, stdout, stderr, launch_seconds, run_seconds):
+        super().__init__(args, returncode, stdout, stderr)
+        self.launch_seconds = launch_seconds
+        self.run_seconds = run_seconds
+
+    @property
+    def elapsed(self):
+        """从启动到结束的总耗时 (秒)"""
+        return self.launch_seconds + self.run_seconds
+
+class TopazJob:
+    """
+    一次 tpai 调用
+
+    参数列表通过 create_subprocess_exec 直接启动，不经过 shell。
+    标准输出按 \n、\r\n 或单独的 \r 切分为行，每行到达时调用 on_line(line)。
+
+    参数:
+        command (list): 参数列表
+        timeout (float, optional): 超时时间 (秒)，超时后结束进程并抛出 subprocess.TimeoutExpired
+        on_line (callable, optional): 标准输出的逐行回调
+    """
+
+    def __init__(self, command, timeout=None, on_line=None):
+        if isinstance(command, str):
+            raise TypeError("command 必须是参数列表，不支持命令行字符串")
+        self.command = command
+        self.timeout = timeout
+        self.on_line = on_line
+        self.returncode = None
+        self.stdout_lines = []
+        self.stderr = ""
+        self.launch_seconds = None
+        self.run_seconds = None
+        self.finished = threading.Event()
+
+    def _emit(self, line):
+        line = line.decode("utf-8", errors="ignore")
+        self.stdout_lines.append(line)
+        if self.on_line:
+            self.on_line(line)
+
+    async def _read_stdout(self, stream):
+        pending = b""
+        while True:
+            chunk = await stream.read(READ_CHUNK_BYTES)
+            if not chunk:
+                break
+            data = pending + chunk
+            # 末尾的 \r 可能是跨块的 \r\n 的前半部分，留到下一块再切分
+            end = len(data) - 1 if data.endswith(b"\r") else len(data)
+            lines = _LINE_BREAK.split(data[:end])
+            pending = lines.pop() + data[end:]
+            for line in lines:
+                self._emit(line)
+            if len(pending) > MAX_LINE_BYTES:
+                self._emit(pending)
+                pending = b""
+        if pending.rstrip(b"\r"):
+            self._emit(pending.rstrip(b"\r"))
+
+    async def run(self):
+        """
+        运行任务直到进程结束
+
+        任务被取消、超时或读取输出时出错都会先结束 tpai 进程，不会留下孤儿进程。
+
+        返回:
+            JobResult: 执行结果
+        """
+        try:
+            return await self._run()
+        finally:
+            self.finished.set()
+
+    async def _run(self):
+        start = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(
+            *self.command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, **_POPEN_KWARGS)
+        launched = time.perf_counter()
+        self.launch_seconds = launched - start
+
+        async def communicate():
+            stderr, _ = await asyncio.gather(process.stderr.read(), self._read_stdout(process.stdout))
+            self.stderr = stderr.decode("utf-8", errors="ignore")
+            return await process.wait()
+
+        try:
+            self.returncode = await asyncio.wait_for(communicate(), self.timeout)
+        except asyncio.TimeoutError:
+            await self._kill(process)
+            raise subprocess.TimeoutExpired(self.command, self.timeout)
+        except BaseException:
+            # 包括取消和输出回调抛出的异常；否则调用方重试时旧的 tpai 仍在运行
+            await self._kill(process)
+            raise
+        finally:
+            self.run_seconds = time.perf_counter() - launched
+
+        return JobResult(self.command, self.returncode, "\n".join(self.stdout_lines), self.stderr,
+                         self.launch_seconds, self.run_seconds)
+
+    @staticmethod
+    async def _kill(process):
+        if process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+            await process.wait()
+
+async def run_jobs(jobs, limit=None, return_exceptions=False):
+    """
+    并发运行多个任务
+
+    参数:
+        jobs (list): TopazJob 列表
+        limit (int, optional): 同时运行的最大任务数，默认不限制
+        return_exceptions (bool): 为 True 时失败的任务返回异常对象而不是中断其他任务
+
+    返回:
+        list: 与 jobs 顺序一致的执行结果
+    """
+    semaphore = asyncio.Semaphore(limit) if limit else None
+
+    async def run_one(job):
+        if semaphore is None:
+            return await job.run()
+        async with semaphore:
+            return await job.run()
+
+    return await asyncio.gather(*(run_one(job) for job in jobs), return_exceptions=return_exceptions)
+
+class JobRunner:
+    """
+    在后台线程的事件循环中运行 tpai 任务
+
+    同步代码 (节点类、批处理脚本) 通过 submit/run 提交任务，ComfyUI 的执行线程
+    不需要自己的事件循环；多个线程提交的任务在同一个循环中并发运行。
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="topaz_jobs", daemon=True).start()
+            return self._loop
+
+    def submit(self, coro):
+        """提交协程，返回 concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, job, cancel_check=None):
+        """
+        同步运行任务并返回结果
+
+        等待期间定期调用 cancel_check，返回 True 时取消任务、等待 tpai 进程结束并抛出
+        JobCancelled。调用线程被中断 (如 KeyboardInterrupt) 时同样取消任务。
+        """
+        future = self.submit(job.run())
+        try:
+            while True:
+                try:
+                    return future.result(timeout=CANCEL_POLL_SECONDS if cancel_check else None)
+                except concurrent.futures.TimeoutError:
+                    if cancel_check():
+                        future.cancel()
+                        job.finished.wait(5)
+                        raise JobCancelled("任务已取消")
+        except BaseException:
+            future.cancel()
+            raise
+
+    def run_many(self, jobs, limit=None, return_exceptions=False):
+        """同步并发运行多个任务"""
+        future = self.submit(run_jobs(jobs, limit, return_exceptions))
+        try:
+            return future.result()
+        except BaseException:
+            future.cancel()
+            raise
+
+_job_runner = None
+_job_runner_lock = threading.Lock()
+
+def get_job_runner():
+    """返回进程共享的任务运行器"""
+    global _job_runner
+    with _job_runner_lock:
+        if _job_runner is None:
+            _job_runner = JobRunner()
+        return _job_runner
@@ -0,0 +1,84 @@
+import os
+import json
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# 当前调用的计时器
+_current_timer = contextvars.ContextVar("topaz_stage_timer", default=None)
+
+class StageTimer:
+    """
+    记录一次节点调用中各阶段的耗时
+
+    每条记录包含阶段名、耗时 (秒) 以及可选的帧索引等附加信息。
+    多个线程可以同时记录。
+    """
+
+    def __init__(self, **info):
+        self.info = info
+        self.events = []
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    def add(self, stage, seconds, **info):
+        with self._lock:
+            self.events.append({"stage": stage, "seconds": round(seconds, 6), **info})
+
+    def summary(self):
+        """
+        返回可序列化为 JSON 的统计结果
+
+        stages 中按阶段汇总总耗时和次数，events 保留每帧/每次调用的明细。
+        """
+        stages = {}
+        with self._lock:
+            events = list(self.events)
+        for event in events:
+            stats = stages.setdefault(event["stage"], {"total_seconds": 0.0, "count": 0})
+            stats["total_seconds"] += event["seconds"]
+            stats["count"] += 1
+        for stats in stages.values():
+            stats["total_seconds"] = round(stats["total_seconds"], 6)
+        return {
+            "timestamp": time.time(),
+            **self.info,
+            "total_seconds": round(time.perf_counter() - self._start, 6),
+            "stages": stages,
+            "events": events,
+        }
+
+@contextmanager
+def activate(timer):
+    """在代码块中把 timer 设为当前计时器"""
+    token = _current_timer.set(timer)
+    try:
+        yield timer
+    finally:
+        _current_timer.reset(token)
+
+def record(stage, seconds, **info):
+    """向当前计时器添加一条记录，没有活动计时器时忽略"""
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.add(stage, seconds, **info)
+
+@contextmanager
+def timed(stage, **info):
+    """计时一个代码块并记录到当前计时器"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start, **info)
+
+def append_jsonl(path, summary):
+    """将一条统计结果追加到 JSONL 文件"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    line = json.dumps(summary, ensure_ascii=False) + "\n"
+    # 单次 write 追加一整行，多个进程同时写入时不会交错
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line)
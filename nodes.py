@@ -1,10 +1,12 @@
 import os
 import sys
+import json
 import folder_paths
 import comfy.model_management as model_management
 
 from .topaz import (
     init_topaz,
+    get_topaz_info,
     test_and_clean_topaz,
     ComfyTopazPhoto,
     NODE_CLASS_MAPPINGS as TOPAZ_NODE_CLASS_MAPPINGS,
@@ -23,8 +25,8 @@ class ComfyTopazPhotoTestAndClean:
             },
         }
 
-    RETURN_TYPES = ("STRING", "STRING", "INT", "FLOAT", "FLOAT",)
-    RETURN_NAMES = ("status", "message", "cleaned_files", "cache_before_MB", "cache_after_MB",)
+    RETURN_TYPES = ("STRING", "STRING", "INT", "FLOAT", "FLOAT", "STRING",)
+    RETURN_NAMES = ("status", "message", "cleaned_files", "cache_before_MB", "cache_after_MB", "cache_stats",)
     FUNCTION = "test_and_clean"
     CATEGORY = "ComfyTopazPhoto"
 
@@ -35,7 +37,7 @@ class ComfyTopazPhotoTestAndClean:
         
         # 验证 tpai_exe 路径是否存在
         if not os.path.exists(tpai_exe):
-            return ("ERROR", f"Topaz Photo AI 可执行文件未找到: {tpai_exe}", 0, 0.0, 0.0)
+            return ("ERROR", f"Topaz Photo AI 可执行文件未找到: {tpai_exe}", 0, 0.0, 0.0, "{}")
         
         # 调用测试和清理函数
         results = test_and_clean_topaz(tpai_exe, clean_cache, verbose)
@@ -43,19 +45,27 @@ class ComfyTopazPhotoTestAndClean:
         # 构建状态和消息
         status = "SUCCESS" if results["success"] else "ERROR"
         
+        # 后台线程尚未完成首次遍历时缓存大小未知
+        scanned = results["cache_size_before"] is not None
+
         message = ""
         if results["success"]:
-            message = "Topaz Photo AI 测试成功!"
-            if clean_cache:
+            message = f"Topaz Photo AI 测试成功! (版本: {get_topaz_info(tpai_exe)['version']})"
+            if not scanned:
+                message += " 缓存尚未完成首次遍历，稍后再查看统计。"
+            elif clean_cache:
                 message += f" 已清理 {results['cleaned_files']} 个缓存文件。"
         else:
             message = f"测试失败: {results['error_message']}"
         
-        # 计算缓存大小（MB）
-        cache_before_MB = results["cache_size_before"] / 1024 / 1024
-        cache_after_MB = results["cache_size_after"] / 1024 / 1024
-        
-        return (status, message, results["cleaned_files"], cache_before_MB, cache_after_MB)
+        # 计算缓存大小（MB），未知时为 -1
+        cache_before_MB = results["cache_size_before"] / 1024 / 1024 if scanned else -1.0
+        cache_after_MB = results["cache_size_after"] / 1024 / 1024 if scanned else -1.0
+
+        # 缓存遍历的统计 (文件数、遍历耗时、容量策略等)，尚未完成首次遍历时 status 为 "not_scanned"
+        cache_stats = json.dumps(results["cache_stats"] or {}, ensure_ascii=False)
+
+        return (status, message, results["cleaned_files"], cache_before_MB, cache_after_MB, cache_stats)
 
 # 合并节点映射
 NODE_CLASS_MAPPINGS = {
@@ -0,0 +1,95 @@
+import queue
+import contextvars
+import threading
+
+# 队列结束标记
+_SENTINEL = object()
+
+def run_pipeline(items, encode, process, decode, depth=2):
+    """
+    以流水线方式执行 编码 -> 处理 -> 解码 三个阶段
+
+    编码和解码分别在后台线程中运行，处理阶段在调用线程中运行，因此在处理第 i
+    个条目的同时，第 i+1 个条目正在编码，第 i-1 个条目正在解码。阶段之间使用
+    容量为 depth 的有界队列，同时存在的中间结果数量不会随批次增长。
+    任意阶段出错时会停止整条流水线，并在调用线程中重新抛出第一个异常。
+
+    参数:
+        items (iterable): 待处理的条目
+        encode (callable): encode(item) -> staged
+        process (callable): process(staged) -> processed
+        decode (callable): decode(item, processed)
+        depth (int): 每个队列的容量
+    """
+    encoded = queue.Queue(maxsize=depth)
+    processed = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    errors = []
+
+    def put(q, value):
+        # 可被 stop 打断的阻塞 put
+        while not stop.is_set():
+            try:
+                q.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(q):
+        # 可被 stop 打断的阻塞 get，停止时返回 _SENTINEL
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _SENTINEL
+
+    def fail(e):
+        errors.append(e)
+        stop.set()
+
+    def encoder():
+        try:
+            for item in items:
+                if not put(encoded, (item, encode(item))):
+                    return
+            put(encoded, _SENTINEL)
+        except BaseException as e:
+            fail(e)
+
+    def decoder():
+        try:
+            while True:
+                entry = get(processed)
+                if entry is _SENTINEL:
+                    return
+                decode(*entry)
+        except BaseException as e:
+            fail(e)
+
+    # 后台线程在调用方上下文的副本中运行，原因同 topaz.process_topaz_parallel
+    threads = [
+        threading.Thread(target=contextvars.copy_context().run, args=(encoder,), name="topaz_encode", daemon=True),
+        threading.Thread(target=contextvars.copy_context().run, args=(decoder,), name="topaz_decode", daemon=True),
+    ]
+    for t in threads:
+        t.start()
+
+    try:
+        while True:
+            entry = get(encoded)
+            if entry is _SENTINEL:
+                break
+            item, staged = entry
+            if not put(processed, (item, process(staged))):
+                break
+        put(processed, _SENTINEL)
+    except BaseException as e:
+        fail(e)
+    finally:
+        for t in threads:
+            t.join()
+
+    if errors:
+        raise errors[0]
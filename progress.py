@@ -0,0 +1,128 @@
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from .jobs import JobCancelled
+
+# ComfyUI 的进度条和中断标志，在 ComfyUI 之外运行时不可用
+try:
+    import comfy.utils
+    import comfy.model_management
+    _comfy_available = True
+except ImportError:
+    _comfy_available = False
+
+# 每个图像在进度条上占的步数，用于显示单个图像内部的进度
+STEPS_PER_IMAGE = 100
+
+# 当前调用的进度跟踪器
+_current_progress = contextvars.ContextVar("topaz_progress", default=None)
+# 当前调用的取消标志 (threading.Event)，用于 ComfyUI 之外的调用方 (如 worker 服务) 取消单个请求
+_current_cancel = contextvars.ContextVar("topaz_cancel", default=None)
+
+def interrupted():
+    """用户是否在 ComfyUI 中取消了当前任务，或当前调用的取消标志已设置"""
+    event = _current_cancel.get()
+    if event is not None and event.is_set():
+        return True
+    return _comfy_available and comfy.model_management.processing_interrupted()
+
+def throw_if_interrupted():
+    """任务已被取消时抛出 ComfyUI 的中断异常 (取消标志已设置时抛出 JobCancelled)"""
+    event = _current_cancel.get()
+    if event is not None and event.is_set():
+        raise JobCancelled("任务已取消")
+    if _comfy_available:
+        comfy.model_management.throw_exception_if_processing_interrupted()
+
+@contextmanager
+def cancel_scope(event):
+    """在代码块中使用 event 作为取消标志，event 被设置后 tpai 调用立即结束并抛出 JobCancelled"""
+    token = _current_cancel.set(event)
+    try:
+        yield event
+    finally:
+        _current_cancel.reset(token)
+
+def is_interrupt(e):
+    """异常是否表示任务被用户取消 (需要继续向上抛出而不是当作处理失败)"""
+    if isinstance(e, JobCancelled):
+        return True
+    return _comfy_available and isinstance(e, comfy.model_management.InterruptProcessingException)
+
+class NodeProgress:
+    """
+    汇总一次节点调用中所有 tpai 任务的进度并报告给 ComfyUI 的进度条
+
+    已完成的图像 (包括缓存命中) 通过 advance 计入；正在运行的任务通过 job 返回的
+    句柄报告它已处理的图像数和当前图像内部的进度。多个线程可以同时报告。
+    """
+
+    def __init__(self, total):
+        self.total = max(1, total)
+        self.completed = 0
+        self._jobs = set()
+        self._lock = threading.Lock()
+        self._bar = comfy.utils.ProgressBar(self.total * STEPS_PER_IMAGE) if _comfy_available else None
+
+    def set_total(self, total):
+        """实际处理的图像数与输入不同时 (去重、分块) 调整总数"""
+        with self._lock:
+            self.total = max(1, total)
+        self._update()
+
+    def advance(self, count=1):
+        with self._lock:
+            self.completed += count
+        self._update()
+
+    def job(self, count):
+        """登记一个处理 count 个图像的 tpai 任务"""
+        handle = _JobProgress(self, count)
+        with self._lock:
+            self._jobs.add(handle)
+        return handle
+
+    def _close(self, handle, success):
+        with self._lock:
+            self._jobs.discard(handle)
+            if success:
+                self.completed += handle.count
+        self._update()
+
+    def _update(self):
+        if self._bar is None:
+            return
+        with self._lock:
+            value = self.completed + sum(job.value for job in self._jobs)
+            total = self.total
+            self._bar.update_absolute(min(value, total) * STEPS_PER_IMAGE, total * STEPS_PER_IMAGE)
+
+class _JobProgress:
+    """一个 tpai 任务的进度句柄，用作 TpaiOutputParser 的 on_progress 回调"""
+
+    def __init__(self, tracker, count):
+        self.tracker = tracker
+        self.count = count
+        self.value = 0.0
+
+    def __call__(self, processed, fraction):
+        self.value = min(self.count, processed + (fraction or 0.0))
+        self.tracker._update()
+
+    def close(self, success):
+        self.tracker._close(self, success)
+
+@contextmanager
+def track(total):
+    """在代码块中把新的进度跟踪器设为当前跟踪器"""
+    tracker = NodeProgress(total)
+    token = _current_progress.set(tracker)
+    try:
+        yield tracker
+    finally:
+        _current_progress.reset(token)
+
+def current_progress():
+    """返回当前的进度跟踪器，没有时返回 None"""
+    return _current_progress.get()
@@ -0,0 +1,382 @@
+import os
+import json
+import time
+import uuid
+import socket
+import struct
+import threading
+import contextvars
+import http.client
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from .jobs import CANCEL_POLL_SECONDS
+from .metrics import timed
+from .progress import current_progress, interrupted, throw_if_interrupted
+from .scheduler import current_job_context
+
+# 日志前缀
+log_prefix = "[ComfyTopazPhoto]"
+
+# worker 与客户端之间的消息格式版本
+PROTOCOL_VERSION = 2
+
+# 客户端和 worker 共用的访问令牌，可通过环境变量 COMFY_TOPAZ_WORKER_TOKEN 设置
+WORKER_TOKEN_ENV = "COMFY_TOPAZ_WORKER_TOKEN"
+
+# 健康检查的超时时间和有效期 (秒)，不可用的 worker 也在有效期过后重新检查
+HEALTH_TIMEOUT = 5
+HEALTH_INTERVAL = 30
+
+# worker 处理期间每隔 HEARTBEAT_INTERVAL 秒发送一次心跳 (长度为 0 的消息头)。
+# 客户端超过 IDLE_TIMEOUT 秒收不到任何数据 (包括上传期间) 才认为 worker 无响应，
+# 因此在 worker 的调度器中排队多久都不会触发超时
+HEARTBEAT_INTERVAL = 10
+IDLE_TIMEOUT = HEARTBEAT_INTERVAL * 6
+HEARTBEAT = struct.pack(">I", 0)
+
+# 消息头的最大长度，防止错误的请求占用大量内存
+MAX_HEADER_BYTES = 16 * 1024 * 1024
+
+# 流式读写文件的块大小
+CHUNK_SIZE = 1024 * 1024
+
+class WorkerError(Exception):
+    """远程 worker 处理失败"""
+    pass
+
+class WorkerUnavailable(WorkerError):
+    """worker 无法连接或暂时不能接受任务，可以换一个 worker 重试"""
+    pass
+
+# 消息格式: 4 字节大端消息头长度 + JSON 消息头 + 按消息头 files 列表顺序首尾相接的文件内容。
+# 消息头中的 files 为 [{"name": 文件名, "size": 字节数}, ...]，接收方据此逐个把文件流式写入磁盘，
+# 发送方直接从磁盘流式读取文件，两端都不需要把整个批次放进内存。
+# worker 收到完整的请求后立即返回 200，处理期间在响应中发送心跳，最后发送结果消息；
+# 处理失败时结果消息头中的 error 为错误信息，没有文件。
+
+def encode_header(header):
+    """编码消息头 (含长度前缀)"""
+    data = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    return struct.pack(">I", len(data)) + data
+
+def file_entries(paths):
+    """返回消息头中 files 列表的内容"""
+    return [{"name": os.path.basename(path), "size": os.path.getsize(path)} for path in paths]
+
+def message_length(header_bytes, entries):
+    """返回整个消息的字节数，用作 Content-Length"""
+    return len(header_bytes) + sum(entry["size"] for entry in entries)
+
+def send_files(send, paths):
+    """按顺序流式发送文件内容"""
+    for path in paths:
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                send(chunk)
+
+def read_exact(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise WorkerError(f"消息不完整: 需要 {size} 字节, 只收到 {len(data)} 字节")
+    return data
+
+def read_header(stream):
+    """读取并解析消息头，跳过之前的心跳"""
+    length = 0
+    while length == 0:
+        (length,) = struct.unpack(">I", read_exact(stream, 4))
+    if length > MAX_HEADER_BYTES:
+        raise WorkerError(f"消息头过大: {length} 字节")
+    header = json.loads(read_exact(stream, length).decode("utf-8"))
+    if header.get("version") != PROTOCOL_VERSION:
+        raise WorkerError(f"不支持的消息版本: {header.get('version')}")
+    return header
+
+def receive_files(stream, entries, paths):
+    """按 entries 中的大小依次把文件内容流式写入 paths"""
+    for entry, path in zip(entries, paths):
+        remaining = int(entry["size"])
+        with open(path, "wb") as f:
+            while remaining > 0:
+                chunk = stream.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise WorkerError(f"消息不完整: {entry['name']} 缺少 {remaining} 字节")
+                f.write(chunk)
+                remaining -= len(chunk)
+
+def parse_worker_urls(text):
+    """解析以逗号、空格或换行分隔的 worker 地址列表"""
+    urls = [url.strip().rstrip("/") for url in text.replace(",", " ").split()]
+    return [url if "://" in url else f"http://{url}" for url in urls if url]
+
+class _WorkerState:
+    """客户端记录的单个 worker 的状态"""
+
+    def __init__(self, url):
+        self.url = url
+        self.healthy = False
+        self.checked_at = 0.0
+        self.version = None
+        self.load = 0.0  # worker 报告的 (运行 + 排队) / 并发上限
+        self.in_flight = 0  # 本进程发往该 worker 尚未完成的请求数
+        self.error = None
+
+class WorkerPool:
+    """
+    一组远程 Topaz worker 的客户端
+
+    定期检查各 worker 的 /health，把批次平均分给可用的 worker，每块发给本进程在途请求最少、
+    负载最低的 worker。worker 开始处理之前的失败 (连接失败、上传中断、暂时不可用) 把该 worker
+    标记为不可用并换一个重试；之后的失败 (tpai 失败、无响应) 直接报错。
+
+    参数:
+        urls (list): worker 地址，如 ["http://10.0.0.5:8601"]
+        token (str, optional): 访问令牌，默认读取环境变量 COMFY_TOPAZ_WORKER_TOKEN
+    """
+
+    def __init__(self, urls, token=None):
+        if not urls:
+            raise WorkerError("没有指定 worker 地址")
+        self.workers = [_WorkerState(url) for url in urls]
+        self.token = token if token is not None else os.environ.get(WORKER_TOKEN_ENV)
+        self._lock = threading.Lock()
+
+    def _connection(self, url, timeout):
+        parsed = urllib.parse.urlsplit(url)
+        cls = http.client.HTTPSConnection if parsed.scheme == "https" else http.client.HTTPConnection
+        return cls(parsed.hostname, parsed.port, timeout=timeout), parsed.path.rstrip("/")
+
+    def _headers(self):
+        return {"Authorization": f"Bearer {self.token}"} if self.token else {}
+
+    def _check(self, worker):
+        conn, base = self._connection(worker.url, HEALTH_TIMEOUT)
+        try:
+            conn.request("GET", base + "/health", headers=self._headers())
+            response = conn.getresponse()
+            body = response.read()
+            if response.status != 200:
+                raise WorkerUnavailable(f"HTTP {response.status}")
+            info = json.loads(body)
+            worker.version = info.get("version")
+            worker.load = (info.get("running", 0) + info.get("queued", 0)) / max(1, info.get("limit", 1))
+            worker.healthy = True
+            worker.error = None
+        except (OSError, ValueError, WorkerError) as e:
+            worker.healthy = False
+            worker.error = str(e)
+        finally:
+            conn.close()
+            worker.checked_at = time.monotonic()
+
+    def refresh(self, force=False):
+        """重新检查超过有效期的 worker (force 时检查全部)，多个 worker 并发检查"""
+        now = time.monotonic()
+        stale = [w for w in self.workers if force or now - w.checked_at > HEALTH_INTERVAL]
+        if stale:
+            with ThreadPoolExecutor(max_workers=len(stale), thread_name_prefix="topaz_health") as executor:
+                list(executor.map(self._check, stale))
+
+    def healthy_workers(self):
+        self.refresh()
+        return [w for w in self.workers if w.healthy]
+
+    def version(self):
+        """
+        返回可用 worker 的 tpai 版本，用于结果缓存的键
+
+        返回:
+            str: 各 worker 版本去重后的组合
+        """
+        workers = self.healthy_workers()
+        if not workers:
+            raise WorkerError("没有可用的 Topaz worker: " + "; ".join(f"{w.url} ({w.error})" for w in self.workers))
+        return "remote:" + "|".join(sorted({str(w.version) for w in workers}))
+
+    def _pick(self, exclude):
+        with self._lock:
+            candidates = [w for w in self.workers if w.healthy and w not in exclude]
+            if not candidates:
+                return None
+            worker = min(candidates, key=lambda w: (w.in_flight, w.load))
+            worker.in_flight += 1
+            return worker
+
+    def process(self, input_paths, output_folder, output_format="png", quality=95, settings=None):
+        """
+        在远程 worker 上处理图像
+
+        当前上下文的优先级和所属者随请求发送，worker 的调度器据此排队。
+
+        参数:
+            input_paths (list): 输入图像路径
+            output_folder (str): 输出文件夹
+            output_format (str): 输出格式
+            quality (int): JPEG 质量
+            settings (list, optional): 每个输入对应的 JSON 设置
+
+        返回:
+            list: 与 input_paths 顺序一致的输出图像路径列表
+        """
+        workers = self.healthy_workers()
+        if not workers:
+            raise WorkerError("没有可用的 Topaz worker: " + "; ".join(f"{w.url} ({w.error})" for w in self.workers))
+
+        count = min(len(workers), len(input_paths))
+        chunk_size = -(-len(input_paths) // count)  # 向上取整
+        starts = range(0, len(input_paths), chunk_size)
+        print(f"{log_prefix} 远程处理 {len(input_paths)} 个图像: {len(starts)} 块, {len(workers)} 个可用 worker")
+
+        def run_chunk(start):
+            chunk_settings = settings[start:start + chunk_size] if settings else None
+            return self._dispatch(input_paths[start:start + chunk_size], output_folder, output_format, quality, chunk_settings)
+
+        with ThreadPoolExecutor(max_workers=len(starts), thread_name_prefix="topaz_remote") as executor:
+            # 每块在当前上下文的副本中运行，原因同 topaz.process_topaz_parallel
+            futures = [executor.submit(contextvars.copy_context().run, run_chunk, start) for start in starts]
+            output_paths = []
+            for future in futures:
+                output_paths.extend(future.result())
+        return output_paths
+
+    def _dispatch(self, input_paths, output_folder, output_format, quality, settings):
+        """
+        把一块发给一个 worker，不可用时换下一个
+
+        只有 worker 开始处理之前的失败 (连接失败、上传中断、502/503/504) 才换 worker 重试；
+        上传完成之后的失败直接报错，避免同一块在两个 worker 上重复处理。
+        """
+        tried = set()
+        last_error = None
+        while True:
+            worker = self._pick(tried)
+            if worker is None:
+                raise WorkerError(f"所有 worker 都无法处理该批次，最后的错误: {last_error}")
+            tried.add(worker)
+            try:
+                with timed("remote", worker=worker.url, count=len(input_paths)):
+                    output_paths = self._post(worker, input_paths, output_folder, output_format, quality, settings)
+                tracker = current_progress()
+                if tracker:
+                    tracker.advance(len(input_paths))
+                return output_paths
+            except WorkerUnavailable as e:
+                worker.healthy = False
+                worker.error = str(e)
+                last_error = f"{worker.url}: {e}"
+                print(f"{log_prefix} worker 不可用: {last_error}，尝试其他 worker")
+            finally:
+                with self._lock:
+                    worker.in_flight -= 1
+
+    def _post(self, worker, input_paths, output_folder, output_format, quality, settings):
+        entries = file_entries(input_paths)
+        priority, owner = current_job_context()
+        header = encode_header({
+            "version": PROTOCOL_VERSION,
+            "output_format": output_format,
+            "quality": quality,
+            "settings": settings,
+            "priority": priority,
+            "owner": owner,
+            "files": entries,
+        })
+        conn, base = self._connection(worker.url, IDLE_TIMEOUT)
+        done = threading.Event()
+        try:
+            # worker 收到完整的请求之前不会开始处理，这一阶段的失败可以换一个 worker 重试
+            try:
+                conn.putrequest("POST", base + "/process")
+                conn.putheader("Content-Type", "application/octet-stream")
+                conn.putheader("Content-Length", str(message_length(header, entries)))
+                for name, value in self._headers().items():
+                    conn.putheader(name, value)
+                conn.endheaders()
+                conn.send(header)
+                send_files(conn.send, input_paths)
+            except OSError as e:
+                # worker 可能在上传途中拒绝了请求 (如 400、413) 并关闭连接，先尝试读取它的响应
+                sock = conn.sock
+                response = self._early_response(conn) if sock is not None else None
+                if response is None:
+                    raise WorkerUnavailable(f"上传失败: {e}")
+            else:
+                # 响应声明 Connection: close 时 getresponse 会把 conn.sock 置为 None，先保留套接字
+                sock = conn.sock
+                try:
+                    response = conn.getresponse()
+                except OSError as e:
+                    raise WorkerError(f"{worker.url} 在收到请求后没有响应: {e}")
+
+            if response.status != 200:
+                body = response.read()
+                try:
+                    message = json.loads(body).get("error", "")
+                except ValueError:
+                    message = body[:200].decode("utf-8", errors="ignore")
+                error = f"{worker.url} 返回 HTTP {response.status}: {message}"
+                if response.status in (502, 503, 504):
+                    raise WorkerUnavailable(error)
+                raise WorkerError(error)
+
+            # 用户在 ComfyUI 中取消时关闭连接，worker 发送心跳失败后取消正在运行的 tpai
+            def watch():
+                while not done.wait(CANCEL_POLL_SECONDS):
+                    if interrupted():
+                        try:
+                            sock.shutdown(socket.SHUT_RDWR)
+                        except (OSError, AttributeError):
+                            pass
+                        return
+            threading.Thread(target=contextvars.copy_context().run, args=(watch,), name="topaz_remote_watch", daemon=True).start()
+
+            try:
+                reply = read_header(response)
+                if reply.get("error"):
+                    raise WorkerError(f"{worker.url}: {reply['error']}")
+                outputs = reply["files"]
+                if len(outputs) != len(input_paths):
+                    raise WorkerError(f"{worker.url} 返回了 {len(outputs)} 个输出, 应为 {len(input_paths)} 个")
+                token = uuid.uuid4().hex[:12]
+                output_paths = [os.path.join(output_folder, f"remote_{token}_{i:05d}{os.path.splitext(entry['name'])[1]}")
+                                for i, entry in enumerate(outputs)]
+                receive_files(response, outputs, output_paths)
+                return output_paths
+            except (OSError, WorkerError) as e:
+                # 连接被上面的线程关闭时按取消处理
+                throw_if_interrupted()
+                if isinstance(e, WorkerError):
+                    raise
+                raise WorkerError(f"{worker.url} 在处理期间断开或超过 {IDLE_TIMEOUT} 秒没有响应: {e}")
+        finally:
+            done.set()
+            conn.close()
+
+    @staticmethod
+    def _early_response(conn):
+        """上传失败后读取 worker 已经发送的响应，没有时返回 None"""
+        try:
+            return conn.getresponse()
+        except (OSError, http.client.HTTPException):
+            return None
+
+    def stats(self):
+        """返回各 worker 的状态"""
+        return [{"url": w.url, "healthy": w.healthy, "version": w.version, "load": round(w.load, 2),
+                 "in_flight": w.in_flight, "error": w.error} for w in self.workers]
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_worker_pool(urls):
+    """返回地址列表对应的进程共享客户端，健康状态在多次调用之间保留"""
+    key = tuple(urls)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = WorkerPool(list(urls))
+        return pool
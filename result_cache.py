@@ -0,0 +1,249 @@
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+# 日志前缀
+log_prefix = "[ComfyTopazPhoto]"
+
+# 默认缓存容量 (MB)，可通过环境变量 COMFY_TOPAZ_CACHE_MB 调整
+DEFAULT_MAX_BYTES = int(os.environ.get("COMFY_TOPAZ_CACHE_MB", 2048)) * 1024 * 1024
+# 内存中已解码帧的容量 (MB)，可通过环境变量 COMFY_TOPAZ_MEMORY_CACHE_MB 开启，默认 0 表示关闭
+# 缓存的每帧都是复制出来的 float32 张量，ComfyUI 自身也会缓存节点输出，因此只在需要时开启
+DEFAULT_MEMORY_BYTES = int(os.environ.get("COMFY_TOPAZ_MEMORY_CACHE_MB", 0)) * 1024 * 1024
+
+def default_cache_dir():
+    """
+    返回结果缓存目录
+    优先使用环境变量 COMFY_TOPAZ_CACHE_DIR，其次是 ComfyUI 的用户目录，
+    在 ComfyUI 之外运行时使用用户缓存目录 (~/.cache 或 XDG_CACHE_HOME)。
+    不使用 ComfyUI 的临时目录: ComfyUI 启动和退出时会清空它，缓存无法跨重启保留
+    """
+    cache_dir = os.environ.get("COMFY_TOPAZ_CACHE_DIR")
+    if cache_dir:
+        return cache_dir
+    try:
+        import folder_paths
+        return os.path.join(folder_paths.get_user_directory(), "topaz_result_cache")
+    except (ImportError, AttributeError):
+        cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+        return os.path.join(cache_home, "comfy_topaz_result_cache")
+
+def content_digest(image):
+    """
+    计算单帧图像像素内容的摘要 (包含形状和数据类型)
+
+    去重和缓存键共用这一摘要，每帧的像素只需哈希一次。
+
+    参数:
+        image (torch.Tensor | np.ndarray): 单帧图像像素
+
+    返回:
+        str: 十六进制摘要
+    """
+    if isinstance(image, torch.Tensor):
+        image = image.detach().cpu().contiguous().numpy()
+    image = np.ascontiguousarray(image)
+
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f"{image.shape}|{image.dtype}".encode())
+    h.update(memoryview(image).cast("B"))
+    return h.hexdigest()
+
+def make_cache_key(image, settings, tpai_version, digest=None):
+    """
+    计算单帧图像的缓存键
+
+    参数:
+        image (torch.Tensor | np.ndarray): 单帧图像像素
+        settings (dict): 影响输出的所有设置 (格式、质量、滤镜等)
+        tpai_version (str): tpai 版本字符串
+        digest (str, optional): 已计算的 content_digest(image)，提供时不再哈希像素
+
+    返回:
+        str: 十六进制的缓存键
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update((digest or content_digest(image)).encode())
+    h.update(json.dumps(settings, sort_keys=True).encode())
+    h.update(str(tpai_version).encode())
+    return h.hexdigest()
+
+class ResultCache:
+    """
+    按内容寻址的 Topaz 处理结果磁盘缓存
+
+    每个条目是一个以缓存键命名的输出文件。索引在内存中按最近使用顺序维护，
+    总大小超过 max_bytes 时淘汰最久未使用的条目。命中时更新文件的修改时间，
+    因此重启后可以从磁盘恢复 LRU 顺序。
+
+    磁盘之上还有一层内存缓存，保存最近解码过的帧张量 (同样按 LRU 淘汰)，
+    整批命中时无需读取或解码任何文件。
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES, memory_max_bytes=DEFAULT_MEMORY_BYTES):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.memory_max_bytes = memory_max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.memory_hits = 0
+        self._lock = threading.Lock()
+        self._index = OrderedDict()  # key -> (path, size)，最久未使用的在前
+        self._total_bytes = 0
+        self._frames = OrderedDict()  # key -> 解码后的帧张量，最久未使用的在前
+        self._memory_bytes = 0
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        """扫描缓存目录，按修改时间重建 LRU 索引"""
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if not entry.is_file() or entry.name.startswith("."):
+                    continue
+                st = entry.stat()
+                key = os.path.splitext(entry.name)[0]
+                entries.append((st.st_mtime, key, entry.path, st.st_size))
+
+        for _, key, path, size in sorted(entries):
+            self._index[key] = (path, size)
+            self._total_bytes += size
+
+        with self._lock:
+            self._evict()
+
+    def get(self, key):
+        """返回缓存的输出文件路径，未命中时返回 None"""
+        with self._lock:
+            item = self._index.get(key)
+            if item is None or not os.path.exists(item[0]):
+                if item is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            self.hits += 1
+            path = item[0]
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def put(self, key, src_path):
+        """
+        将处理结果加入缓存
+
+        与缓存目录在同一文件系统时创建硬链接，不复制数据；否则 (如暂存目录在内存文件系统中)
+        复制一份。调用方应先从 src_path 解码，再调用本方法，使复制不阻塞解码。
+
+        返回:
+            str: 缓存中的文件路径
+        """
+        ext = os.path.splitext(src_path)[1]
+        dst_path = os.path.join(self.cache_dir, key + ext)
+
+        # 先写入临时文件再原子替换，避免并发读取到不完整的文件
+        tmp_path = os.path.join(self.cache_dir, f".tmp_{uuid.uuid4().hex}")
+        try:
+            try:
+                os.link(src_path, tmp_path)
+            except OSError:
+                shutil.copyfile(src_path, tmp_path)
+            os.replace(tmp_path, dst_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        size = os.path.getsize(dst_path)
+        with self._lock:
+            if key in self._index:
+                self._total_bytes -= self._index[key][1]
+            self._index[key] = (dst_path, size)
+            self._index.move_to_end(key)
+            self._total_bytes += size
+            self._evict(keep=key)
+        return dst_path
+
+    def get_frame(self, key):
+        """返回内存中缓存的解码帧 (调用方不得修改)，未命中时返回 None"""
+        with self._lock:
+            frame = self._frames.get(key)
+            if frame is not None:
+                self._frames.move_to_end(key)
+                self.memory_hits += 1
+            return frame
+
+    def put_frame(self, key, frame):
+        """将解码后的帧放入内存缓存，frame 会被复制，不会保留对整个批次张量的引用"""
+        size = frame.nelement() * frame.element_size()
+        if size > self.memory_max_bytes:
+            return
+        frame = frame.detach().clone()
+        with self._lock:
+            old = self._frames.pop(key, None)
+            if old is not None:
+                self._memory_bytes -= old.nelement() * old.element_size()
+            self._frames[key] = frame
+            self._memory_bytes += size
+            while self._memory_bytes > self.memory_max_bytes:
+                _, evicted = self._frames.popitem(last=False)
+                self._memory_bytes -= evicted.nelement() * evicted.element_size()
+
+    def _drop(self, key):
+        path, size = self._index.pop(key)
+        self._total_bytes -= size
+        return path
+
+    def _evict(self, keep=None):
+        """淘汰最久未使用的条目直到总大小不超过上限 (调用方需持有锁)"""
+        while self._total_bytes > self.max_bytes and self._index:
+            key = next(iter(self._index))
+            if key == keep:
+                break
+            path = self._drop(key)
+            self.evictions += 1
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        """返回缓存统计信息"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._index),
+                "total_bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "memory_entries": len(self._frames),
+                "memory_bytes": self._memory_bytes,
+                "memory_hits": self.memory_hits,
+            }
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+def get_result_cache():
+    """返回进程共享的结果缓存实例"""
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache()
+        return _result_cache
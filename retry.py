@@ -0,0 +1,156 @@
+import os
+import time
+import random
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from PIL import Image
+
+from .progress import interrupted, throw_if_interrupted
+
+# 失败时的最大重试次数，可通过环境变量 COMFY_TOPAZ_MAX_RETRIES 调整
+MAX_RETRIES = max(0, int(os.environ.get("COMFY_TOPAZ_MAX_RETRIES", 2)))
+
+# 重试没有意义的返回码: 未登录、参数错误、没有有效输入在重试时结果不会改变
+FATAL_CODES = {253, 254, 255}
+
+# 超时 = 启动时间 + 余量 * 每百万像素耗时 * 百万像素数
+# 还没有观测数据时每百万像素按 DEFAULT_SECONDS_PER_MP 秒估算
+STARTUP_SECONDS = 120
+DEFAULT_SECONDS_PER_MP = 15.0
+TIMEOUT_MARGIN = 4.0
+MIN_TIMEOUT = 60
+# 因超时重试时超时时间的放大倍数
+TIMEOUT_GROWTH = 2.0
+# 观测值的指数移动平均系数
+THROUGHPUT_SMOOTHING = 0.3
+
+# 指数退避: 第 n 次重试前等待 [0.5, 1] * min(BACKOFF_MAX, BACKOFF_BASE * 2^n) 秒
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+
+# 同一批次中连续出现这么多次不可重试的失败后熔断，其余调用立即失败
+BREAKER_THRESHOLD = 2
+
+# 当前批次的熔断器
+_current_breaker = contextvars.ContextVar("topaz_circuit_breaker", default=None)
+
+def is_fatal(returncode):
+    """返回码是否表示重试也不会成功的错误"""
+    return returncode in FATAL_CODES
+
+def backoff_delay(attempt):
+    """第 attempt 次重试 (从 0 开始) 前的等待时间，带随机抖动以错开并发的重试"""
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt))
+    return delay * random.uniform(0.5, 1.0)
+
+def wait_backoff(delay):
+    """等待 delay 秒，期间用户取消任务时立即抛出中断异常"""
+    deadline = time.monotonic() + delay
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or interrupted():
+            break
+        time.sleep(min(remaining, 0.2))
+    throw_if_interrupted()
+
+def input_megapixels(paths):
+    """返回输入图像的总像素数 (百万)，只读取文件头；无法读取的文件按 0 计算"""
+    total = 0
+    for path in paths:
+        try:
+            with Image.open(path) as img:
+                width, height = img.size
+            total += width * height
+        except Exception:
+            pass
+    return total / 1e6
+
+class ThroughputEstimator:
+    """
+    根据已完成的 tpai 调用估算每百万像素的处理耗时，用于计算超时时间
+
+    进程内共享，观测值取指数移动平均；不同设置 (如放大倍数) 的耗时差异由 TIMEOUT_MARGIN 覆盖。
+    """
+
+    def __init__(self):
+        self.seconds_per_mp = None
+        self._lock = threading.Lock()
+
+    def observe(self, megapixels, seconds):
+        # 耗时包含 tpai 的启动时间，小于 1 百万像素的输入按 1 百万像素计算，
+        # 避免启动时间占主导的小图像把估算值拉得过高
+        sample = seconds / max(megapixels, 1.0)
+        with self._lock:
+            if self.seconds_per_mp is None:
+                self.seconds_per_mp = sample
+            else:
+                self.seconds_per_mp += THROUGHPUT_SMOOTHING * (sample - self.seconds_per_mp)
+
+    def timeout_for(self, megapixels):
+        """返回处理 megapixels 百万像素时使用的超时时间 (秒)"""
+        seconds_per_mp = self.seconds_per_mp if self.seconds_per_mp is not None else DEFAULT_SECONDS_PER_MP
+        return max(MIN_TIMEOUT, STARTUP_SECONDS + TIMEOUT_MARGIN * seconds_per_mp * megapixels)
+
+_throughput = ThroughputEstimator()
+
+def get_throughput_estimator():
+    """返回进程共享的耗时估算器"""
+    return _throughput
+
+class CircuitBreakerOpen(Exception):
+    """熔断器已打开，不再启动 tpai"""
+    pass
+
+class CircuitBreaker:
+    """
+    一个批次内的熔断器
+
+    连续 threshold 次调用以不可重试的错误 (或耗尽重试) 结束后打开，此后同一批次中
+    所有调用 (包括并行的块和正在等待重试的调用) 直接失败，不再启动 tpai。成功的调用会清零计数。
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD):
+        self.threshold = threshold
+        self.failures = 0
+        self.reason = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.reason is not None
+
+    def check(self):
+        """熔断器打开时抛出 CircuitBreakerOpen"""
+        if self.reason is not None:
+            raise CircuitBreakerOpen(f"已连续 {self.failures} 次失败，停止处理本批次: {self.reason}")
+
+    def record_success(self):
+        with self._lock:
+            if self.reason is None:
+                self.failures = 0
+
+    def record_failure(self, reason):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold and self.reason is None:
+                self.reason = reason
+
+@contextmanager
+def breaker_scope(threshold=BREAKER_THRESHOLD):
+    """
+    在代码块中使用同一个熔断器
+
+    已有活动的熔断器时沿用它，使嵌套调用 (节点 -> 并行块 -> 单次 tpai) 共享同一批次的状态。
+    """
+    breaker = _current_breaker.get()
+    if breaker is not None:
+        yield breaker
+        return
+    breaker = CircuitBreaker(threshold)
+    token = _current_breaker.set(breaker)
+    try:
+        yield breaker
+    finally:
+        _current_breaker.reset(token)
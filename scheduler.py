@@ -0,0 +1,187 @@
+import os
+import time
+import uuid
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from .jobs import CANCEL_POLL_SECONDS, JobCancelled
+
+# 进程级的 tpai 并发上限，由所有节点共享
+# 可通过环境变量 COMFY_TOPAZ_MAX_WORKERS 调整
+MAX_TOTAL_WORKERS = max(1, int(os.environ.get("COMFY_TOPAZ_MAX_WORKERS", max(1, (os.cpu_count() or 2) // 2))))
+
+# 优先级，数值越小越先运行
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+# 等待超过这么多秒的任务提升一级优先级，避免低优先级任务一直等待
+AGING_SECONDS = 60
+
+# 当前调用的优先级和所属者 (通常是 ComfyUI 的 prompt)
+_current_priority = contextvars.ContextVar("topaz_job_priority", default=PRIORITIES["normal"])
+_current_owner = contextvars.ContextVar("topaz_job_owner", default="default")
+
+class _Waiter:
+    __slots__ = ("priority", "owner", "seq", "enqueued")
+
+    def __init__(self, priority, owner, seq):
+        self.priority = priority
+        self.owner = owner
+        self.seq = seq
+        self.enqueued = time.monotonic()
+
+class TopazScheduler:
+    """
+    进程内所有 tpai 调用共享的调度器
+
+    同时运行的 tpai 进程数不超过 limit，其余调用排队。有空闲名额时按以下顺序选择下一个:
+    优先级 (等待每满 AGING_SECONDS 秒提升一级)、所属者当前正在运行的 tpai 数、所属者
+    已获得的名额数 (都是少的优先，使多个 prompt 或客户端轮流使用名额)、排队顺序。
+    """
+
+    def __init__(self, limit=MAX_TOTAL_WORKERS):
+        self.limit = limit
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._running = {}  # 所属者 -> 正在运行的 tpai 数
+        self._served = {}  # 所属者 -> 已获得的名额数，所属者没有运行或排队的调用时清除
+        self._active = 0
+        self._seq = itertools.count()
+        self.completed = 0
+        self.max_queued = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _rank(self, waiter, now):
+        aged = int((now - waiter.enqueued) // AGING_SECONDS)
+        return (waiter.priority - aged, self._running.get(waiter.owner, 0), self._served.get(waiter.owner, 0), waiter.seq)
+
+    def _is_next(self, waiter):
+        if self._active >= self.limit:
+            return False
+        now = time.monotonic()
+        return min(self._waiting, key=lambda w: self._rank(w, now)) is waiter
+
+    def acquire(self, priority=None, owner=None, cancel_check=None):
+        """
+        等待一个运行名额
+
+        参数:
+            priority (int, optional): 优先级，默认使用当前上下文的优先级
+            owner (str, optional): 所属者，默认使用当前上下文的所属者
+            cancel_check (callable, optional): 等待期间定期调用，返回 True 时放弃等待并抛出 JobCancelled
+
+        返回:
+            float: 排队等待的时间 (秒)
+        """
+        priority = _current_priority.get() if priority is None else priority
+        owner = _current_owner.get() if owner is None else owner
+        with self._cond:
+            waiter = _Waiter(priority, owner, next(self._seq))
+            self._waiting.append(waiter)
+            self.max_queued = max(self.max_queued, len(self._waiting))
+            try:
+                while not self._is_next(waiter):
+                    self._cond.wait(CANCEL_POLL_SECONDS if cancel_check else None)
+                    if cancel_check and cancel_check():
+                        raise JobCancelled("等待运行名额时任务已取消")
+            except BaseException:
+                self._waiting.remove(waiter)
+                self._forget(owner)
+                # 队首变化后其他等待者需要重新判断
+                self._cond.notify_all()
+                raise
+            self._waiting.remove(waiter)
+            self._cond.notify_all()
+
+            wait = time.monotonic() - waiter.enqueued
+            self._active += 1
+            self._running[owner] = self._running.get(owner, 0) + 1
+            self._served[owner] = self._served.get(owner, 0) + 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            return wait
+
+    def release(self, owner=None):
+        owner = _current_owner.get() if owner is None else owner
+        with self._cond:
+            self._active -= 1
+            self.completed += 1
+            count = self._running.get(owner, 0) - 1
+            if count > 0:
+                self._running[owner] = count
+            else:
+                self._running.pop(owner, None)
+                self._forget(owner)
+            self._cond.notify_all()
+
+    def _forget(self, owner):
+        """所属者没有运行或排队的调用时清除它的计数 (调用方需持有锁)"""
+        if owner not in self._running and not any(w.owner == owner for w in self._waiting):
+            self._served.pop(owner, None)
+
+    @contextmanager
+    def slot(self, priority=None, owner=None, cancel_check=None):
+        """在代码块中占用一个运行名额，返回排队等待的时间 (秒)"""
+        owner = _current_owner.get() if owner is None else owner
+        wait = self.acquire(priority, owner, cancel_check)
+        try:
+            yield wait
+        finally:
+            self.release(owner)
+
+    def stats(self):
+        """返回调度器的统计信息"""
+        with self._cond:
+            return {
+                "limit": self.limit,
+                "running": self._active,
+                "queued": len(self._waiting),
+                "max_queued": self.max_queued,
+                "completed": self.completed,
+                "avg_wait_seconds": round(self.total_wait / self.completed, 3) if self.completed else 0.0,
+                "max_wait_seconds": round(self.max_wait, 3),
+            }
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+    """返回进程共享的调度器"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = TopazScheduler()
+        return _scheduler
+
+def current_prompt_id():
+    """返回 ComfyUI 正在执行的 prompt 的 ID，在 ComfyUI 之外运行时返回 None"""
+    try:
+        from server import PromptServer
+        return getattr(PromptServer.instance, "last_prompt_id", None)
+    except (ImportError, AttributeError):
+        return None
+
+def current_job_context():
+    """返回当前上下文的优先级名称和所属者"""
+    value = _current_priority.get()
+    priority = next((name for name, level in PRIORITIES.items() if level == value), "normal")
+    return priority, _current_owner.get()
+
+@contextmanager
+def job_context(priority="normal", owner=None):
+    """
+    在代码块中设置 tpai 调用的优先级和所属者
+
+    参数:
+        priority (str): "high"、"normal" 或 "low"
+        owner (str, optional): 所属者，默认使用当前 prompt 的 ID，没有时为本次调用生成一个
+    """
+    priority_token = _current_priority.set(PRIORITIES.get(priority, PRIORITIES["normal"]))
+    owner_token = _current_owner.set(owner or current_prompt_id() or uuid.uuid4().hex)
+    try:
+        yield
+    finally:
+        _current_owner.reset(owner_token)
+        _current_priority.reset(priority_token)
@@ -0,0 +1,22 @@
+"""
+Run a Topaz worker service for the ComfyTopazPhoto node's client mode.
+
+    python scripts/topaz_worker.py --tpai-exe /path/to/tpai --port 8601
+
+The worker does not need ComfyUI. Like the benchmarks, it registers an empty
+package pointing at the repository (the package __init__ would copy web assets
+into a ComfyUI install) and imports the worker module from it.
+"""
+import importlib
+import os
+import sys
+import types
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = "comfy_topaz_photo"
+
+if __name__ == "__main__":
+    package = types.ModuleType(PACKAGE)
+    package.__path__ = [REPO_DIR]
+    sys.modules[PACKAGE] = package
+    sys.exit(importlib.import_module(f"{PACKAGE}.worker").main())
@@ -0,0 +1,150 @@
+import os
+import re
+import json
+import shutil
+from collections import Counter
+
+from .fingerprint import tensor_fingerprint
+from .staging import make_work_dir
+
+# 日志前缀
+log_prefix = "[ComfyTopazPhoto]"
+
+# 序列中识别的图像扩展名
+SEQUENCE_EXTS = {".png", ".jpg", ".jpeg", ".tif", ".tiff", ".webp", ".bmp"}
+
+# 记录已完成帧的清单文件名
+MANIFEST_NAME = ".topaz_sequence.json"
+
+def _natural_key(name):
+    """按数字大小排序 frame_2 < frame_10"""
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", name)]
+
+def list_frames(input_dir):
+    """
+    按帧序列出目录中的图像文件
+
+    帧名是输出文件的基本名，也是清单中的键。通常为不含扩展名的文件名；
+    多个文件只有扩展名不同 (如 0001.png 和 0001.jpg) 时改用完整的文件名，
+    避免这些帧在清单和输出目录中互相覆盖。
+
+    返回:
+        list: (帧名, 文件路径) 列表
+    """
+    if not os.path.isdir(input_dir):
+        raise FileNotFoundError(f"输入目录不存在: {input_dir}")
+    names = [
+        entry.name for entry in os.scandir(input_dir)
+        if entry.is_file() and os.path.splitext(entry.name)[1].lower() in SEQUENCE_EXTS
+    ]
+    stems = Counter(os.path.splitext(name)[0] for name in names)
+    frames = []
+    for name in sorted(names, key=_natural_key):
+        stem = os.path.splitext(name)[0]
+        frames.append((stem if stems[stem] == 1 else name, os.path.join(input_dir, name)))
+    return frames
+
+def source_fingerprint(source):
+    """
+    返回一帧来源的指纹，用于判断续传时该帧是否变化
+
+    文件按大小和修改时间判断，单帧图像使用 tensor_fingerprint (张量输入的帧名总是
+    frame_000000...，只凭帧名无法区分不同的片段)。
+    """
+    if isinstance(source, str):
+        st = os.stat(source)
+        return f"file:{st.st_size}|{st.st_mtime_ns}"
+    return "tensor:" + tensor_fingerprint(source[None])
+
+class SequenceManifest:
+    """
+    输出目录中记录已完成帧的清单，用于中断后续传
+
+    每帧记录输出文件名和来源的指纹，来源变化的帧重新处理。
+    设置与清单中记录的不一致时视为新任务，之前的记录全部作废。
+    """
+
+    def __init__(self, output_dir, settings):
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self.output_dir = output_dir
+        self.settings = settings
+        self.frames = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("settings") == settings:
+                self.frames = data.get("frames", {})
+        except (OSError, ValueError):
+            pass
+
+    def is_done(self, name, fingerprint):
+        entry = self.frames.get(name)
+        # 旧版本的清单只记录了输出文件名，没有指纹，按未完成处理
+        if not isinstance(entry, dict) or entry.get("source") != fingerprint:
+            return False
+        return os.path.exists(os.path.join(self.output_dir, entry["output"]))
+
+    def mark(self, name, output, fingerprint):
+        self.frames[name] = {"output": output, "source": fingerprint}
+
+    def save(self):
+        """原子写入清单，崩溃时不会留下损坏的文件"""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"settings": self.settings, "frames": self.frames}, f)
+        os.replace(tmp_path, self.path)
+
+def process_sequence(frames, output_dir, process_chunk, chunk_size=16, resume=True, settings=None, staging_dir=None):
+    """
+    分块流式处理图像序列，结果直接写入输出目录
+
+    frames 可以是惰性迭代器，任何时刻只有一个分块的帧在处理中，内存占用与序列长度无关。
+    每个分块完成后更新清单，中断后以 resume=True 重新运行会跳过已完成的帧。
+
+    参数:
+        frames (iterable): (帧名, 来源) 序列，来源可以是文件路径或单帧图像
+        output_dir (str): 输出目录，结果文件以帧名命名
+        process_chunk (callable): process_chunk(sources, work_dir) -> 输出文件路径列表
+        chunk_size (int): 每个分块的帧数
+        resume (bool): 是否跳过清单中已完成的帧
+        settings (dict, optional): 影响输出的设置，变化时不续传
+        staging_dir (str, optional): 暂存根目录
+
+    返回:
+        dict: {"processed": 本次处理的帧数, "skipped": 跳过的帧数}
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = SequenceManifest(output_dir, settings)
+    stats = {"processed": 0, "skipped": 0}
+
+    def run_chunk(chunk):
+        work_dir = make_work_dir(configured_root=staging_dir, prefix="sequence_")
+        try:
+            outputs = process_chunk([source for _, source, _ in chunk], work_dir)
+            if len(outputs) != len(chunk):
+                raise RuntimeError(f"输出数量 ({len(outputs)}) 与输入数量 ({len(chunk)}) 不一致")
+            for (name, _, fingerprint), output in zip(chunk, outputs):
+                filename = name + os.path.splitext(output)[1]
+                # 暂存目录可能位于内存文件系统，跨设备时 move 会退化为复制
+                shutil.move(output, os.path.join(output_dir, filename))
+                manifest.mark(name, filename, fingerprint)
+            manifest.save()
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        stats["processed"] += len(chunk)
+        print(f"{log_prefix} 序列处理: 已完成 {stats['processed']} 帧, 跳过 {stats['skipped']} 帧")
+
+    chunk = []
+    for name, source in frames:
+        fingerprint = source_fingerprint(source)
+        if resume and manifest.is_done(name, fingerprint):
+            stats["skipped"] += 1
+            continue
+        chunk.append((name, source, fingerprint))
+        if len(chunk) >= chunk_size:
+            run_chunk(chunk)
+            chunk = []
+    if chunk:
+        run_chunk(chunk)
+
+    return stats
@@ -0,0 +1,142 @@
+import os
+import atexit
+import shutil
+import tempfile
+import threading
+
+# 日志前缀
+log_prefix = "[ComfyTopazPhoto]"
+
+# 用户指定的暂存根目录，优先于自动检测，可通过环境变量 COMFY_TOPAZ_STAGING_DIR 设置
+STAGING_ROOT_ENV = "COMFY_TOPAZ_STAGING_DIR"
+
+# 优先检查的内存文件系统挂载点
+PREFERRED_RAM_DIRS = ["/dev/shm"]
+
+# 估算占用之外额外保留的比例，避免把内存文件系统写满
+SAFETY_FACTOR = 1.5
+
+_lock = threading.Lock()
+_process_dirs = {}  # 暂存根目录 -> 本进程的长期暂存目录
+
+def detect_ram_dirs():
+    """
+    检测可写的内存文件系统 (tmpfs/ramfs) 挂载点
+
+    返回:
+        list: 挂载点路径列表，/dev/shm 在前
+    """
+    mounts = []
+    try:
+        with open("/proc/mounts", "r", encoding="utf-8", errors="ignore") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 3 and fields[2] in ("tmpfs", "ramfs"):
+                    # /proc/mounts 中的空格、制表符等以八进制转义
+                    mount = fields[1]
+                    for escaped, char in (("\\040", " "), ("\\011", "\t"), ("\\012", "\n"), ("\\134", "\\")):
+                        mount = mount.replace(escaped, char)
+                    mounts.append(mount)
+    except OSError:
+        return []
+
+    ordered = [d for d in PREFERRED_RAM_DIRS if d in mounts] + [d for d in mounts if d not in PREFERRED_RAM_DIRS]
+    return [d for d in ordered if os.path.isdir(d) and os.access(d, os.W_OK)]
+
+def available_memory():
+    """返回可用内存字节数 (/proc/meminfo 中的 MemAvailable)，无法获取时返回 None"""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def disk_staging_root():
+    """磁盘上的后备暂存根目录: ComfyUI 临时目录，在 ComfyUI 之外运行时为系统临时目录"""
+    try:
+        import folder_paths
+        return folder_paths.get_temp_directory()
+    except ImportError:
+        return tempfile.gettempdir()
+
+def estimate_footprint(images, output_scale=4):
+    """
+    估算一个批次在暂存目录中的占用字节数
+
+    暂存输入按无压缩 8 位计算，输出按放大 output_scale 倍后的无压缩 8 位计算。
+
+    参数:
+        images: 形状为 [B, H, W, C] 的张量或数组
+        output_scale (int): 预期的放大倍数
+    """
+    shape = tuple(images.shape)
+    if len(shape) == 3:
+        shape = (1,) + shape
+    pixels = 1
+    for dim in shape:
+        pixels *= int(dim)
+    return pixels * (1 + output_scale * output_scale)
+
+def select_staging_root(estimated_bytes=0, configured_root=None):
+    """
+    选择暂存根目录
+
+    用户配置 (参数或环境变量) 优先；否则选择剩余空间和可用内存都足以容纳
+    估算占用的内存文件系统；都不满足时回退到磁盘。
+
+    参数:
+        estimated_bytes (int): 批次的估算占用
+        configured_root (str, optional): 用户指定的根目录
+
+    返回:
+        str: 暂存根目录
+    """
+    configured_root = configured_root or os.environ.get(STAGING_ROOT_ENV)
+    if configured_root:
+        return configured_root
+
+    required = int(estimated_bytes * SAFETY_FACTOR)
+    mem_available = available_memory()
+    for ram_dir in detect_ram_dirs():
+        try:
+            free = shutil.disk_usage(ram_dir).free
+        except OSError:
+            continue
+        # tmpfs 中的文件占用内存，因此还要检查可用内存
+        if free >= required and (mem_available is None or mem_available >= required):
+            return ram_dir
+
+    return disk_staging_root()
+
+def _remove_process_dirs():
+    for path in list(_process_dirs.values()):
+        shutil.rmtree(path, ignore_errors=True)
+
+atexit.register(_remove_process_dirs)
+
+def get_process_staging_dir(estimated_bytes=0, configured_root=None):
+    """
+    返回本进程在所选根目录下的长期暂存目录
+
+    目录在首次使用时创建并在进程退出时删除，之后的调用都复用它。
+    """
+    root = select_staging_root(estimated_bytes, configured_root)
+    with _lock:
+        path = _process_dirs.get(root)
+        if path is None or not os.path.isdir(path):
+            path = os.path.join(root, f"comfy_topaz_{os.getpid()}")
+            os.makedirs(path, exist_ok=True)
+            _process_dirs[root] = path
+            print(f"{log_prefix} 暂存目录: {path}")
+    return path
+
+def make_work_dir(estimated_bytes=0, configured_root=None, prefix="job_"):
+    """
+    在长期暂存目录中为一次调用创建独立的工作子目录
+
+    并发调用各自使用自己的子目录，互不干扰。调用方负责在结束后删除它。
+    """
+    return tempfile.mkdtemp(prefix=prefix, dir=get_process_staging_dir(estimated_bytes, configured_root))
@@ -0,0 +1,113 @@
+import numpy as np
+import torch
+
+def tile_positions(length, tile_size, overlap):
+    """
+    计算一个维度上各分块的起始位置
+
+    分块之间至少重叠 overlap 像素，最后一块与边缘对齐，因此所有分块大小相同。
+    长度不超过 tile_size 时只有一个覆盖整个维度的分块。
+
+    返回:
+        tuple: (起始位置列表, 分块大小)
+    """
+    if length <= tile_size:
+        return [0], length
+    stride = tile_size - overlap
+    count = -(-(length - overlap) // stride)  # 向上取整
+    starts = [min(i * stride, length - tile_size) for i in range(count)]
+    return starts, tile_size
+
+def split_tiles(images, tile_size, overlap):
+    """
+    将 [B, H, W, C] 图像切分为相互重叠、大小相同的分块
+
+    参数:
+        images (torch.Tensor): 输入图像
+        tile_size (int): 分块边长
+        overlap (int): 相邻分块的重叠像素数
+
+    返回:
+        tuple: (分块张量 [B*N, th, tw, C], 分块布局)
+            布局记录原图大小和每个分块的位置，供 merge_tiles 使用
+    """
+    if overlap * 2 >= tile_size:
+        raise ValueError(f"重叠 ({overlap}) 必须小于分块大小 ({tile_size}) 的一半")
+
+    batch, height, width = images.shape[:3]
+    ys, tile_h = tile_positions(height, tile_size, overlap)
+    xs, tile_w = tile_positions(width, tile_size, overlap)
+    boxes = [(y, x) for y in ys for x in xs]
+
+    tiles = torch.stack([
+        images[b, y:y + tile_h, x:x + tile_w]
+        for b in range(batch) for y, x in boxes
+    ])
+    layout = {"batch": batch, "size": (height, width), "tile": (tile_h, tile_w), "boxes": boxes}
+    return tiles, layout
+
+def _feather(length, starts, tile, scale):
+    """
+    计算一个维度上每个分块的羽化权重
+
+    与相邻分块重叠的一侧按重叠宽度从 0 线性过渡到 1，位于图像边缘的一侧保持为 1。
+
+    返回:
+        dict: 起始位置 -> 长度为 tile*scale 的权重向量
+    """
+    out_tile = int(round(tile * scale))
+    ordered = sorted(set(starts))
+    weights = {}
+    for i, start in enumerate(ordered):
+        ramp = np.ones(out_tile, dtype=np.float32)
+        if i > 0:
+            ramp_len = int(round((ordered[i - 1] + tile - start) * scale))
+            if ramp_len > 0:
+                ramp[:ramp_len] = (np.arange(ramp_len, dtype=np.float32) + 0.5) / ramp_len
+        if i < len(ordered) - 1:
+            ramp_len = int(round((start + tile - ordered[i + 1]) * scale))
+            if ramp_len > 0:
+                ramp[out_tile - ramp_len:] = np.minimum(
+                    ramp[out_tile - ramp_len:], (np.arange(ramp_len, 0, -1, dtype=np.float32) - 0.5) / ramp_len)
+        weights[start] = ramp
+    return weights
+
+def merge_tiles(tiles, layout):
+    """
+    将处理后的分块按布局拼回完整图像，重叠区域使用羽化权重混合
+
+    处理后的分块可以被放大，放大倍数由分块大小的变化推算。
+
+    参数:
+        tiles (torch.Tensor): 处理后的分块 [B*N, th', tw', C]
+        layout (dict): split_tiles 返回的分块布局
+
+    返回:
+        torch.Tensor: 拼接后的图像 [B, H', W', C]
+    """
+    height, width = layout["size"]
+    tile_h, tile_w = layout["tile"]
+    boxes = layout["boxes"]
+    out_tile_h, out_tile_w, channels = tiles.shape[1:]
+    scale_y = out_tile_h / tile_h
+    scale_x = out_tile_w / tile_w
+
+    # 权重是可分离的，每个分块的二维权重由两个一维向量外积得到
+    wy = _feather(height, [y for y, _ in boxes], tile_h, scale_y)
+    wx = _feather(width, [x for _, x in boxes], tile_w, scale_x)
+    masks = torch.from_numpy(np.stack([np.outer(wy[y], wx[x]) for y, x in boxes]))[..., None]
+
+    out_h = int(round(height * scale_y))
+    out_w = int(round(width * scale_x))
+    tiles = tiles.reshape(layout["batch"], len(boxes), out_tile_h, out_tile_w, channels)
+    merged = torch.zeros((layout["batch"], out_h, out_w, channels), dtype=torch.float32)
+    weight = torch.zeros((out_h, out_w, 1), dtype=torch.float32)
+
+    for i, (y, x) in enumerate(boxes):
+        oy = min(int(round(y * scale_y)), out_h - out_tile_h)
+        ox = min(int(round(x * scale_x)), out_w - out_tile_w)
+        merged[:, oy:oy + out_tile_h, ox:ox + out_tile_w] += tiles[:, i] * masks[i]
+        weight[oy:oy + out_tile_h, ox:ox + out_tile_w] += masks[i]
+
+    merged /= weight.clamp_min(1e-6)
+    return merged
@@ -6,11 +6,32 @@ import time
 import tempfile
 import uuid
 import shutil
-import glob
+import json
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from PIL import Image, ImageOps
 import numpy as np
 import torch  # 添加导入 torch 模块
 
+from .autopilot import analyze_autopilot, get_autopilot_cache
+from .cli import TPAI_ERROR_CODES, TopazError, TpaiOutputParser, build_tpai_argv, format_argv, run_tpai
+from .dedup import find_duplicates
+from .fingerprint import node_fingerprint
+from .janitor import get_janitor
+from .jobs import CANCEL_POLL_SECONDS, JobCancelled, TopazJob, get_job_runner
+from .metrics import StageTimer, activate, append_jsonl, timed
+from .progress import current_progress, interrupted, is_interrupt, throw_if_interrupted, track
+from .pipeline import run_pipeline
+from .remote import WorkerError, get_worker_pool, parse_worker_urls
+from .sequence import list_frames, process_sequence
+from .result_cache import get_result_cache, make_cache_key
+from .retry import (MAX_RETRIES, TIMEOUT_GROWTH, CircuitBreakerOpen, backoff_delay, breaker_scope,
+                    get_throughput_estimator, input_megapixels, is_fatal, wait_backoff)
+from .scheduler import MAX_TOTAL_WORKERS, PRIORITIES, get_scheduler, job_context
+from .staging import estimate_footprint, make_work_dir
+from .tiling import merge_tiles, split_tiles
+
 # 日志前缀
 log_prefix = "[ComfyTopazPhoto]"
 
@@ -21,71 +42,194 @@ log_prefix = "[ComfyTopazPhoto]"
 # 4. 清理临时文件的安全机制
 # 5. 与 ComfyUI 更好的兼容性
 
-# Topaz Photo AI 异常类
-class TopazError(Exception):
-    """Topaz Photo AI 相关错误的异常类"""
-    pass
+# 暂存 (tpai 输入) 文件的编码方式: 名称 -> (文件后缀, PIL 保存参数)
+# 暂存文件几秒后就会删除，压缩只会浪费时间，因此默认使用无压缩 TIFF
+STAGING_FORMATS = {
+    "tiff": (".tif", {"compression": None}),
+    "png_fast": (".png", {"compress_level": 1}),
+    "png_none": (".png", {"compress_level": 0}),
+    "png": (".png", {"compress_level": 6}),
+}
+DEFAULT_STAGING_FORMAT = "tiff"
 
-def init_topaz(custom_path=None):
+def resolve_output_format(output_format, quality=95):
     """
-    初始化 Topaz Photo AI，查找可执行文件
+    将节点的输出格式选项转换为 tpai 的格式参数
+
+    "auto" 表示调用方只需要解码后的张量，此时选择解码最快的 8 位无压缩 TIFF。
+
+    返回:
+        (format, args): 实际输出格式 (用于查找输出文件) 和 tpai 参数列表
+    """
+    if output_format == "auto":
+        return "tif", ['--format', 'tif', '--bit-depth', '8', '--tiff-compression', 'none']
+    return output_format, ['--format', output_format, '--quality', str(quality)]
+
+# tpai 命令行选项，探测时检查 --help 输出中是否包含它们
+KNOWN_TPAI_OPTIONS = [
+    "--showSettings", "--skipProcessing", "--verbose", "--override", "--settings",
+    "--format", "--quality", "--compression", "--bit-depth", "--tiff-compression",
+    "--recursive", "--overwrite",
+]
+
+# 进程级的 tpai 信息缓存: 可执行文件真实路径 -> 信息字典
+_topaz_registry = {}
+# 正在探测的可执行文件: 真实路径 -> Future，同一路径的并发调用只启动一次探测
+_probing = {}
+_registry_lock = threading.Lock()
+
+# 探测失败的结果只缓存较短时间，之后再次调用会重新探测
+PROBE_FAILURE_TTL = 60
+
+def _run_probe(argv):
+    """直接启动 tpai 探测命令，不占用调度器的运行名额，取消时抛出中断异常"""
+    try:
+        return get_job_runner().run(TopazJob(argv, timeout=60), cancel_check=interrupted)
+    except JobCancelled:
+        throw_if_interrupted()
+        raise
+
+def _probe_topaz(path):
+    """
+    启动 tpai 获取版本和支持的命令行选项
+
+    返回:
+        (version, capabilities, ok): ok 为 False 表示探测失败，version 为 "未知版本"
+    """
+    try:
+        result = _run_probe([path, '--version'])
+        if result.returncode != 0 or not result.stdout.strip():
+            raise TopazError(f"返回代码 {result.returncode}")
+        version = result.stdout.strip()
+        result = _run_probe([path, '--help'])
+        help_text = result.stdout + result.stderr
+        return version, [option for option in KNOWN_TPAI_OPTIONS if option in help_text], True
+    except Exception as e:
+        if is_interrupt(e):
+            raise
+        print(f"{log_prefix} 警告: 找到 Topaz Photo AI 但无法获取版本: {path}, 错误: {str(e)}")
+        return "未知版本", [], False
+
+def _cached_info(real_path, st):
+    """返回仍然有效的缓存信息，需要持有 _registry_lock"""
+    info = _topaz_registry.get(real_path)
+    if not info or info["mtime_ns"] != st.st_mtime_ns or info["size"] != st.st_size:
+        return None
+    if info["expires"] is not None and time.monotonic() >= info["expires"]:
+        return None
+    return info
+
+def get_topaz_info(executable_path):
+    """
+    返回 tpai 可执行文件的缓存信息
+
+    信息按可执行文件的真实路径缓存，只有当文件的修改时间或大小发生变化
+    (例如 Topaz 升级) 时才会重新启动 tpai 探测。同一路径同时只有一个调用方探测，
+    其余调用方等待它的结果。探测失败的结果在 PROBE_FAILURE_TTL 秒后过期。
+
     参数:
-        custom_path (str, optional): 用户指定的 tpai.exe 路径
-    返回: 
-        (executable_path, version_string)
+        executable_path (str): tpai 可执行文件路径
+
+    返回:
+        dict: {"path", "version", "capabilities", "mtime_ns", "size", "expires"}
     """
-    # 如果提供了自定义路径，先检查它
-    if custom_path and os.path.isfile(custom_path):
-        try:
-            result = subprocess.run(f'"{custom_path}" --version', shell=True, capture_output=True, text=True, encoding='utf-8', errors='ignore')
-            version = result.stdout.strip() if result.returncode == 0 else "未知版本"
-            print(f"{log_prefix} 使用自定义路径 Topaz Photo AI: {custom_path} (版本: {version})")
-            return (custom_path, version)
-        except Exception as e:
-            print(f"{log_prefix} 警告: 找到 Topaz Photo AI 但无法获取版本: {custom_path}, 错误: {str(e)}")
-            return (custom_path, "未知版本")
-    
-    # 如果未提供自定义路径或自定义路径无效，尝试标准路径
-    executable_paths = []
-    
+    real_path = os.path.realpath(executable_path)
+    try:
+        st = os.stat(real_path)
+    except OSError as e:
+        raise TopazError(f"Topaz Photo AI 可执行文件无法访问: {executable_path}, 错误: {str(e)}")
+
+    while True:
+        with _registry_lock:
+            info = _cached_info(real_path, st)
+            if info:
+                return info
+            future = _probing.get(real_path)
+            owner = future is None
+            if owner:
+                future = _probing[real_path] = Future()
+        if owner:
+            break
+        # 等待其他调用方的探测结果，探测方被中断时结果为 None，重新检查
+        while True:
+            try:
+                info = future.result(timeout=CANCEL_POLL_SECONDS)
+                break
+            except FutureTimeoutError:
+                throw_if_interrupted()
+        if info is not None:
+            return info
+
+    info = None
+    try:
+        version, capabilities, ok = _probe_topaz(executable_path)
+        info = {
+            "path": executable_path,
+            "version": version,
+            "capabilities": capabilities,
+            "mtime_ns": st.st_mtime_ns,
+            "size": st.st_size,
+            "expires": None if ok else time.monotonic() + PROBE_FAILURE_TTL,
+        }
+        with _registry_lock:
+            _topaz_registry[real_path] = info
+        print(f"{log_prefix} 已探测 Topaz Photo AI: {executable_path} (版本: {version})")
+        return info
+    finally:
+        with _registry_lock:
+            _probing.pop(real_path, None)
+        future.set_result(info)
+
+def list_topaz_info():
+    """返回所有已缓存的 tpai 信息 (副本)，不会启动探测"""
+    with _registry_lock:
+        return [dict(info, capabilities=list(info["capabilities"])) for info in _topaz_registry.values()]
+
+def _default_executable_paths():
+    """返回当前平台上 Topaz Photo AI 的标准安装路径"""
     # Windows 路径
     if platform.system() == "Windows":
         # Topaz Photo AI 安装路径
-        paths = [
+        return [
             os.path.join(os.environ.get('PROGRAMFILES', 'C:\\Program Files'), 'Topaz Labs LLC', 'Topaz Photo AI', 'tpai.exe'),
             os.path.join(os.environ.get('PROGRAMFILES(X86)', 'C:\\Program Files (x86)'), 'Topaz Labs LLC', 'Topaz Photo AI', 'tpai.exe'),
             os.path.join(os.environ.get('LOCALAPPDATA', ''), 'Topaz Labs LLC', 'Topaz Photo AI', 'tpai.exe'),
         ]
-        executable_paths.extend(paths)
     
     # macOS 路径
     elif platform.system() == "Darwin":
-        paths = [
+        return [
             '/Applications/Topaz Photo AI.app/Contents/MacOS/tpai',
             os.path.expanduser('~/Applications/Topaz Photo AI.app/Contents/MacOS/tpai')
         ]
-        executable_paths.extend(paths)
     
     # Linux 路径 (如果支持)
     elif platform.system() == "Linux":
-        paths = [
+        return [
             '/opt/topaz-photo-ai/tpai',
             os.path.expanduser('~/.local/share/Topaz Labs LLC/Topaz Photo AI/tpai')
         ]
-        executable_paths.extend(paths)
+    return []
+
+def init_topaz(custom_path=None):
+    """
+    初始化 Topaz Photo AI，查找可执行文件
+    版本信息来自 get_topaz_info 的缓存，只在首次使用或可执行文件变化时启动 tpai
+    参数:
+        custom_path (str, optional): 用户指定的 tpai.exe 路径
+    返回: 
+        (executable_path, version_string)
+    """
+    # 如果提供了自定义路径，先检查它
+    if custom_path and os.path.isfile(custom_path):
+        info = get_topaz_info(custom_path)
+        return (custom_path, info["version"])
     
-    # 检查路径是否存在
-    for path in executable_paths:
+    # 如果未提供自定义路径或自定义路径无效，尝试标准路径
+    for path in _default_executable_paths():
         if os.path.isfile(path):
-            # 尝试获取版本
-            try:
-                result = subprocess.run(f'"{path}" --version', shell=True, capture_output=True, text=True, encoding='utf-8', errors='ignore')
-                version = result.stdout.strip() if result.returncode == 0 else "未知版本"
-                print(f"{log_prefix} 找到 Topaz Photo AI: {path} (版本: {version})")
-                return (path, version)
-            except Exception as e:
-                print(f"{log_prefix} 警告: 找到 Topaz Photo AI 但无法获取版本: {path}, 错误: {str(e)}")
-                return (path, "未知版本")
+            info = get_topaz_info(path)
+            return (path, info["version"])
     
     # 没有找到可执行文件
     if custom_path:
@@ -93,272 +237,462 @@ def init_topaz(custom_path=None):
     else:
         raise TopazError(f"未找到 Topaz Photo AI 可执行文件。请提供正确的 tpai.exe 路径或确保已正确安装 Topaz Photo AI。")
 
-def process_topaz_image(tpai_exe, input_images, output_folder, output_format="jpg", quality=95, overwrite=False):
+def fingerprint_version(tpai_exe, worker_urls=""):
     """
-    使用 Topaz Photo AI 处理图像
-    
+    返回 IS_CHANGED 使用的 tpai 版本
+
+    本机模式下为 get_topaz_info 缓存的版本 (只在首次使用或可执行文件变化时探测)，
+    设置了 worker 时为 worker 报告的版本。找不到 tpai 或 worker 不可用时返回空字符串，
+    此时节点执行会报告实际的错误。
+    """
+    try:
+        if worker_urls.strip():
+            return get_worker_pool(parse_worker_urls(worker_urls)).version()
+        return init_topaz(tpai_exe)[1]
+    except (TopazError, WorkerError):
+        return ""
+
+def _stage_file(src, dst):
+    """将输入文件放入暂存文件夹，优先使用硬链接以避免复制"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def output_stems(count, token=None):
+    """
+    为一批输入预先分配唯一的文件名 (不含扩展名)
+
+    文件名形如 "<token>_00003"，token 对每次调用唯一，因此即使多个调用共用
+    同一个输出文件夹，也能把输出确定地映射回各自的输入。
+
+    返回:
+        (token, stems)
+    """
+    token = token or uuid.uuid4().hex[:12]
+    return token, [f"{token}_{i:05d}" for i in range(count)]
+
+def resolve_outputs(token, count, output_folder, output_format):
+    """
+    通过一次 os.scandir 把输出文件夹中的文件按文件名映射回输入
+
     参数:
-        tpai_exe (str): Topaz Photo AI 可执行文件路径
-        input_images (list): 输入图像路径列表
+        token (str): output_stems 返回的 token
+        count (int): 输入数量
         output_folder (str): 输出文件夹
-        output_format (str): 输出格式 (jpg, png, tif, etc.)
-        quality (int): JPEG 质量 (0-100)
-        overwrite (bool): 是否覆盖现有文件
-        
+        output_format (str): 输出格式 ("preserve" 时不检查扩展名)
+
     返回:
-        list: 处理后的图像路径列表
+        list: 与输入顺序一致的输出路径列表，未找到的为 None
     """
-    # 验证输入
-    if not tpai_exe or not os.path.exists(tpai_exe):
-        raise TopazError(f"Topaz Photo AI 可执行文件未找到: {tpai_exe}")
-    
-    if not input_images:
-        raise TopazError("没有输入图像")
-    
-    # 确保输出文件夹存在
-    try:
-        os.makedirs(output_folder, exist_ok=True)
-        print(f"{log_prefix} 输出文件夹: {output_folder}")
-    except Exception as e:
-        raise TopazError(f"无法创建输出文件夹: {output_folder}, 错误: {str(e)}")
-    
-    output_images = []
-    max_retries = 2  # 最大重试次数
-    
-    # 处理每个输入图像
-    for input_path in input_images:
-        if not os.path.exists(input_path):
-            print(f"{log_prefix} 警告: 输入图像不存在: {input_path}")
-            continue
-        
-        print(f"{log_prefix} 处理图像: {input_path}")
-        
-        # 检查是否已经有处理过的文件
-        existing_file = find_output_file(input_path, output_folder, output_format)
-        if existing_file and not overwrite:
-            print(f"{log_prefix} 输出文件已存在且不覆盖: {existing_file}")
-            output_images.append(existing_file)
-            continue
-        
-        # 记录处理前的文件列表
-        before_files = set(os.listdir(output_folder)) if os.path.exists(output_folder) else set()
-        
-        # 构建命令
-        cmd = [
-            f'"{tpai_exe}"',
-            f'"{input_path}"',
-            f'--output "{output_folder}"',
-            f'--format {output_format}',
-            f'--quality {quality}',
-            f'--showSettings' # 显示处理设置
-        ]
-        
-        if overwrite:
-            cmd.append('--overwrite')
-        
-        # 执行命令
-        command = " ".join(cmd)
-        print(f"{log_prefix} 执行命令: {command}")
-        
+    equivalent_exts = {
+        "jpg": {"jpg", "jpeg"}, "jpeg": {"jpg", "jpeg"},
+        "tif": {"tif", "tiff"}, "tiff": {"tif", "tiff"},
+    }
+    accepted_exts = equivalent_exts.get(output_format, {output_format})
+    prefix = token + "_"
+    index_end = len(prefix) + 5
+
+    exact = [None] * count
+    variants = [None] * count
+    with os.scandir(output_folder) as it:
+        for entry in it:
+            base, ext = os.path.splitext(entry.name)
+            if not base.startswith(prefix) or not base[len(prefix):index_end].isdigit():
+                continue
+            if output_format != "preserve" and ext[1:].lower() not in accepted_exts:
+                continue
+            if not entry.is_file():
+                continue
+
+            index = int(base[len(prefix):index_end])
+            if index >= count:
+                continue
+            if len(base) == index_end:
+                exact[index] = entry.path
+            elif not base[index_end].isdigit():
+                # Topaz 可能在文件名后追加后缀 (例如 <token>_00003-1.jpg)，取名称最小的一个
+                if variants[index] is None or entry.path < variants[index]:
+                    variants[index] = entry.path
+
+    return [e if e is not None else v for e, v in zip(exact, variants)]
+
+def _run_tpai_command(argv, megapixels, description, ok_codes=(0,), max_retries=MAX_RETRIES, count=1):
+    """
+    执行 tpai 命令，按返回码分类决定是否重试
+
+    超时时间根据输入像素数和已观测到的处理速度计算，因超时重试时逐次放大。
+    不可重试的返回码 (未登录、参数错误等) 立即失败，并计入当前批次的熔断器；
+    熔断器打开后批次中的其余调用不再启动 tpai。重试之间按指数退避并加入随机抖动。
+
+    参数:
+        argv (list): build_tpai_argv 构建的参数列表
+        megapixels (float): 本次处理的总像素数 (百万)，用于计算超时时间
+        description (str): 用于日志和错误信息的描述
+        ok_codes (tuple): 视为成功的返回码
+        max_retries (int): 最大重试次数
+        count (int): 本次处理的图像数，用于进度报告
+
+    返回:
+        tuple: (JobResult, TpaiOutputParser) 成功的执行结果和逐行解析的输出
+    """
+    throughput = get_throughput_estimator()
+    timeout = throughput.timeout_for(megapixels)
+    with breaker_scope() as breaker:
         for retry in range(max_retries + 1):
             try:
-                result = subprocess.run(
-                    command, 
-                    shell=True, 
-                    capture_output=True, 
-                    text=True, 
-                    encoding='utf-8', 
-                    errors='ignore',
-                    timeout=300  # 设置超时时间为5分钟
-                )
-                
+                breaker.check()
+            except CircuitBreakerOpen as e:
+                raise TopazError(f"{e} ({description})")
+
+            fatal = False
+            try:
+                # 在任务运行器的事件循环中执行，输出到达时逐行解析并报告进度
+                parser = TpaiOutputParser()
+                result = run_tpai(argv, timeout, parser, count)
+
                 # 输出详细日志用于调试
                 print(f"{log_prefix} 命令返回码: {result.returncode}")
                 print(f"{log_prefix} 命令标准输出: {result.stdout[:500]}...")  # 只显示前500个字符
                 if result.stderr:
                     print(f"{log_prefix} 命令错误输出: {result.stderr}")
-                
-                # 检查是否成功
-                if result.returncode == 0:
-                    # 尝试查找输出文件
-                    output_file = find_output_file(input_path, output_folder, output_format)
-                    if output_file:
-                        print(f"{log_prefix} 成功处理图像: {input_path} -> {output_file}")
-                        output_images.append(output_file)
-                        break  # 成功处理，退出重试循环
-                    else:
-                        # 查找处理后的新文件
-                        after_files = set(os.listdir(output_folder))
-                        new_files = after_files - before_files
-                        
-                        # 按文件创建时间排序，获取最新的文件
-                        if new_files:
-                            new_file_paths = [os.path.join(output_folder, f) for f in new_files]
-                            # 按修改时间排序
-                            new_file_paths.sort(key=os.path.getmtime, reverse=True)
-                            output_path = new_file_paths[0]
-                            print(f"{log_prefix} 成功处理图像(通过新文件检测): {input_path} -> {output_path}")
-                            output_images.append(output_path)
-                            break
-                        else:
-                            error_msg = f"Topaz Photo AI 可能处理成功但未检测到输出文件"
-                            if retry < max_retries:
-                                print(f"{log_prefix} {error_msg}，第 {retry+1} 次重试...")
-                                time.sleep(2)  # 等待2秒后重试
-                            else:
-                                print(f"{log_prefix} {error_msg}，已达最大重试次数。")
-                                raise TopazError(error_msg)
-                else:
-                    error_msg = f"处理图像失败: {result.stderr if result.stderr else '未知错误'}"
-                    if retry < max_retries:
-                        print(f"{log_prefix} {error_msg}，第 {retry+1} 次重试...")
-                        time.sleep(2)  # 等待2秒后重试
-                    else:
-                        print(f"{log_prefix} 错误代码: {result.returncode}")
-                        print(f"{log_prefix} 标准输出: {result.stdout}")
-                        print(f"{log_prefix} 错误输出: {result.stderr}")
-                        raise TopazError(error_msg)
-            
+
+                if result.returncode in ok_codes:
+                    # 只用 tpai 自身的耗时，不含在调度器中排队的时间
+                    throughput.observe(megapixels, result.elapsed)
+                    breaker.record_success()
+                    return result, parser
+                fatal = is_fatal(result.returncode)
+                detail = result.stderr.strip() or "; ".join(parser.errors) or TPAI_ERROR_CODES.get(result.returncode, "未知错误")
+                error_msg = f"处理图像失败: {detail} (返回码: {result.returncode}, {description})"
             except subprocess.TimeoutExpired:
-                error_msg = f"处理图像超时: {input_path}"
-                if retry < max_retries:
-                    print(f"{log_prefix} {error_msg}，第 {retry+1} 次重试...")
-                    time.sleep(2)  # 等待2秒后重试
-                else:
-                    print(f"{log_prefix} {error_msg}，已达最大重试次数。")
-                    raise TopazError(error_msg)
-            
+                error_msg = f"处理图像超时 ({timeout:.0f} 秒): {description}"
+                timeout *= TIMEOUT_GROWTH
             except Exception as e:
+                # 用户取消时不重试
+                if is_interrupt(e):
+                    raise
                 error_msg = f"执行异常: {str(e)}"
-                if retry < max_retries:
-                    print(f"{log_prefix} {error_msg}，第 {retry+1} 次重试...")
-                    time.sleep(2)  # 等待2秒后重试
-                else:
-                    print(f"{log_prefix} {error_msg}，已达最大重试次数。")
-                    raise TopazError(f"Topaz Photo AI 执行异常: {str(e)}")
+
+            if fatal or retry >= max_retries:
+                breaker.record_failure(error_msg)
+                print(f"{log_prefix} {error_msg}，{'不可重试的错误' if fatal else '已达最大重试次数'}。")
+                raise TopazError(error_msg)
+
+            delay = backoff_delay(retry)
+            print(f"{log_prefix} {error_msg}，{delay:.1f} 秒后第 {retry+1} 次重试...")
+            wait_backoff(delay)
+
+def _prepare_run(tpai_exe, input_images, output_folder):
+    """验证输入并确保输出文件夹存在"""
+    if not tpai_exe or not os.path.exists(tpai_exe):
+        raise TopazError(f"Topaz Photo AI 可执行文件未找到: {tpai_exe}")
+
+    if not input_images:
+        raise TopazError("没有输入图像")
+
+    missing_inputs = [p for p in input_images if not os.path.exists(p)]
+    if missing_inputs:
+        raise TopazError(f"输入图像不存在: {missing_inputs}")
+
+    try:
+        os.makedirs(output_folder, exist_ok=True)
+    except Exception as e:
+        raise TopazError(f"无法创建输出文件夹: {output_folder}, 错误: {str(e)}")
+
+def _collect_outputs(input_images, token, output_folder, output_format):
+    """映射输出并确认每个输入都有输出"""
+    with timed("output_discovery", count=len(input_images)):
+        output_paths = resolve_outputs(token, len(input_images), output_folder, output_format)
+    missing = [input_images[i] for i, p in enumerate(output_paths) if p is None]
+    if missing:
+        raise TopazError(f"Topaz Photo AI 未生成以下图像的输出: {missing}")
+    return output_paths
+
+def process_topaz_image(tpai_exe, input_images, output_folder, output_format="jpg", quality=95, overwrite=False, settings=None):
+    """
+    使用 Topaz Photo AI 处理图像，每个图像启动一次 tpai
     
-    if not output_images:
-        print(f"{log_prefix} 警告: 没有处理任何图像")
-    else:
-        print(f"{log_prefix} 成功处理 {len(output_images)} 个图像")
+    每个输入先以预先分配的唯一文件名放入暂存文件夹，整批处理完成后只扫描一次
+    输出文件夹，把输出确定地映射回输入。
     
+    参数:
+        tpai_exe (str): Topaz Photo AI 可执行文件路径
+        input_images (list): 输入图像路径列表
+        output_folder (str): 输出文件夹
+        output_format (str): 输出格式 (jpg, png, tif, auto, etc.)
+        quality (int): JPEG 质量 (0-100)
+        overwrite (bool): 是否覆盖现有文件
+        settings (str | list, optional): 通过 --settings 传递的 JSON 设置，列表时按输入逐个对应
+        
+    返回:
+        list: 与 input_images 顺序一致的输出图像路径列表
+    """
+    _prepare_run(tpai_exe, input_images, output_folder)
+    if not isinstance(settings, list):
+        settings = [settings] * len(input_images)
+    output_format, format_args = resolve_output_format(output_format, quality)
+    token, stems = output_stems(len(input_images))
+
+    # 暂存文件夹放在输出文件夹内，tpai 不带 --recursive 时不会处理子目录
+    staging_folder = os.path.join(output_folder, f"input_{token}")
+    os.makedirs(staging_folder)
+
+    try:
+        # 处理每个输入图像
+        for input_path, stem, image_settings in zip(input_images, stems, settings):
+            staged_path = os.path.join(staging_folder, stem + os.path.splitext(input_path)[1])
+            _stage_file(input_path, staged_path)
+            print(f"{log_prefix} 处理图像: {input_path}")
+
+            # 构建参数列表，直接启动 tpai 而不经过 shell
+            argv = build_tpai_argv(tpai_exe, staged_path, output_folder, format_args, image_settings,
+                                   show_settings=True, overwrite=overwrite)
+            print(f"{log_prefix} 执行命令: {format_argv(argv)}")
+            _run_tpai_command(argv, input_megapixels([staged_path]), description=input_path)
+
+        output_images = _collect_outputs(input_images, token, output_folder, output_format)
+        print(f"{log_prefix} 成功处理 {len(output_images)} 个图像")
+        return output_images
+    finally:
+        shutil.rmtree(staging_folder, ignore_errors=True)
+
+def process_topaz_batch(tpai_exe, input_images, output_folder, output_format="jpg", quality=95, overwrite=False, settings=None):
+    """
+    使用单次 Topaz Photo AI 调用处理整个批次
+
+    所有输入以预先分配的唯一文件名放入同一个暂存文件夹，tpai 只启动一次并处理
+    整个文件夹，输出再按文件名确定地映射回对应的输入，从而避免每张图像都重复
+    加载 Topaz 模型。
+
+    参数:
+        tpai_exe (str): Topaz Photo AI 可执行文件路径
+        input_images (list): 输入图像路径列表
+        output_folder (str): 输出文件夹
+        output_format (str): 输出格式 (jpg, png, tif, auto, etc.)
+        quality (int): JPEG 质量 (0-100)
+        overwrite (bool): 是否覆盖现有文件
+        settings (str, optional): 通过 --settings 传递给整个批次的 JSON 设置
+
+    返回:
+        list: 与 input_images 顺序一致的输出图像路径列表
+    """
+    _prepare_run(tpai_exe, input_images, output_folder)
+    output_format, format_args = resolve_output_format(output_format, quality)
+    token, stems = output_stems(len(input_images))
+
+    # 暂存文件夹放在输出文件夹内，tpai 不带 --recursive 时不会处理子目录
+    staging_folder = os.path.join(output_folder, f"input_{token}")
+    os.makedirs(staging_folder)
+
+    try:
+        for input_path, stem in zip(input_images, stems):
+            _stage_file(input_path, os.path.join(staging_folder, stem + os.path.splitext(input_path)[1]))
+
+        argv = build_tpai_argv(tpai_exe, staging_folder, output_folder, format_args, settings,
+                               show_settings=True, overwrite=overwrite)
+        print(f"{log_prefix} 批处理 {len(input_images)} 个图像，执行命令: {format_argv(argv)}")
+
+        # 0=成功, 1=部分成功 (缺失的输出在映射时报告)
+        _run_tpai_command(argv, input_megapixels(input_images), description=f"{len(input_images)} 个图像",
+                          ok_codes=(0, 1), count=len(input_images))
+
+        output_images = _collect_outputs(input_images, token, output_folder, output_format)
+        print(f"{log_prefix} 批处理成功处理 {len(output_images)} 个图像")
+        return output_images
+    finally:
+        shutil.rmtree(staging_folder, ignore_errors=True)
+
+def process_topaz_parallel(tpai_exe, input_images, output_folder, output_format="jpg", quality=95, overwrite=False, max_workers=2, settings=None):
+    """
+    使用多个并发的 tpai 进程处理图像
+
+    批次被切分为连续的若干块，每块通过 process_topaz_batch 由一个 tpai 进程
+    处理。同时运行的 tpai 进程数受 max_workers 和调度器的进程级上限 MAX_TOTAL_WORKERS
+    共同限制，输出顺序与输入一致。
+
+    参数:
+        tpai_exe (str): Topaz Photo AI 可执行文件路径
+        input_images (list): 输入图像路径列表
+        output_folder (str): 输出文件夹
+        output_format (str): 输出格式 (jpg, png, tif, auto, etc.)
+        quality (int): JPEG 质量 (0-100)
+        overwrite (bool): 是否覆盖现有文件
+        max_workers (int): 本次调用最多同时运行的 tpai 进程数
+        settings (str, optional): 通过 --settings 传递的 JSON 设置
+
+    返回:
+        list: 与 input_images 顺序一致的输出图像路径列表
+    """
+    if not input_images:
+        raise TopazError("没有输入图像")
+
+    num_workers = max(1, min(int(max_workers), MAX_TOTAL_WORKERS, len(input_images)))
+    chunk_size = -(-len(input_images) // num_workers)  # 向上取整
+    chunks = [input_images[i:i + chunk_size] for i in range(0, len(input_images), chunk_size)]
+    print(f"{log_prefix} 并行处理 {len(input_images)} 个图像: {len(chunks)} 块, 最多 {num_workers} 个 tpai 进程")
+
+    def run_chunk(chunk):
+        # 每块的输出文件名带有唯一 token，可以共用同一个输出文件夹
+        return process_topaz_batch(tpai_exe, chunk, output_folder, output_format, quality, overwrite, settings)
+
+    # 各块共享一个熔断器: 一块遇到未登录等错误后，其余块不再启动 tpai
+    with breaker_scope(), ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="topaz_worker") as executor:
+        # 本次调用的状态 (计时器、进度跟踪器、熔断器、调度优先级和所属者) 都保存在 contextvars 中，
+        # 而线程池的线程不会继承调用方的上下文。每个任务在 copy_context() 的副本中运行，
+        # 才能记录到同一个计时器和进度条、共享同一个熔断器并以相同的优先级排队
+        futures = [executor.submit(contextvars.copy_context().run, run_chunk, chunk) for chunk in chunks]
+        output_images = []
+        for future in futures:
+            output_images.extend(future.result())
+
     return output_images
 
-def save_images(images, file_prefix="temp_", file_suffix=".png"):
+def process_topaz_paths(tpai_exe, input_paths, output_folder, output_format="jpg", quality=95, overwrite=False,
+                        execution_mode="batch", max_workers=2, settings=None):
+    """
+    按执行模式调用 Topaz Photo AI 处理图像
+
+    batch: 整个批次只启动一次 tpai; parallel: 多个 tpai 进程分块并行; sequential: 每个图像启动一次。
+    各帧的设置不同时按设置分组分别处理 (每次调用只能传一份 --settings)。
+    设置已由 _parse_autopilot_settings 规范化 (键排序)，这里按完全相同的设置分组。
+
+    参数:
+        settings (list, optional): 每个输入对应的 JSON 设置
+
+    返回:
+        list: 与 input_paths 顺序一致的输出图像路径列表
+    """
+    if settings and len(set(settings)) > 1:
+        groups = {}
+        for i, frame_settings in enumerate(settings):
+            groups.setdefault(frame_settings, []).append(i)
+        # Autopilot 为每帧给出的数值通常略有不同，此时几乎每帧一组，batch 和 parallel 退化为逐帧启动 tpai
+        if len(groups) * 2 > len(input_paths):
+            print(f"{log_prefix} 警告: {len(input_paths)} 帧的设置分为 {len(groups)} 组，每组单独启动 tpai，"
+                  f"{execution_mode} 模式基本失去批处理的效果。可为整批使用同一份设置以减少启动次数")
+        output_paths = [None] * len(input_paths)
+        for frame_settings, indices in groups.items():
+            group_paths = process_topaz_paths(tpai_exe, [input_paths[i] for i in indices], output_folder, output_format, quality,
+                                              overwrite, execution_mode, max_workers, [frame_settings] * len(indices))
+            for i, path in zip(indices, group_paths):
+                output_paths[i] = path
+        return output_paths
+
+    shared_settings = settings[0] if settings else None
+    if execution_mode == "parallel":
+        return process_topaz_parallel(tpai_exe, input_paths, output_folder, output_format, quality, overwrite, max_workers, shared_settings)
+    process_fn = process_topaz_batch if execution_mode == "batch" else process_topaz_image
+    return process_fn(tpai_exe, input_paths, output_folder, output_format, quality, overwrite, shared_settings)
+
+def images_to_uint8(images):
+    """
+    将图像张量或数组一次性转换为 uint8 的 [B, H, W, C] numpy 数组
+
+    支持 [B, H, W, C]、[B, C, H, W]、[H, W, C]、[C, H, W] 和 [H, W] 格式。
+    整个批次在一次向量化运算中完成缩放、裁剪和类型转换，并且只在浮点输入上
+    做一次 max 归约来判断值范围是 0-1 还是 0-255。
+
+    参数:
+        images (torch.Tensor | np.ndarray): 图像数据
+
+    返回:
+        np.ndarray: uint8 类型的 [B, H, W, C] 数组
+    """
+    t = torch.from_numpy(np.asarray(images)) if isinstance(images, np.ndarray) else images.detach()
+
+    # 统一为 4 维
+    if t.ndim == 2:  # [H, W]
+        t = t[None, :, :, None]
+    elif t.ndim == 3:  # [H, W, C] 或 [C, H, W]
+        t = t[None]
+    elif t.ndim != 4:
+        raise ValueError(f"不支持的图像形状: {tuple(t.shape)}")
+
+    # [B, C, H, W] -> [B, H, W, C]
+    channels_first = t.shape[1] in (1, 3, 4) and t.shape[-1] not in (1, 3, 4)
+    if t.dtype != torch.uint8:
+        # 值范围在 0-1 时放大到 0-255，裁剪后截断为 uint8
+        scale = 255.0 if t.is_floating_point() and t.max() <= 1.0 else 1.0
+        t = t.to(torch.float32).mul(scale).clamp_(0, 255).to(torch.uint8)
+    if channels_first:
+        t = t.permute(0, 2, 3, 1)
+
+    return t.cpu().contiguous().numpy()
+
+def save_images(images, file_prefix="temp_", file_suffix=None, output_dir=None, staging_format=DEFAULT_STAGING_FORMAT):
     """
     保存图像到临时文件
-    
+
+    张量和数组会按批次整体转换为 uint8，批次中的每一帧各保存为一个文件。
+
     参数:
         images (list): PyTorch张量、PIL图像或numpy数组列表
         file_prefix (str): 文件名前缀
-        file_suffix (str): 文件后缀
+        file_suffix (str, optional): 文件后缀，默认由 staging_format 决定
+        output_dir (str, optional): 保存目录，默认为系统临时目录
+        staging_format (str): 编码方式，见 STAGING_FORMATS
         
     返回:
-        list: 保存的文件路径列表
+        list: 保存的文件路径列表，每帧一个
     """
     saved_paths = []
+    default_suffix, save_kwargs = STAGING_FORMATS[staging_format]
+    if file_suffix is None:
+        file_suffix = default_suffix
     
     # 确保是列表
     if not isinstance(images, list):
         images = [images]
     
     for img in images:
-        # 创建临时文件
-        temp_file = tempfile.NamedTemporaryFile(
-            prefix=file_prefix, 
-            suffix=file_suffix,
-            delete=False
-        )
-        temp_file.close()
-        
-        try:
-            # 转换为PIL图像并保存
-            if isinstance(img, torch.Tensor):
-                # 从PyTorch张量转换为PIL图像
-                image_np = img.cpu().numpy()
-                
-                # 打印调试信息
-                print(f"{log_prefix} 张量形状: {image_np.shape}, 类型: {image_np.dtype}, 值范围: {image_np.min()} - {image_np.max()}")
-                
-                # 处理批次维度 (如果有)
-                if len(image_np.shape) == 4:  # [B, H, W, C] 或 [B, C, H, W]
-                    # 提取第一个批次
-                    image_np = image_np[0]
-                
-                # 处理图像数据格式，确保是 [H, W, C]
-                if len(image_np.shape) == 3:
-                    if image_np.shape[0] == 3 or image_np.shape[0] == 4:  # [C, H, W] 格式
-                        # 转换为 [H, W, C]
-                        image_np = np.transpose(image_np, (1, 2, 0))
-                
-                # 确保值范围在 0-255
-                if image_np.max() <= 1.0:
-                    image_np = image_np * 255.0
-                
-                # 裁剪值到 0-255 并转换为 uint8
-                image_np = np.clip(image_np, 0, 255).astype(np.uint8)
-                
-                # 根据通道数创建不同模式的图像
-                if image_np.ndim == 3 and image_np.shape[2] == 3:
-                    pil_img = Image.fromarray(image_np, 'RGB')
-                elif image_np.ndim == 3 and image_np.shape[2] == 4:
-                    pil_img = Image.fromarray(image_np, 'RGBA')
-                elif image_np.ndim == 2 or (image_np.ndim == 3 and image_np.shape[2] == 1):
-                    if image_np.ndim == 3:
-                        image_np = image_np[:, :, 0]
-                    pil_img = Image.fromarray(image_np, 'L')
-                else:
-                    # 尝试直接转换
-                    pil_img = Image.fromarray(image_np)
-                
-                pil_img.save(temp_file.name)
-                
-            elif isinstance(img, np.ndarray):
-                # 从numpy数组转换为PIL图像
-                image_np = img.copy()
-                
-                # 打印调试信息
-                print(f"{log_prefix} 数组形状: {image_np.shape}, 类型: {image_np.dtype}, 值范围: {image_np.min()} - {image_np.max()}")
-                
-                # 确保值范围在 0-255
-                if image_np.max() <= 1.0:
-                    image_np = image_np * 255.0
-                
-                # 裁剪值到 0-255 并转换为 uint8
-                image_np = np.clip(image_np, 0, 255).astype(np.uint8)
-                
-                # 根据通道数创建不同模式的图像
-                if image_np.ndim == 3 and image_np.shape[2] == 3:
-                    pil_img = Image.fromarray(image_np, 'RGB')
-                elif image_np.ndim == 3 and image_np.shape[2] == 4:
-                    pil_img = Image.fromarray(image_np, 'RGBA')
-                elif image_np.ndim == 2 or (image_np.ndim == 3 and image_np.shape[2] == 1):
-                    if image_np.ndim == 3:
-                        image_np = image_np[:, :, 0]
-                    pil_img = Image.fromarray(image_np, 'L')
+        if isinstance(img, Image.Image):
+            frames = [img]
+        elif isinstance(img, (torch.Tensor, np.ndarray)):
+            with timed("encode_convert", frames=len(img) if img.ndim == 4 else 1):
+                batch = images_to_uint8(img)
+            print(f"{log_prefix} 保存 {batch.shape[0]} 帧图像, 形状: {batch.shape[1:]}")
+            frames = batch
+        else:
+            raise ValueError(f"不支持的图像类型: {type(img)}")
+
+        for frame in frames:
+            # 创建临时文件
+            temp_file = tempfile.NamedTemporaryFile(
+                prefix=file_prefix, 
+                suffix=file_suffix,
+                dir=output_dir,
+                delete=False
+            )
+            temp_file.close()
+
+            try:
+                if isinstance(frame, Image.Image):
+                    pil_img = frame
+                elif frame.shape[2] == 3:
+                    pil_img = Image.fromarray(frame, 'RGB')
+                elif frame.shape[2] == 4:
+                    pil_img = Image.fromarray(frame, 'RGBA')
+                elif frame.shape[2] == 1:
+                    pil_img = Image.fromarray(frame[:, :, 0], 'L')
                 else:
                     # 尝试直接转换
-                    pil_img = Image.fromarray(image_np)
-                
-                pil_img.save(temp_file.name)
-                
-            elif isinstance(img, Image.Image):
-                # 直接保存PIL图像
-                img.save(temp_file.name)
-            else:
-                raise ValueError(f"不支持的图像类型: {type(img)}")
-            
-            saved_paths.append(temp_file.name)
-            
-        except Exception as e:
-            print(f"{log_prefix} 保存图像时出错: {str(e)}")
-            # 如果出错，删除临时文件
-            if os.path.exists(temp_file.name):
-                try:
-                    os.remove(temp_file.name)
-                except:
-                    pass
-            raise e
+                    pil_img = Image.fromarray(frame)
+
+                with timed("encode", file=os.path.basename(temp_file.name)):
+                    pil_img.save(temp_file.name, **save_kwargs)
+                saved_paths.append(temp_file.name)
+
+            except Exception as e:
+                print(f"{log_prefix} 保存图像时出错: {str(e)}")
+                # 如果出错，删除本次及之前保存的临时文件
+                for path in saved_paths + [temp_file.name]:
+                    if os.path.exists(path):
+                        try:
+                            os.remove(path)
+                        except:
+                            pass
+                raise e
     
     return saved_paths
 
@@ -412,6 +746,50 @@ def load_images(file_paths):
         
     return images
 
+def decode_image_uint8(path):
+    """
+    解码图像文件为 uint8 的 [H, W, 3] numpy 数组 (应用 EXIF 方向并转换为 RGB)
+    """
+    with timed("decode", file=os.path.basename(path)), Image.open(path) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        return np.asarray(img)
+
+def copy_uint8_frame(out, index, frame):
+    """
+    将 uint8 帧原地写入预分配的 float32 批次张量的第 index 个切片并归一化到 0-1
+    """
+    if tuple(out.shape[1:]) != frame.shape:
+        raise TopazError(f"输出图像尺寸不一致: {frame.shape}, 预期: {tuple(out.shape[1:])}")
+    # 直接在张量内存上完成 uint8 -> float32 转换和缩放，不产生中间数组
+    with timed("decode_convert", frame=index):
+        np.divide(frame, np.float32(255.0), out=out[index].numpy())
+
+def load_images_to_tensor(file_paths):
+    """
+    将图像文件直接解码到一次性分配的 [B, H, W, 3] float32 张量中
+
+    第一张图像决定输出尺寸，之后每张图像解码后直接写入对应切片，不会生成
+    中间的 float32 副本，也不需要 torch.cat。
+
+    参数:
+        file_paths (list): 图像文件路径列表
+
+    返回:
+        torch.Tensor: [B, H, W, 3] float32 张量
+    """
+    if not file_paths:
+        raise TopazError("没有可加载的图像")
+
+    out = None
+    for i, path in enumerate(file_paths):
+        frame = decode_image_uint8(path)
+        if out is None:
+            out = torch.empty((len(file_paths),) + frame.shape, dtype=torch.float32)
+        copy_uint8_frame(out, i, frame)
+    return out
+
 def disable_topaz_image_cache():
     """禁用 Topaz Photo AI 的图像缓存"""
     # 这里简化实现
@@ -440,7 +818,8 @@ def test_and_clean_topaz(tpai_exe, clean_cache=False, verbose=True):
         "test_output": "",
         "cleaned_files": 0,
         "cache_size_before": 0,
-        "cache_size_after": 0
+        "cache_size_after": 0,
+        "cache_stats": None,
     }
     
     # 检查 tpai_exe 路径是否有效
@@ -450,35 +829,13 @@ def test_and_clean_topaz(tpai_exe, clean_cache=False, verbose=True):
             print(f"{log_prefix} {results['error_message']}")
         return results
     
-    # 获取缓存目录路径
-    cache_dir = ""
-    if platform.system() == "Windows":
-        cache_dir = os.path.expanduser("~/AppData/Local/Topaz Labs LLC/Topaz Photo AI/Cache")
-    elif platform.system() == "Darwin":  # macOS
-        cache_dir = os.path.expanduser("~/Library/Caches/Topaz Labs LLC/Topaz Photo AI")
-    elif platform.system() == "Linux":
-        cache_dir = os.path.expanduser("~/.cache/Topaz Labs LLC/Topaz Photo AI")
-    
-    # 检查缓存目录大小
-    if clean_cache and os.path.exists(cache_dir):
-        cache_size = sum(os.path.getsize(f) for f in glob.glob(os.path.join(cache_dir, '**/*'), recursive=True) if os.path.isfile(f))
-        results["cache_size_before"] = cache_size
-        if verbose:
-            print(f"{log_prefix} 缓存目录: {cache_dir}")
-            print(f"{log_prefix} 当前缓存大小: {cache_size/1024/1024:.2f} MB")
-    
     # 1. 执行 Topaz Photo AI 测试命令
     try:
         if verbose:
             print(f"{log_prefix} 尝试执行测试命令: {tpai_exe} --test")
         
         # 执行测试命令
-        result = subprocess.run(f'"{tpai_exe}" --test', 
-                               shell=True, 
-                               capture_output=True, 
-                               text=True, 
-                               encoding='utf-8', 
-                               errors='ignore')
+        result = run_tpai([tpai_exe, '--test'], timeout=300)
         
         results["test_output"] = result.stdout
         if result.stderr:
@@ -505,104 +862,83 @@ def test_and_clean_topaz(tpai_exe, clean_cache=False, verbose=True):
         if verbose:
             print(f"{log_prefix} {results['error_message']}")
     
-    # 2. 如果请求清理缓存
-    if clean_cache and os.path.exists(cache_dir):
-        try:
-            if verbose:
-                print(f"{log_prefix} 开始清理缓存目录: {cache_dir}")
-            
-            # 获取要删除的文件列表
-            files_to_delete = []
-            for file_pattern in ["*.tmp", "*.cache", "temp_*", "*.log"]:
-                files_to_delete.extend(glob.glob(os.path.join(cache_dir, file_pattern)))
-                files_to_delete.extend(glob.glob(os.path.join(cache_dir, "**", file_pattern), recursive=True))
-            
-            # 删除文件
-            cleaned_count = 0
-            for file_path in files_to_delete:
-                try:
-                    if os.path.isfile(file_path):
-                        os.remove(file_path)
-                        cleaned_count += 1
-                        if verbose and cleaned_count % 10 == 0:  # 每清理10个文件记录一次
-                            print(f"{log_prefix} 已清理 {cleaned_count} 个缓存文件...")
-                except Exception as e:
-                    if verbose:
-                        print(f"{log_prefix} 无法删除文件 {file_path}: {str(e)}")
-            
-            results["cleaned_files"] = cleaned_count
-            
-            # 计算清理后的缓存大小
-            if os.path.exists(cache_dir):
-                cache_size_after = sum(os.path.getsize(f) for f in glob.glob(os.path.join(cache_dir, '**/*'), recursive=True) if os.path.isfile(f))
-                results["cache_size_after"] = cache_size_after
-                
-                if verbose:
-                    print(f"{log_prefix} 清理完成! 删除了 {cleaned_count} 个文件")
-                    print(f"{log_prefix} 清理前缓存大小: {results['cache_size_before']/1024/1024:.2f} MB")
-                    print(f"{log_prefix} 清理后缓存大小: {cache_size_after/1024/1024:.2f} MB")
-                    print(f"{log_prefix} 节省空间: {(results['cache_size_before'] - cache_size_after)/1024/1024:.2f} MB")
-        
-        except Exception as e:
+    # 2. 缓存统计: 使用后台清理线程维护的索引，清理时直接在索引上挑选文件，不遍历缓存目录
+    janitor = get_janitor()
+    try:
+        if clean_cache:
             if verbose:
-                print(f"{log_prefix} 清理缓存时出错: {str(e)}")
-    
+                print(f"{log_prefix} 开始清理缓存目录: {janitor.cache_dir}")
+            stats = janitor.clean(clean_temp=True)
+        else:
+            stats = janitor.stats()
+    except Exception as e:
+        stats = None
+        if verbose:
+            print(f"{log_prefix} 清理缓存时出错: {str(e)}")
+
+    if stats and stats["status"] == "not_scanned":
+        # 后台线程还没有完成首次遍历，大小未知而不是 0
+        results["cache_size_before"] = None
+        results["cache_size_after"] = None
+        results["cache_stats"] = stats
+        if verbose:
+            print(f"{log_prefix} 缓存目录 {stats['cache_dir']} 尚未完成首次遍历，后台线程正在统计" +
+                  ("，遍历完成后清理临时文件" if clean_cache else ""))
+    elif stats:
+        results["cleaned_files"] = stats["removed_files"]
+        results["cache_size_before"] = stats["size_before"]
+        results["cache_size_after"] = stats["size_after"]
+        results["cache_stats"] = stats
+        if verbose:
+            print(f"{log_prefix} 缓存目录: {stats['cache_dir']} ({stats['files']} 个文件, 最近一次遍历耗时 {stats['scan_seconds']:.2f} 秒)")
+            print(f"{log_prefix} 清理前缓存大小: {stats['size_before']/1024/1024:.2f} MB")
+            print(f"{log_prefix} 清理后缓存大小: {stats['size_after']/1024/1024:.2f} MB")
+            if clean_cache:
+                print(f"{log_prefix} 清理完成! 删除了 {stats['removed_files']} 个文件, 节省空间: {stats['removed_bytes']/1024/1024:.2f} MB")
+
     return results
 
-def find_output_file(input_path, output_folder, output_format):
+def autopilot_for_frames(tpai_exe, images, use_cache=True):
     """
-    查找 Topaz 处理后的输出文件。
-    Topaz 可能使用不同的命名规则，所以我们需要尝试多种方式。
-    
+    计算每帧的 Autopilot 设置，结果按图像内容缓存
+
     参数:
-        input_path (str): 原始输入文件路径
-        output_folder (str): 输出文件夹
-        output_format (str): 输出文件格式
-        
+        tpai_exe (str): 用户指定的 tpai 路径
+        images (torch.Tensor): [B, H, W, C] 图像
+        use_cache (bool): 是否使用 Autopilot 设置缓存
+
     返回:
-        str: 找到的输出文件路径，如果未找到则返回 None
+        list: 每帧的设置 (分析失败的帧为 None)
     """
-    # 方法1：使用相同的文件名（不含扩展名）
-    base_name = os.path.basename(input_path)
-    name_without_ext = os.path.splitext(base_name)[0]
-    
-    # 尝试找到确切匹配的文件
-    exact_match = os.path.join(output_folder, f"{name_without_ext}.{output_format}")
-    if os.path.exists(exact_match):
-        return exact_match
-    
-    # 方法2：使用相同文件名的任何可能变体
-    possible_matches = glob.glob(os.path.join(output_folder, f"{name_without_ext}*.{output_format}"))
-    if possible_matches:
-        # 按修改时间排序，返回最新的
-        possible_matches.sort(key=os.path.getmtime, reverse=True)
-        return possible_matches[0]
-    
-    # 方法3：返回最新创建的任何输出格式文件
-    all_files = []
-    for ext in ["jpg", "jpeg", "png", "tif", "tiff"]:
-        all_files.extend(glob.glob(os.path.join(output_folder, f"*.{ext}")))
-    
-    if all_files:
-        # 按修改时间排序，返回最新的
-        all_files.sort(key=os.path.getmtime, reverse=True)
-        return all_files[0]
-    
-    # 方法4：捕获任何文件
-    all_files = glob.glob(os.path.join(output_folder, "*"))
-    if all_files:
-        # 按修改时间排序，返回最新的
-        all_files.sort(key=os.path.getmtime, reverse=True)
-        return all_files[0]
-    
-    # 找不到任何文件
-    return None
+    tpai_exe, version = init_topaz(tpai_exe)
+    cache = get_autopilot_cache() if use_cache else None
+
+    keys = [make_cache_key(frame, {"autopilot": True}, version) for frame in images]
+    settings = [cache.get(key) for key in keys] if cache else [None] * len(images)
+    pending = [i for i, value in enumerate(settings) if value is None]
+
+    if pending:
+        work_dir = make_work_dir(estimate_footprint(images, output_scale=0), prefix="autopilot_input_")
+        try:
+            pending_images = images if len(pending) == len(images) else images[pending]
+            input_paths = save_images(pending_images, output_dir=work_dir)
+            for i, value in zip(pending, analyze_autopilot(tpai_exe, input_paths)):
+                settings[i] = value
+                if cache and value is not None:
+                    cache.put(keys[i], value)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"{log_prefix} Autopilot 设置: 分析 {len(pending)} 个, 缓存命中 {len(images) - len(pending)} 个")
+    return settings
 
 # 简化的 ComfyTopazPhoto 类
 class ComfyTopazPhoto:
     def __init__(self):
         # 不再自动查找可执行文件，而是在 process_images 方法中使用用户提供的路径
         self.tpai_version = "未知版本"
+        # 设置了 worker_urls 时由远程 worker 处理
+        self.worker_pool = None
     
     @classmethod
     def INPUT_TYPES(cls):
@@ -610,132 +946,432 @@ class ComfyTopazPhoto:
             "required": {
                 "images": ("IMAGE",),
                 "tpai_exe": ("STRING", {"default": "C:\\Program Files\\Topaz Labs LLC\\Topaz Photo AI\\tpai.exe"}),
-                "output_format": (["jpg", "png", "tif", "tiff", "preserve"], {"default": "jpg"}),
+                "output_format": (["auto", "jpg", "png", "tif", "tiff", "preserve"], {"default": "auto"}),
                 "quality": ("INT", {"default": 95, "min": 0, "max": 100, "step": 1}),
                 "overwrite": (["True", "False"], {"default": "False"}),
             },
             "optional": {
                 "output_prefix": ("STRING", {"default": "topaz_", "multiline": False}),
+                "execution_mode": (["batch", "parallel", "pipeline", "sequential"], {"default": "batch"}),
+                "max_workers": ("INT", {"default": 2, "min": 1, "max": 64, "step": 1}),
+                "use_cache": (["True", "False"], {"default": "True"}),
+                "staging_format": (list(STAGING_FORMATS.keys()), {"default": DEFAULT_STAGING_FORMAT}),
+                "staging_dir": ("STRING", {"default": "", "multiline": False}),
+                "autopilot_settings": ("STRING", {"forceInput": True}),
+                "tile_size": ("INT", {"default": 0, "min": 0, "max": 16384, "step": 64}),
+                "tile_overlap": ("INT", {"default": 64, "min": 0, "max": 2048, "step": 8}),
+                "dedup": (["exact", "perceptual", "off"], {"default": "exact"}),
+                "dedup_threshold": ("FLOAT", {"default": 0.01, "min": 0.0, "max": 1.0, "step": 0.001}),
+                "metrics_file": ("STRING", {"default": "", "multiline": False}),
+                "priority": (list(PRIORITIES.keys()), {"default": "normal"}),
+                "worker_urls": ("STRING", {"default": "", "multiline": False}),
             },
         }
     
-    RETURN_TYPES = ("IMAGE",)
+    RETURN_TYPES = ("IMAGE", "STRING")
+    RETURN_NAMES = ("images", "metrics")
     FUNCTION = "process_images"
     CATEGORY = "ComfyTopazPhoto"
+
+    @classmethod
+    def IS_CHANGED(cls, images=None, tpai_exe="", **kwargs):
+        """输出只取决于像素、设置和 tpai 版本，三者不变时 ComfyUI 复用上次的输出"""
+        version = fingerprint_version(tpai_exe, kwargs.get("worker_urls", ""))
+        return node_fingerprint(images, tpai_exe, version, **kwargs)
     
-    def process_images(self, images, tpai_exe, output_format="jpg", quality=95, overwrite="False", output_prefix="topaz_"):
-        """处理图像"""
+    @staticmethod
+    def _parse_autopilot_settings(autopilot_settings, count):
+        """
+        解析 Autopilot 分析节点输出的设置
+
+        返回:
+            list: 每帧一个 JSON 字符串 (或 None)，未提供设置时返回 None
+        """
+        if not autopilot_settings:
+            return None
+        value = json.loads(autopilot_settings)
+        if not isinstance(value, list):
+            value = [value]
+        if len(value) == 1:
+            value = value * count
+        if len(value) != count:
+            raise TopazError(f"Autopilot 设置数量 ({len(value)}) 与图像数量 ({count}) 不一致")
+        return [v if v is None or isinstance(v, str) else json.dumps(v, sort_keys=True) for v in value]
+
+    def _run_topaz(self, input_paths, output_folder, output_format, quality, overwrite, execution_mode, max_workers, settings=None):
+        """按执行模式调用 Topaz Photo AI 处理图像，设置了 worker 时交给远程 worker 处理"""
+        if self.worker_pool is not None:
+            try:
+                return self.worker_pool.process(input_paths, output_folder, output_format, quality, settings)
+            except WorkerError as e:
+                raise TopazError(str(e))
+        return process_topaz_paths(self.tpai_exe, input_paths, output_folder, output_format, quality, overwrite,
+                                   execution_mode, max_workers, settings)
+
+    def _process_pipeline(self, images, pending, output_paths, cache, cache_keys, output_folder, output_format, quality, overwrite, file_prefix, staging_format, frame_settings):
+        """
+        流水线处理未命中缓存的帧
+
+        第 i+1 帧编码和第 i-1 帧解码在后台线程中进行，同时 tpai 处理第 i 帧。
+        已缓存的帧 (output_paths 中非 None 的项) 在流水线结束后解码，
+        新处理的帧在解码时把输出路径填回 output_paths。
+
+        返回:
+            torch.Tensor: [B, H, W, 3] float32 张量
+        """
+        staging_folder = os.path.join(output_folder, "pipeline_input")
+        os.makedirs(staging_folder, exist_ok=True)
+        state = {"result": None}
+
+        def store(i, path):
+            frame = decode_image_uint8(path)
+            if state["result"] is None:
+                state["result"] = torch.empty((len(images),) + frame.shape, dtype=torch.float32)
+            copy_uint8_frame(state["result"], i, frame)
+
+        def encode(i):
+            return i, save_images(images[i], file_prefix=file_prefix, output_dir=staging_folder, staging_format=staging_format)[0]
+
+        def process(staged):
+            i, input_path = staged
+            try:
+                settings = frame_settings[i] if frame_settings else None
+                return process_topaz_image(self.tpai_exe, [input_path], output_folder, output_format, quality, overwrite, settings)[0]
+            finally:
+                os.remove(input_path)
+
+        def decode(i, output_path):
+            # 先从暂存目录解码，再把输出加入磁盘缓存
+            store(i, output_path)
+            output_paths[i] = output_path
+            if cache:
+                cache.put(cache_keys[i], output_path)
+
+        cached = [i for i, path in enumerate(output_paths) if path is not None]
+        run_pipeline(pending, encode, process, decode)
+
+        for i in cached:
+            store(i, output_paths[i])
+        return state["result"]
+
+    def _process_tiled(self, images, tpai_exe, output_format, quality, overwrite, output_prefix, execution_mode, max_workers,
+                       use_cache, staging_format, staging_dir, autopilot_settings, tile_size, tile_overlap):
+        """将大图切分为重叠的分块分别处理，再羽化混合拼回完整图像"""
+        # 重叠必须小于分块大小的一半，节点的默认值 (64) 与较小的分块大小组合时自动收窄
+        max_overlap = tile_size // 2 - 1
+        if tile_overlap > max_overlap:
+            print(f"{log_prefix} 分块重叠 {tile_overlap} 不小于分块大小 {tile_size} 的一半，改为 {max_overlap}")
+            tile_overlap = max_overlap
+        tiles, layout = split_tiles(images, tile_size, tile_overlap)
+        tile_count = len(layout["boxes"])
+        print(f"{log_prefix} 分块处理: 每帧 {tile_count} 个分块, 分块大小 {layout['tile']}, 重叠 {tile_overlap}")
+
+        # 每个分块沿用所属帧的 Autopilot 设置。没有连接 Autopilot 分析节点时先分析完整的帧，
+        # 否则 Autopilot 会为每个分块单独选择降噪、锐化和放大倍数，产生接缝甚至分块大小不一致
+        frame_settings = self._parse_autopilot_settings(autopilot_settings, len(images))
+        if frame_settings is None:
+            if self.worker_pool is not None:
+                print(f"{log_prefix} 警告: 远程模式下不分析整帧的 Autopilot 设置，建议连接 Topaz Autopilot Analysis 节点")
+            else:
+                frame_settings = self._parse_autopilot_settings(
+                    json.dumps(autopilot_for_frames(tpai_exe, images, use_cache == "True")), len(images))
+        tile_settings = None
+        if frame_settings:
+            tile_settings = json.dumps([value for value in frame_settings for _ in range(tile_count)])
+
+        # 分块之间相互独立，batch 模式下改为 parallel，由多个 tpai 进程同时处理
+        tile_mode = "parallel" if execution_mode == "batch" else execution_mode
+        processed = self._process_images(tiles, tpai_exe, output_format, quality, overwrite, output_prefix, tile_mode, max_workers,
+                                         use_cache, staging_format, staging_dir, tile_settings, tile_size=0)
+
+        result = merge_tiles(processed, layout)
+        print(f"{log_prefix} 分块合并后图像形状: {result.shape}")
+        return result
+
+    def process_images(self, images, tpai_exe, output_format="auto", quality=95, overwrite="False", output_prefix="topaz_", execution_mode="batch", max_workers=2, use_cache="True", staging_format=DEFAULT_STAGING_FORMAT, staging_dir="", autopilot_settings=None, tile_size=0, tile_overlap=64, dedup="exact", dedup_threshold=0.01, metrics_file="", priority="normal", worker_urls=""):
+        """处理图像，同时返回各阶段耗时的 JSON 统计"""
+        # worker_urls 非空时 tpai 在这些 worker 上运行，本机不需要安装 Topaz
+        self.worker_pool = get_worker_pool(parse_worker_urls(worker_urls)) if worker_urls.strip() else None
+        timer = StageTimer(node="ComfyTopazPhoto", frames=len(images), execution_mode=execution_mode)
+        # 同一次调用中的所有 tpai 调用共享一个熔断器，并以相同的优先级和所属者排队
+        with activate(timer), track(len(images)), breaker_scope(), job_context(priority):
+            result = self._process_images(images, tpai_exe, output_format, quality, overwrite, output_prefix, execution_mode, max_workers,
+                                          use_cache, staging_format, staging_dir, autopilot_settings, tile_size, tile_overlap, dedup, dedup_threshold)
+
+        summary = timer.summary()
+        summary["scheduler"] = get_scheduler().stats()
+        if self.worker_pool is not None:
+            summary["workers"] = self.worker_pool.stats()
+        if metrics_file:
+            try:
+                append_jsonl(metrics_file, summary)
+            except OSError as e:
+                print(f"{log_prefix} 写入统计文件失败: {metrics_file}, 错误: {str(e)}")
+        print(f"{log_prefix} 总耗时 {summary['total_seconds']:.3f} 秒, 各阶段: " +
+              ", ".join(f"{name} {stats['total_seconds']:.3f}s" for name, stats in summary["stages"].items()))
+        return (result, json.dumps(summary, ensure_ascii=False))
+
+    def _process_images(self, images, tpai_exe, output_format="auto", quality=95, overwrite="False", output_prefix="topaz_", execution_mode="batch", max_workers=2, use_cache="True", staging_format=DEFAULT_STAGING_FORMAT, staging_dir="", autopilot_settings=None, tile_size=0, tile_overlap=64, dedup="exact", dedup_threshold=0.01, digests=None):
+        """
+        处理图像，返回处理后的张量
+
+        digests 为调用方已计算的每帧内容摘要 (去重时计算)，用于缓存键，避免再次哈希像素
+        """
+        # 重复帧只处理一次，结果再分发到每个重复的位置
+        if dedup != "off" and len(images) > 1:
+            frame_settings = self._parse_autopilot_settings(autopilot_settings, len(images))
+            unique, inverse, digests = find_duplicates(images, dedup_threshold if dedup == "perceptual" else 0.0, frame_settings, digests)
+            if len(unique) < len(images):
+                print(f"{log_prefix} 去重: {len(images)} 帧中有 {len(unique)} 个唯一帧")
+                unique_settings = json.dumps([frame_settings[i] for i in unique]) if frame_settings else None
+                result = self._process_images(images[unique], tpai_exe, output_format, quality, overwrite, output_prefix, execution_mode,
+                                              max_workers, use_cache, staging_format, staging_dir, unique_settings,
+                                              tile_size, tile_overlap, dedup="off", digests=[digests[i] for i in unique])
+                return result[inverse]
+
+        # 超过分块大小的图像按分块处理
+        if tile_size and max(images.shape[1:3]) > tile_size:
+            return self._process_tiled(images, tpai_exe, output_format, quality, overwrite, output_prefix, execution_mode, max_workers,
+                                       use_cache, staging_format, staging_dir, autopilot_settings, tile_size, tile_overlap)
+
         # 将字符串转换为布尔值
         overwrite = (overwrite == "True")
+        use_cache = (use_cache == "True")
         
-        # 验证 tpai_exe 路径
-        try:
+        # 验证 tpai_exe 路径 (远程模式下使用 worker 的版本)
+        if self.worker_pool is not None:
+            try:
+                self.tpai_exe, self.tpai_version = None, self.worker_pool.version()
+            except WorkerError as e:
+                raise TopazError(str(e))
+            print(f"{log_prefix} 使用远程 Topaz worker: {[w.url for w in self.worker_pool.healthy_workers()]} (版本: {self.tpai_version})")
+        else:
             self.tpai_exe, self.tpai_version = init_topaz(tpai_exe)
             print(f"{log_prefix} 使用 Topaz Photo AI: {self.tpai_exe} (版本: {self.tpai_version})")
-        except TopazError as e:
-            raise e
-        
-        # 创建临时输出文件夹
-        output_folder = tempfile.mkdtemp(prefix="topaz_output_")
-        input_paths = []  # 初始化为空列表
-        
+
+        # 打印输入图像信息用于调试
+        print(f"{log_prefix} 输入图像形状: {images.shape}")
+
+        # 来自 Autopilot 分析节点的每帧设置
+        frame_settings = self._parse_autopilot_settings(autopilot_settings, len(images))
+
+        cache = get_result_cache() if use_cache else None
+        cache_settings = {"output_format": output_format, "quality": quality}
+        cache_keys = None
+        if cache:
+            cache_keys = [
+                make_cache_key(frame, {**cache_settings, "settings": frame_settings[i] if frame_settings else None}, self.tpai_version,
+                               digests[i] if digests else None)
+                for i, frame in enumerate(images)
+            ]
+            # 所有帧都在内存缓存中时直接拼接返回，不创建工作目录也不读取任何文件
+            frames = [cache.get_frame(key) for key in cache_keys]
+            if all(frame is not None for frame in frames) and len({frame.shape for frame in frames}) == 1:
+                tracker = current_progress()
+                if tracker:
+                    tracker.advance(len(images))
+                print(f"{log_prefix} 结果缓存: 全部 {len(images)} 帧命中内存缓存")
+                return torch.stack(frames)
+
+        # 在进程级暂存目录 (优先使用内存文件系统) 中创建本次调用的工作目录
+        work_dir = make_work_dir(estimate_footprint(images), staging_dir or None, prefix="topaz_")
+        input_folder = os.path.join(work_dir, "input")
+        output_folder = os.path.join(work_dir, "output")
+        os.makedirs(input_folder)
+        os.makedirs(output_folder)
+
         try:
-            # 打印输入图像信息用于调试
-            print(f"{log_prefix} 输入图像形状: {images.shape}")
-            
-            # 保存输入图像到临时文件
+            # 查询结果缓存，只有未命中的帧才交给 Topaz 处理
+            if cache:
+                output_paths = [cache.get(key) for key in cache_keys]
+            else:
+                output_paths = [None] * len(images)
+            pending = [i for i, path in enumerate(output_paths) if path is None]
+
+            # 去重或分块后实际处理的图像数可能与节点输入不同
+            tracker = current_progress()
+            if tracker:
+                tracker.set_total(len(images))
+                tracker.advance(len(images) - len(pending))
+
+            result = None
+            uncached = []  # 解码后再加入磁盘缓存的 (帧序号, 输出路径)
             timestamp = int(time.time())
             file_prefix = f"{output_prefix}{timestamp}_"
-            input_paths = save_images(images, file_prefix=file_prefix)
-            print(f"{log_prefix} 已保存输入图像到: {input_paths}")
-            
-            # 调用 Topaz Photo AI 处理图像
-            output_paths = process_topaz_image(
-                self.tpai_exe, 
-                input_paths, 
-                output_folder, 
-                output_format, 
-                quality, 
-                overwrite
-            )
+            if pending and execution_mode == "pipeline" and self.worker_pool is None:
+                # 流水线模式 (远程模式下按整批发送): 编码、Topaz 处理和解码在不同线程中重叠执行
+                result = self._process_pipeline(images, pending, output_paths, cache, cache_keys,
+                                                output_folder, output_format, quality, overwrite, file_prefix, staging_format, frame_settings)
+            elif pending:
+                # 保存输入图像到临时文件
+                pending_images = images if len(pending) == len(images) else images[pending]
+                input_paths = save_images(pending_images, file_prefix=file_prefix, output_dir=input_folder, staging_format=staging_format)
+                print(f"{log_prefix} 已保存输入图像到: {input_paths}")
+
+                pending_settings = [frame_settings[i] for i in pending] if frame_settings else None
+                processed_paths = self._run_topaz(input_paths, output_folder, output_format, quality, overwrite, execution_mode, max_workers, pending_settings)
+                if len(processed_paths) != len(pending):
+                    raise TopazError(f"输出数量 ({len(processed_paths)}) 与输入数量 ({len(pending)}) 不一致")
+
+                for i, path in zip(pending, processed_paths):
+                    output_paths[i] = path
+                uncached = list(zip(pending, processed_paths))
+
+            if cache:
+                print(f"{log_prefix} 结果缓存: 本次命中 {len(images) - len(pending)}/{len(images)}, 统计: {cache.stats()}")
             
             print(f"{log_prefix} 处理后图像路径: {output_paths}")
             
             # 如果没有处理任何图像，返回原图
-            if not output_paths:
-                print(f"{log_prefix} 警告: 没有成功处理任何图像，返回原图")
-                return (images,)
-            
-            # 直接使用参考代码中的图像加载方法
-            upscaled_images = []
-            for upscaled_path in output_paths:
-                try:
-                    # 打开图像，应用EXIF方向
-                    img = Image.open(upscaled_path)
-                    img = ImageOps.exif_transpose(img)
-                    img = img.convert('RGB')  # 确保是RGB模式
-                    
-                    # 转换为numpy数组，再转为PyTorch格式
-                    img_np = np.array(img).astype(np.float32) / 255.0
-                    # 添加批次维度 [H, W, C] -> [1, H, W, C]
-                    img_tensor = torch.from_numpy(img_np)[None,]  
-                    
-                    upscaled_images.append(img_tensor)
-                    print(f"{log_prefix} 成功加载处理后图像: {upscaled_path}, 形状: {img_tensor.shape}")
-                except Exception as e:
-                    print(f"{log_prefix} 加载图像失败: {upscaled_path}, 错误: {str(e)}")
+            if any(path is None for path in output_paths):
+                print(f"{log_prefix} 警告: 有图像没有得到处理结果，返回原图")
+                return images
             
-            # 如果没有成功加载任何图像，返回原图
-            if not upscaled_images:
-                print(f"{log_prefix} 警告: 没有成功加载任何处理后的图像，返回原图")
-                return (images,)
-            
-            # 如果有多个图像，合并为一个批次
-            if len(upscaled_images) > 1:
-                # 合并所有张量为一个批次
-                result = torch.cat(upscaled_images, dim=0)
-            else:
-                # 只有一个图像，直接返回
-                result = upscaled_images[0]
-                
+            # 直接解码到预分配的批次张量中
+            if result is None:
+                result = load_images_to_tensor(output_paths)
+            if cache:
+                # 从暂存目录解码之后再把新的输出加入磁盘缓存 (流水线模式在解码线程中加入)
+                for i, path in uncached:
+                    cache.put(cache_keys[i], path)
+                if cache.memory_max_bytes:
+                    for i, key in enumerate(cache_keys):
+                        cache.put_frame(key, result[i])
             print(f"{log_prefix} 最终输出图像形状: {result.shape}")
-            return (result,)
+            return result
         
         except Exception as e:
+            # 用户取消时交给 ComfyUI 处理，不返回原图
+            if is_interrupt(e):
+                print(f"{log_prefix} 处理已取消")
+                raise
             print(f"{log_prefix} 处理图像时出错: {str(e)}")
             # 如果出错，返回原图
-            return (images,)
+            return images
             
         finally:
-            # 清理临时文件
+            # 清理本次调用的工作目录 (进程级暂存目录保留复用)
             try:
-                # 清理输入临时文件
-                for path in input_paths:
-                    if os.path.exists(path):
-                        try:
-                            os.remove(path)
-                            print(f"{log_prefix} 已删除临时输入文件: {path}")
-                        except Exception as e:
-                            print(f"{log_prefix} 清理临时输入文件失败: {path}, 错误: {str(e)}")
-                
-                # 清理临时输出文件夹
-                if os.path.exists(output_folder):
-                    try:
-                        shutil.rmtree(output_folder)
-                        print(f"{log_prefix} 已删除临时输出文件夹: {output_folder}")
-                    except Exception as e:
-                        print(f"{log_prefix} 清理临时输出文件夹失败: {output_folder}, 错误: {str(e)}")
+                shutil.rmtree(work_dir)
             except Exception as e:
-                print(f"{log_prefix} 清理临时文件失败: {str(e)}")
+                print(f"{log_prefix} 清理临时工作目录失败: {work_dir}, 错误: {str(e)}")
+
+# Autopilot 分析节点
+class ComfyTopazPhotoAutopilot:
+    """只计算 Autopilot 设置而不渲染，结果按图像内容缓存"""
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "images": ("IMAGE",),
+                "tpai_exe": ("STRING", {"default": "C:\\Program Files\\Topaz Labs LLC\\Topaz Photo AI\\tpai.exe"}),
+            },
+            "optional": {
+                "use_cache": (["True", "False"], {"default": "True"}),
+            },
+        }
+
+    RETURN_TYPES = ("IMAGE", "STRING")
+    RETURN_NAMES = ("images", "autopilot_settings")
+    FUNCTION = "analyze"
+    CATEGORY = "ComfyTopazPhoto"
+
+    @classmethod
+    def IS_CHANGED(cls, images=None, tpai_exe="", **kwargs):
+        return node_fingerprint(images, tpai_exe, fingerprint_version(tpai_exe), **kwargs)
+
+    def analyze(self, images, tpai_exe, use_cache="True"):
+        """分析图像的 Autopilot 设置，返回原图和每帧设置的 JSON 列表"""
+        with job_context():
+            settings = autopilot_for_frames(tpai_exe, images, use_cache == "True")
+        return (images, json.dumps(settings))
+
+# 序列处理节点
+class ComfyTopazPhotoSequence:
+    """分块流式处理长图像序列，结果直接写入输出目录，可在中断后续传"""
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "input_dir": ("STRING", {"default": "", "multiline": False}),
+                "output_dir": ("STRING", {"default": "", "multiline": False}),
+                "tpai_exe": ("STRING", {"default": "C:\\Program Files\\Topaz Labs LLC\\Topaz Photo AI\\tpai.exe"}),
+                "output_format": (["png", "jpg", "tif", "tiff", "preserve", "auto"], {"default": "png"}),
+                "quality": ("INT", {"default": 95, "min": 0, "max": 100, "step": 1}),
+            },
+            "optional": {
+                "images": ("IMAGE",),
+                "chunk_size": ("INT", {"default": 16, "min": 1, "max": 1024, "step": 1}),
+                "execution_mode": (["batch", "parallel"], {"default": "batch"}),
+                "max_workers": ("INT", {"default": 2, "min": 1, "max": 64, "step": 1}),
+                "resume": (["True", "False"], {"default": "True"}),
+                "staging_dir": ("STRING", {"default": "", "multiline": False}),
+                "priority": (list(PRIORITIES.keys()), {"default": "low"}),
+            },
+        }
+
+    RETURN_TYPES = ("STRING", "INT")
+    RETURN_NAMES = ("output_dir", "frame_count")
+    FUNCTION = "process_sequence"
+    CATEGORY = "ComfyTopazPhoto"
+    OUTPUT_NODE = True
+
+    def process_sequence(self, input_dir, output_dir, tpai_exe, output_format="png", quality=95, images=None, chunk_size=16,
+                         execution_mode="batch", max_workers=2, resume="True", staging_dir="", priority="low"):
+        """处理图像序列"""
+        if not output_dir:
+            raise TopazError("必须指定输出目录")
+        tpai_exe, version = init_topaz(tpai_exe)
+
+        # 连接了 images 时处理张量中的帧，否则从输入目录按帧序惰性读取文件
+        if images is not None:
+            frames = ((f"frame_{i:06d}", images[i]) for i in range(len(images)))
+        else:
+            # 输出目录位于输入目录中时，输出文件会在下次运行时被当作输入帧
+            input_root = os.path.realpath(input_dir)
+            output_root = os.path.realpath(output_dir)
+            try:
+                nested = os.path.commonpath([input_root, output_root]) == input_root
+            except ValueError:  # Windows 上位于不同的驱动器
+                nested = False
+            if nested:
+                raise TopazError(f"输出目录不能是输入目录或位于输入目录中: {output_dir}")
+            frames = list_frames(input_dir)
+
+        def process_chunk(sources, work_dir):
+            # 目录中的帧直接以文件交给 tpai，不经过解码
+            input_paths = [source if isinstance(source, str) else None for source in sources]
+            tensors = [source for source in sources if not isinstance(source, str)]
+            if tensors:
+                saved = iter(save_images(torch.stack(tensors), output_dir=work_dir))
+                input_paths = [path or next(saved) for path in input_paths]
+
+            output_folder = os.path.join(work_dir, "output")
+            os.makedirs(output_folder)
+            if execution_mode == "parallel":
+                return process_topaz_parallel(tpai_exe, input_paths, output_folder, output_format, quality, True, max_workers)
+            return process_topaz_batch(tpai_exe, input_paths, output_folder, output_format, quality, True)
+
+        settings = {"output_format": output_format, "quality": quality, "tpai_version": version}
+        with breaker_scope(), job_context(priority):
+            stats = process_sequence(frames, output_dir, process_chunk, chunk_size, resume == "True", settings, staging_dir or None)
+        print(f"{log_prefix} 序列处理完成: 处理 {stats['processed']} 帧, 跳过已完成的 {stats['skipped']} 帧, 输出目录: {output_dir}")
+        return (output_dir, stats["processed"] + stats["skipped"])
 
 # 节点类映射
 NODE_CLASS_MAPPINGS = {
     "ComfyTopazPhoto": ComfyTopazPhoto,
+    "ComfyTopazPhotoAutopilot": ComfyTopazPhotoAutopilot,
+    "ComfyTopazPhotoSequence": ComfyTopazPhotoSequence,
 }
 
 # 节点显示名称映射
 NODE_DISPLAY_NAME_MAPPINGS = {
     "ComfyTopazPhoto": "Topaz Photo AI",
+    "ComfyTopazPhotoAutopilot": "Topaz Autopilot Analysis",
+    "ComfyTopazPhotoSequence": "Topaz Photo AI Sequence",
 }
 
 # 初始化和测试函数 - 现在作为一个可调用的函数而不是自动执行
@@ -2,12 +2,21 @@ import os
 import numpy as np
 import torch
 import json
-import subprocess
 import tempfile
 import time
 from PIL import Image
 import folder_paths # Ensure this import is correct and folder_paths is accessible
-import shutil # Added for fallback copy
+import shutil
+
+from .cli import TPAI_ERROR_CODES, TpaiOutputParser, build_tpai_argv, format_argv, run_tpai
+from .fingerprint import node_fingerprint
+from .progress import is_interrupt, track
+from .scheduler import job_context
+from .staging import estimate_footprint, make_work_dir
+from .topaz import (
+    output_stems, resolve_outputs, copy_uint8_frame, load_images_to_tensor, fingerprint_version,
+    STAGING_FORMATS, DEFAULT_STAGING_FORMAT,
+)
 
 # Simplified Upscale Settings Node
 class ComfyTopazPhotoUpscaleSettings:
@@ -96,6 +105,8 @@ class ComfyTopazPhoto:
                 "upscale": ("TOPAZ_UPSCALESETTINGS",),
                 "sharpen": ("TOPAZ_SHARPENSETTINGS",),
                 "face_recovery": ("TOPAZ_FACERECOVERYSETTINGS",),
+                "batch_mode": ("BOOLEAN", {"default": True}),
+                "staging_format": (list(STAGING_FORMATS.keys()), {"default": DEFAULT_STAGING_FORMAT}),
             }
         }
 
@@ -103,19 +114,56 @@ class ComfyTopazPhoto:
     FUNCTION = "process"
     CATEGORY = "ComfyTopazPhoto"
 
-    def process(self, images, tpai_exe, compression, upscale=None, sharpen=None, face_recovery=None):
+    @classmethod
+    def IS_CHANGED(s, images=None, tpai_exe="", **kwargs):
+        # Output depends only on pixels, settings and the tpai binary and version; a sampled
+        # fingerprint lets ComfyUI reuse the cached result without hashing the whole batch
+        return node_fingerprint(images, tpai_exe, fingerprint_version(tpai_exe), **kwargs)
+
+    @staticmethod
+    def _build_filters(upscale, sharpen, face_recovery):
+        # Build filters JSON (Simplified logic)
+        filters = {}
+        if upscale and upscale.get("enabled", False):
+            filters[upscale.get("module", "enhance")] = {} # Use Autopilot settings
+        if sharpen and sharpen.get("enabled", False):
+            filters[sharpen.get("module", "sharpen")] = {} # Use Autopilot settings
+        if face_recovery and face_recovery.get("enabled", False):
+            filters[face_recovery.get("module", "faceRecover")] = {} # Use Autopilot settings
+        return filters
+
+    def process(self, images, tpai_exe, compression, upscale=None, sharpen=None, face_recovery=None, batch_mode=True, staging_format=DEFAULT_STAGING_FORMAT):
         if not tpai_exe or not os.path.exists(tpai_exe):
             raise ValueError("[ComfyTopazPhoto] Error: tpai.exe path is not valid or not provided.")
 
-        batch_results = []
+        filters = self._build_filters(upscale, sharpen, face_recovery)
+        if not filters:
+            # Nothing for tpai to do: pass the input through without encoding or touching disk
+            print("[ComfyTopazPhoto] Warning: No Topaz filters enabled. Returning original images.")
+            return (images[..., :3], "{}", "N/A")
+
+        # Per-call work dir inside the long-lived staging dir (RAM-backed when possible)
+        work_dir = make_work_dir(estimate_footprint(images), prefix="topaz_")
+        try:
+            # Reports per-image progress to ComfyUI's progress bar; tpai launches queue
+            # in the process-wide scheduler under this prompt
+            with track(len(images)), job_context():
+                if batch_mode and len(images) > 1:
+                    return self._process_batch(images, tpai_exe, compression, filters, staging_format, work_dir)
+                return self._process_sequential(images, tpai_exe, compression, filters, staging_format, work_dir)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def _process_sequential(self, images, tpai_exe, compression, filters, staging_format, work_dir):
+        """Run tpai.exe once per image."""
+        staging_suffix, staging_kwargs = STAGING_FORMATS[staging_format]
+        output_images = None # Allocated once the first output size is known
         autopilot_settings_str = "N/A"
         final_settings_json = "{}" # Default empty JSON
 
         for i, image in enumerate(images):
             input_path = None # Initialize paths
             output_path = None
-            process = None # Initialize process variable
-            filters = {} # Reset filters for each image
 
             try:
                 # Convert tensor to PIL
@@ -123,97 +171,64 @@ class ComfyTopazPhoto:
                 img_pil = Image.fromarray((img_np * 255).astype(np.uint8))
 
                 # Create temp input file using tempfile for unique names
-                with tempfile.NamedTemporaryFile(dir=self.output_dir, suffix=".png", delete=False) as temp_input_file:
+                with tempfile.NamedTemporaryFile(dir=work_dir, suffix=staging_suffix, delete=False) as temp_input_file:
                     input_path = temp_input_file.name
                 # Ensure the file handle is closed before saving, or save directly
-                img_pil.save(input_path, pnginfo=None, compress_level=6)
+                img_pil.save(input_path, **staging_kwargs)
 
                 # Create temp output file path
-                temp_output_file = tempfile.NamedTemporaryFile(dir=self.output_dir, suffix=".png", delete=False)
+                temp_output_file = tempfile.NamedTemporaryFile(dir=work_dir, suffix=".png", delete=False)
                 output_path = temp_output_file.name
                 temp_output_file.close() # Close handle immediately
 
-                # Build filters JSON (Simplified logic)
-                if upscale and upscale.get("enabled", False):
-                    filters[upscale.get("module", "enhance")] = {} # Use Autopilot settings
-                if sharpen and sharpen.get("enabled", False):
-                    filters[sharpen.get("module", "sharpen")] = {} # Use Autopilot settings
-                if face_recovery and face_recovery.get("enabled", False):
-                    filters[face_recovery.get("module", "faceRecover")] = {} # Use Autopilot settings
-
                 # --- Processing Logic ---
-                settings_json_for_run = "{}"
-                if not filters:
-                    # No filters enabled, copy original image to output path
-                    print(f"[ComfyTopazPhoto] Warning: No Topaz filters enabled for image {i+1}. Returning original image.")
-                    try:
-                        if os.path.exists(output_path): os.remove(output_path)
-                        # Use copy instead of link for reliability
-                        shutil.copy2(input_path, output_path)
-                    except Exception as e:
-                        print(f"[ComfyTopazPhoto] Error copying original image: {e}")
-                        raise RuntimeError(f"Failed to prepare original image for output: {e}")
-                else:
-                    # Filters enabled, run tpai.exe
-                    settings_json_for_run = json.dumps({"filters": filters})
-                    if i == 0: final_settings_json = settings_json_for_run # Store JSON for the first processed image
-
-                    # Build command, ensure paths are quoted
-                    command_parts = [
-                        f'"{tpai_exe}"', # Assume tpai_exe might need quotes
-                        f'"{input_path}"',
-                        '--output', f'"{output_path}"',
-                        '--compression', str(compression),
-                        '--override',
-                        '--settings', settings_json_for_run # Pass JSON string directly
-                    ]
-                    command_str = " ".join(command_parts)
-                    print(f"[ComfyTopazPhoto] Executing: {command_str}")
-
-                    startupinfo = None
-                    if os.name == 'nt':
-                        startupinfo = subprocess.STARTUPINFO()
-                        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-
-                    process = subprocess.Popen(command_str, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, startupinfo=startupinfo, text=True, encoding='utf-8', errors='replace')
-                    stdout, stderr = process.communicate()
-                    return_code = process.returncode
-
-                    print(f"[ComfyTopazPhoto] stdout:\n{stdout}")
-                    if stderr: print(f"[ComfyTopazPhoto] stderr:\n{stderr}")
-                    print(f"[ComfyTopazPhoto] Return code: {return_code}")
-
-                    # Extract Autopilot settings from stdout
-                    for line in stdout.splitlines():
-                        if line.startswith('Autopilot settings: '):
-                            autopilot_settings_str = line.split('Autopilot settings: ', 1)[1]
-                            break
-
-                    # Check for errors
-                    if return_code != 0 and return_code != 1: # 0=Success, 1=Partial success
-                        error_message = f"tpai.exe failed with return code {return_code}. "
-                        error_codes = {255: "No valid files passed.", 254: "Invalid log token. Login via GUI.", 253: "Invalid argument."}
-                        error_message += error_codes.get(return_code, "Check console/logs.")
-                        raise RuntimeError(f"[ComfyTopazPhoto] Error: {error_message}")
-
-                    if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
-                        raise RuntimeError(f"[ComfyTopazPhoto] Error: Output file missing or empty: {output_path}")
-
-                # --- Load Output Image ---
-                img_out_pil = Image.open(output_path).convert("RGB")
-                img_out_np = np.array(img_out_pil).astype(np.float32) / 255.0
-                img_out_tensor = torch.from_numpy(img_out_np).unsqueeze(0)
-                batch_results.append(img_out_tensor)
+                settings_json_for_run = json.dumps({"filters": filters})
+                if i == 0: final_settings_json = settings_json_for_run # Store JSON for the first processed image
+
+                # argv goes straight to the process, so the settings JSON needs no quoting
+                argv = build_tpai_argv(tpai_exe, input_path, output_path,
+                                       ['--format', 'png', # Output stays PNG whatever the staging format
+                                        '--compression', str(compression), '--override'],
+                                       settings_json_for_run)
+                print(f"[ComfyTopazPhoto] Executing: {format_argv(argv)}")
+
+                # stdout is parsed line by line as it arrives
+                parser = TpaiOutputParser()
+                result = run_tpai(argv, parser=parser, count=1)
+                return_code = result.returncode
+
+                print(f"[ComfyTopazPhoto] stdout:\n{result.stdout}")
+                if result.stderr: print(f"[ComfyTopazPhoto] stderr:\n{result.stderr}")
+                print(f"[ComfyTopazPhoto] Return code: {return_code}")
+
+                if parser.first_settings() is not None:
+                    autopilot_settings_str = parser.first_settings()
+
+                # Check for errors
+                if return_code != 0 and return_code != 1: # 0=Success, 1=Partial success
+                    error_message = f"tpai.exe failed with return code {return_code}. "
+                    error_message += TPAI_ERROR_CODES.get(return_code, "Check console/logs.")
+                    raise RuntimeError(f"[ComfyTopazPhoto] Error: {error_message}")
+
+                if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+                    raise RuntimeError(f"[ComfyTopazPhoto] Error: Output file missing or empty: {output_path}")
+
+                # --- Load Output Image straight into the preallocated batch ---
+                with Image.open(output_path) as img_out_pil:
+                    img_out_np = np.asarray(img_out_pil.convert("RGB"))
+                if output_images is None:
+                    output_images = torch.empty((len(images),) + img_out_np.shape, dtype=torch.float32)
+                copy_uint8_frame(output_images, i, img_out_np)
 
             except Exception as e:
+                 # Cancelled from the UI: let ComfyUI handle the interrupt
+                 if is_interrupt(e):
+                     raise
                  print(f"[ComfyTopazPhoto] Error processing image {i+1} ({input_path if input_path else 'N/A'}): {e}")
                  # Stop the batch on first error
                  raise RuntimeError(f"Error processing image {i+1}: {e}") from e
             finally:
                 # --- Cleanup --- Ensures temp files are removed ---
-                if process and process.poll() is None:
-                    try: process.kill()
-                    except Exception: pass
                 if input_path and os.path.exists(input_path):
                     try: os.remove(input_path)
                     except OSError as e: print(f"Error removing temp input file {input_path}: {e}")
@@ -222,9 +237,52 @@ class ComfyTopazPhoto:
                     except OSError as e: print(f"Error removing temp output file {output_path}: {e}")
 
         # --- Final Check and Return ---
-        if not batch_results:
+        if output_images is None:
              # This case should ideally be caught earlier if copy/processing fails
              raise RuntimeError("[ComfyTopazPhoto] Error: No images were successfully processed or prepared.")
 
-        output_images = torch.cat(batch_results, dim=0)
-        return (output_images, final_settings_json, autopilot_settings_str) 
\ No newline at end of file
+        return (output_images, final_settings_json, autopilot_settings_str)
+
+    def _process_batch(self, images, tpai_exe, compression, filters, staging_format, work_dir):
+        """Stage the whole batch in one folder and run tpai.exe once over it."""
+        staging_dir = os.path.join(work_dir, "input")
+        output_dir = os.path.join(work_dir, "output")
+        os.makedirs(staging_dir)
+        os.makedirs(output_dir)
+
+        settings_json = json.dumps({"filters": filters})
+        staging_suffix, staging_kwargs = STAGING_FORMATS[staging_format]
+        autopilot_settings_str = "N/A"
+
+        token, stems = output_stems(len(images))
+        for image, stem in zip(images, stems):
+            img_pil = Image.fromarray((image.cpu().numpy() * 255).astype(np.uint8))
+            img_pil.save(os.path.join(staging_dir, stem + staging_suffix), **staging_kwargs)
+
+        argv = build_tpai_argv(tpai_exe, staging_dir, output_dir,
+                               ['--format', 'png', '--compression', str(compression), '--override'],
+                               settings_json)
+        print(f"[ComfyTopazPhoto] Executing batch of {len(stems)}: {format_argv(argv)}")
+
+        parser = TpaiOutputParser()
+        result = run_tpai(argv, parser=parser, count=len(stems))
+        return_code = result.returncode
+
+        print(f"[ComfyTopazPhoto] stdout:\n{result.stdout}")
+        if result.stderr: print(f"[ComfyTopazPhoto] stderr:\n{result.stderr}")
+        print(f"[ComfyTopazPhoto] Return code: {return_code}")
+
+        if parser.first_settings() is not None:
+            autopilot_settings_str = parser.first_settings()
+
+        if return_code != 0 and return_code != 1: # 0=Success, 1=Partial success
+            error_message = f"tpai.exe failed with return code {return_code}. "
+            error_message += TPAI_ERROR_CODES.get(return_code, "Check console/logs.")
+            raise RuntimeError(f"[ComfyTopazPhoto] Error: {error_message}")
+
+        output_paths = resolve_outputs(token, len(stems), output_dir, "png")
+        missing = [i + 1 for i, path in enumerate(output_paths) if path is None]
+        if missing:
+            raise RuntimeError(f"[ComfyTopazPhoto] Error: No output produced for images {missing}")
+
+        return (load_images_to_tensor(output_paths), settings_json, autopilot_settings_str)
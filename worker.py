@@ -0,0 +1,319 @@
+import os
+import re
+import json
+import time
+import select
+import shutil
+import socket
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .jobs import CANCEL_POLL_SECONDS, JobCancelled
+from .progress import cancel_scope
+from .remote import (HEARTBEAT, HEARTBEAT_INTERVAL, PROTOCOL_VERSION, WORKER_TOKEN_ENV, WorkerError, encode_header,
+                     file_entries, read_header, receive_files, send_files)
+from .retry import breaker_scope
+from .scheduler import MAX_TOTAL_WORKERS, get_scheduler, job_context
+from .staging import make_work_dir
+from .topaz import TopazError, init_topaz, process_topaz_paths
+
+# 日志前缀
+log_prefix = "[ComfyTopazPhoto]"
+
+# 默认监听地址和端口；默认只接受本机连接，供其他主机使用时需显式指定 --host
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8601
+
+# 单个请求的最大字节数，可通过环境变量 COMFY_TOPAZ_WORKER_MAX_UPLOAD_MB 调整
+MAX_UPLOAD_BYTES = int(float(os.environ.get("COMFY_TOPAZ_WORKER_MAX_UPLOAD_MB", 4096)) * 1024 * 1024)
+
+# 输入文件只保留这些字符组成的扩展名，文件名由 worker 自己生成
+_EXTENSION_PATTERN = re.compile(r"^\.[A-Za-z0-9]{1,8}$")
+
+class BadRequest(Exception):
+    """请求格式错误"""
+    pass
+
+class TopazWorker:
+    """
+    通过 HTTP 接受图像批次并在本机调用 tpai 处理的 worker
+
+    GET /health 返回 tpai 版本和调度器负载；POST /process 接受 remote.py 中定义的消息，
+    把输入流式写入暂存目录，用与节点相同的 process_topaz_paths 处理，再把输出流式返回。
+    处理期间定期发送心跳，客户端断开时取消该请求的 tpai 调用。
+    所有请求共享进程级调度器，并发的 tpai 进程数不超过 COMFY_TOPAZ_MAX_WORKERS。
+
+    参数:
+        tpai_exe (str): tpai 可执行文件路径
+        execution_mode (str): batch、parallel 或 sequential
+        max_workers (int): 每个请求在 parallel 模式下的最大 tpai 进程数
+        token (str, optional): 访问令牌，默认读取环境变量 COMFY_TOPAZ_WORKER_TOKEN
+        staging_dir (str, optional): 暂存目录
+        max_upload_bytes (int): 单个请求的最大字节数
+    """
+
+    def __init__(self, tpai_exe, execution_mode="parallel", max_workers=MAX_TOTAL_WORKERS, token=None, staging_dir=None,
+                 max_upload_bytes=MAX_UPLOAD_BYTES):
+        self.tpai_exe, self.tpai_version = init_topaz(tpai_exe)
+        self.execution_mode = execution_mode
+        self.max_workers = max_workers
+        self.token = token if token is not None else os.environ.get(WORKER_TOKEN_ENV)
+        self.staging_dir = staging_dir or None
+        self.max_upload_bytes = max_upload_bytes
+        self.completed = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def health(self):
+        """返回 /health 的内容"""
+        stats = get_scheduler().stats()
+        return {
+            "status": "ok",
+            "version": self.tpai_version,
+            "protocol": PROTOCOL_VERSION,
+            "running": stats["running"],
+            "queued": stats["queued"],
+            "limit": stats["limit"],
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+    def authorized(self, authorization):
+        return not self.token or authorization == f"Bearer {self.token}"
+
+    def receive(self, stream, client):
+        """
+        读取一个请求，把输入流式写入新的工作目录
+
+        参数:
+            stream: 请求体
+            client (str): 客户端地址，与请求中的所属者一起用于调度器的公平排队
+
+        返回:
+            WorkerRequest: 调用方处理完后删除其 work_dir
+        """
+        try:
+            header = read_header(stream)
+        except (WorkerError, ValueError) as e:
+            raise BadRequest(str(e))
+        entries = header.get("files") or []
+        if not entries:
+            raise BadRequest("请求中没有图像")
+        settings = header.get("settings")
+        if settings is not None and len(settings) != len(entries):
+            raise BadRequest(f"设置数量 ({len(settings)}) 与图像数量 ({len(entries)}) 不一致")
+
+        work_dir = make_work_dir(sum(int(entry["size"]) for entry in entries) * 4, self.staging_dir, prefix="worker_")
+        try:
+            input_folder = os.path.join(work_dir, "input")
+            os.makedirs(input_folder)
+            os.makedirs(os.path.join(work_dir, "output"))
+
+            input_paths = []
+            for i, entry in enumerate(entries):
+                extension = os.path.splitext(str(entry.get("name", "")))[1]
+                if not _EXTENSION_PATTERN.match(extension):
+                    raise BadRequest(f"不支持的文件名: {entry.get('name')}")
+                input_paths.append(os.path.join(input_folder, f"{i:05d}{extension.lower()}"))
+            try:
+                receive_files(stream, entries, input_paths)
+            except WorkerError as e:
+                raise BadRequest(str(e))
+        except BaseException:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            raise
+        return WorkerRequest(header, input_paths, work_dir, f"{client}:{header.get('owner') or 'default'}")
+
+    def run(self, request, cancel):
+        """
+        处理一个请求
+
+        参数:
+            request (WorkerRequest): receive 返回的请求
+            cancel (threading.Event): 客户端断开时被设置，正在运行或排队的 tpai 调用随即结束
+
+        返回:
+            (reply_header, output_paths)
+        """
+        header = request.header
+        output_folder = os.path.join(request.work_dir, "output")
+        print(f"{log_prefix} worker 收到 {len(request.input_paths)} 个图像 (来自 {request.owner}, 优先级 {header.get('priority', 'normal')})")
+        try:
+            with cancel_scope(cancel), breaker_scope(), job_context(header.get("priority", "normal"), owner=request.owner):
+                output_paths = process_topaz_paths(self.tpai_exe, request.input_paths, output_folder, header.get("output_format", "png"),
+                                                   int(header.get("quality", 95)), True, self.execution_mode, self.max_workers,
+                                                   header.get("settings"))
+            if len(output_paths) != len(request.input_paths):
+                raise TopazError(f"输出数量 ({len(output_paths)}) 与输入数量 ({len(request.input_paths)}) 不一致")
+        except BaseException:
+            with self._lock:
+                self.failed += 1
+            raise
+        with self._lock:
+            self.completed += 1
+        return {"version": PROTOCOL_VERSION, "tpai_version": self.tpai_version, "files": file_entries(output_paths)}, output_paths
+
+class WorkerRequest:
+    """worker 已接收的一个请求"""
+    __slots__ = ("header", "input_paths", "work_dir", "owner")
+
+    def __init__(self, header, input_paths, work_dir, owner):
+        self.header = header
+        self.input_paths = input_paths
+        self.work_dir = work_dir
+        self.owner = owner
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "ComfyTopazPhotoWorker"
+
+    @property
+    def worker(self):
+        return self.server.worker
+
+    def _send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/health":
+            return self._send_json(404, {"error": f"未知路径: {self.path}"})
+        if not self.worker.authorized(self.headers.get("Authorization")):
+            return self._send_json(401, {"error": "访问令牌无效"})
+        self._send_json(200, self.worker.health())
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/process":
+            return self._send_json(404, {"error": f"未知路径: {self.path}"})
+        # 拒绝请求时不会读取请求体，连接不能再复用
+        self.close_connection = True
+        if not self.worker.authorized(self.headers.get("Authorization")):
+            return self._send_json(401, {"error": "访问令牌无效"})
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            return self._send_json(411, {"error": "缺少 Content-Length"})
+        if length > self.worker.max_upload_bytes:
+            return self._send_json(413, {"error": f"请求过大: {length} 字节, 上限 {self.worker.max_upload_bytes} 字节"})
+
+        try:
+            request = self.worker.receive(self.rfile, self.client_address[0])
+        except BadRequest as e:
+            return self._send_json(400, {"error": str(e)})
+        except Exception as e:
+            print(f"{log_prefix} worker 接收请求时出错: {str(e)}")
+            return self._send_json(500, {"error": f"worker 内部错误: {str(e)}"})
+
+        try:
+            # 收到完整的请求后立即响应，处理结果 (或错误) 在心跳之后以消息的形式发送
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.flush()
+
+            outcome = self._run_with_heartbeat(request)
+            if outcome is None:
+                return
+            reply, output_paths = outcome
+            self.wfile.write(encode_header(reply))
+            send_files(self.wfile.write, output_paths)
+        except OSError as e:
+            print(f"{log_prefix} worker 发送结果失败 (客户端可能已断开): {str(e)}")
+        finally:
+            shutil.rmtree(request.work_dir, ignore_errors=True)
+
+    def _run_with_heartbeat(self, request):
+        """
+        在后台线程中处理请求，同时发送心跳并检查客户端是否断开
+
+        返回:
+            (reply_header, output_paths)，处理失败时为只含错误信息的消息头；客户端断开时返回 None
+        """
+        cancel = threading.Event()
+        outcome = {}
+
+        def run():
+            try:
+                outcome["result"] = self.worker.run(request, cancel)
+            except BaseException as e:
+                outcome["error"] = e
+
+        thread = threading.Thread(target=run, name="topaz_worker_job", daemon=True)
+        thread.start()
+        last_heartbeat = time.monotonic()
+        while True:
+            thread.join(CANCEL_POLL_SECONDS)
+            if not thread.is_alive():
+                break
+            gone = self._client_gone()
+            if not gone and time.monotonic() - last_heartbeat >= HEARTBEAT_INTERVAL:
+                try:
+                    self.wfile.write(HEARTBEAT)
+                    self.wfile.flush()
+                    last_heartbeat = time.monotonic()
+                except OSError:
+                    gone = True
+            if gone:
+                print(f"{log_prefix} worker: 客户端 {request.owner} 已断开，取消任务")
+                cancel.set()
+                thread.join()
+                return None
+
+        error = outcome.get("error")
+        if error is None:
+            return outcome["result"]
+        if isinstance(error, JobCancelled):
+            return None
+        if not isinstance(error, TopazError):
+            print(f"{log_prefix} worker 处理请求时出错: {str(error)}")
+        return {"version": PROTOCOL_VERSION, "error": str(error)}, []
+
+    def _client_gone(self):
+        """客户端上传完成后不再发送数据，连接可读说明它已关闭"""
+        try:
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            return bool(readable) and self.connection.recv(1, socket.MSG_PEEK) == b""
+        except (OSError, ValueError):
+            return True
+
+    def log_message(self, format, *args):
+        print(f"{log_prefix} worker {self.address_string()} - {format % args}")
+
+def make_server(worker, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """创建 worker 的 HTTP 服务 (port 为 0 时使用随机端口)，调用 serve_forever() 开始服务"""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.worker = worker
+    return server
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Topaz Photo AI worker service for ComfyTopazPhoto client mode")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="address to bind (default: %(default)s, local connections only)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port to listen on (default: %(default)s)")
+    parser.add_argument("--tpai-exe", default=None, help="path to tpai; searched in the standard install locations if omitted")
+    parser.add_argument("--execution-mode", choices=["batch", "parallel", "sequential"], default="parallel")
+    parser.add_argument("--max-workers", type=int, default=MAX_TOTAL_WORKERS,
+                        help="tpai processes per request in parallel mode (the process-wide limit is COMFY_TOPAZ_MAX_WORKERS)")
+    parser.add_argument("--token", default=None, help=f"access token (default: ${WORKER_TOKEN_ENV})")
+    parser.add_argument("--staging-dir", default=None, help="directory for staged inputs and outputs")
+    args = parser.parse_args(argv)
+
+    worker = TopazWorker(args.tpai_exe, args.execution_mode, args.max_workers, args.token, args.staging_dir)
+    server = make_server(worker, args.host, args.port)
+    host, port = server.server_address[:2]
+    print(f"{log_prefix} Topaz worker 已启动: http://{host}:{port} (tpai: {worker.tpai_exe}, 版本: {worker.tpai_version}, "
+          f"并发上限: {get_scheduler().limit})")
+    if not worker.token and args.host not in ("127.0.0.1", "localhost", "::1"):
+        print(f"{log_prefix} 警告: 未设置访问令牌，任何能连接到 {host}:{port} 的主机都可以提交任务")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()